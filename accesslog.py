@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import random
+import logging
+import threading
+from collections import deque
+
+
+class RingBuffer(object):
+    """Очередь записей ограниченной длины между циклом событий и потоком записи.
+
+    put вызывается только из цикла событий и никогда не ждет:
+    если буфер полон, запись отбрасывается и учитывается в dropped.
+    append/popleft у deque атомарны, поэтому блокировка не нужна.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.items = deque()
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, item):
+        if len(self.items) >= self.capacity:
+            self.dropped += 1
+            return False
+        self.items.append(item)
+        return True
+
+    def drain(self):
+        items = []
+        popleft = self.items.popleft
+        try:
+            while True:
+                items.append(popleft())
+        except IndexError:
+            pass
+        return items
+
+
+class BackgroundFlusher(threading.Thread):
+    """Раз в interval секунд отдает накопленное в буфере функции write одним списком"""
+
+    def __init__(self, buffer, write, interval):
+        super(BackgroundFlusher, self).__init__(name='log-flusher')
+        self.daemon = True
+        self.buffer = buffer
+        self.write = write
+        self.interval = interval
+        self.running = True
+
+    def run(self):
+        while self.running:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        items = self.buffer.drain()
+        if items:
+            try:
+                self.write(items)
+            except Exception:
+                # поток записи не должен умирать из-за одной ошибки диска
+                pass
+
+    def stop(self):
+        """Останавливает поток и дописывает остаток буфера"""
+        self.running = False
+        if self.is_alive():
+            self.join()
+        self.flush()
+
+
+class AccessLog(object):
+    """Журнал запросов worker'а.
+
+    record только кладет кортеж в кольцевой буфер, строки форматирует
+    и пишет поток - одним write с O_APPEND на пачку, поэтому пачки
+    нескольких worker'ов в общем файле не перемешиваются.
+    sample - доля записываемых запросов (0..1), остальные считаются в skipped.
+    """
+
+    capacity = 65536
+
+    def __init__(self, path, capacity=None, interval=0.5, sample=1.0):
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.buffer = RingBuffer(capacity or self.capacity)
+        self.sample = sample
+        self.skipped = 0
+        self.written = 0
+        self.flusher = BackgroundFlusher(self.buffer, self.write, interval)
+
+    def start(self):
+        # потоки не переживают fork: запускается в worker'е
+        self.flusher.start()
+
+    def record(self, addr, method, path, version, status, size, seconds):
+        if self.sample < 1.0 and random.random() >= self.sample:
+            self.skipped += 1
+            return
+        self.buffer.put((time.time(), addr, method, path, version, status, size, seconds))
+
+    def write(self, items):
+        lines = []
+        for timestamp, addr, method, path, version, status, size, seconds in items:
+            lines.append('{} [{}] "{} {} {}" {} {:d} {:.6f}\n'.format(
+                addr or '-',
+                time.strftime('%d/%b/%Y:%H:%M:%S +0000', time.gmtime(timestamp)),
+                method or '-', path or '-', version, status or '-', size, seconds))
+        data = ''.join(lines)
+        while data:
+            data = data[os.write(self.fd, data):]
+        self.written += len(items)
+
+    def close(self):
+        self.flusher.stop()
+        os.close(self.fd)
+
+    def stats(self):
+        return {'written': self.written,
+                'dropped': self.buffer.dropped,
+                'skipped': self.skipped}
+
+
+class BufferedLogHandler(logging.Handler):
+    """Обработчик logging, который только кладет запись в кольцевой буфер;
+    форматируют и пишут ее прежние обработчики в потоке записи"""
+
+    def __init__(self, targets, capacity=8192, interval=0.5):
+        logging.Handler.__init__(self)
+        self.targets = targets
+        self.buffer = RingBuffer(capacity)
+        self.flusher = BackgroundFlusher(self.buffer, self.write, interval)
+
+    def emit(self, record):
+        if record.exc_info:
+            # трассировку форматируем сразу, пока кадры не изменились
+            self.format(record)
+        self.buffer.put(record)
+
+    def write(self, records):
+        for record in records:
+            for target in self.targets:
+                if record.levelno >= target.level:
+                    target.handle(record)
+
+    def close(self):
+        self.flusher.stop()
+        logging.Handler.close(self)
+
+    def stats(self):
+        return {'dropped': self.buffer.dropped}
+
+
+def buffer_logging(capacity=8192, interval=0.5):
+    """Переключает корневой logger процесса на запись через буфер и поток"""
+    root = logging.getLogger()
+    handler = BufferedLogHandler(root.handlers[:], capacity, interval)
+    root.handlers = [handler]
+    handler.flusher.start()
+    return handler
+
+
+def restore_logging(handler):
+    """Дописывает буфер и возвращает обработчики, замененные buffer_logging"""
+    handler.close()
+    logging.getLogger().handlers = handler.targets
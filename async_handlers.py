@@ -2,15 +2,39 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
+import math
 import time
 import socket
 import select
 import logging
 import multiprocessing
+import ctypes
+import ctypes.util
+import fcntl
+import signal
+import struct
+import threading
+import Queue
+from itertools import islice
+from collections import deque
 from errno import (EWOULDBLOCK, ECONNRESET, EINVAL, ENOTCONN,
-                   ESHUTDOWN, EINTR, EBADF, ECONNABORTED, EPIPE, EAGAIN, errorcode)
+                   ESHUTDOWN, EINTR, EBADF, ECONNABORTED, EPIPE, EAGAIN,
+                   EMFILE, ENFILE, ENOBUFS, ENOMEM, errorcode)
+
+try:
+    # asyncio для python 2 - trollius, API тот же
+    import trollius as asyncio
+except ImportError:
+    asyncio = None
 
 DISCONNECTED = frozenset((ECONNRESET, ENOTCONN, ESHUTDOWN, ECONNABORTED, EPIPE, EBADF))
+# ошибки accept, после которых слушающий сокет остается рабочим
+ACCEPT_FAILURES = frozenset((ECONNABORTED, EMFILE, ENFILE, ENOBUFS, ENOMEM))
+
+# в python 2 этих констант нет, значения из заголовков Linux
+EPOLLEXCLUSIVE = getattr(select, 'EPOLLEXCLUSIVE', 1 << 28)
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
 
 
 def _strerror(err):
@@ -20,6 +44,103 @@ def _strerror(err):
         return errorcode[err] if err in errorcode else "Unknown error {}".format(err)
 
 
+def _libc_sendfile():
+    """sendfile(2) через ctypes для python 2, где нет os.sendfile"""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = libc.sendfile64
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int,
+                     ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    func.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        offset = ctypes.c_int64(offset)
+        sent = func(out_fd, in_fd, ctypes.byref(offset), count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, _strerror(err))
+        return sent
+    return sendfile
+
+
+_sendfile = getattr(os, 'sendfile', None) or _libc_sendfile()
+HAVE_SENDFILE = _sendfile is not None
+
+
+# python 2 не умеет sendmsg, там мелкие части склеиваются перед отправкой
+HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg')
+IOV_MAX = 1024
+COALESCE_SIZE = 16 * 1024
+
+
+class OutputQueue(object):
+    """Очередь исходящих данных.
+
+    Части хранятся как memoryview без склеивания, отправленный
+    префикс отсекается срезом memoryview, а не копированием строки.
+    """
+
+    def __init__(self):
+        self.chunks = deque()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __nonzero__(self):
+        return self.size > 0
+
+    __bool__ = __nonzero__
+
+    def append(self, data):
+        if data:
+            self.chunks.append(memoryview(data))
+            self.size += len(data)
+
+    def views(self, limit=IOV_MAX):
+        """Первые части очереди для scatter/gather отправки"""
+        return list(islice(self.chunks, limit))
+
+    def peek(self, coalesce=COALESCE_SIZE):
+        """Начало очереди одним буфером: мелкие части склеиваются,
+        чтобы заголовки и небольшое тело ушли одним send"""
+        first = self.chunks[0]
+        if len(first) >= coalesce or len(self.chunks) == 1:
+            return first
+        parts = []
+        size = 0
+        for chunk in self.chunks:
+            if size + len(chunk) > coalesce:
+                break
+            parts.append(chunk.tobytes())
+            size += len(chunk)
+        return ''.join(parts)
+
+    def consume(self, sent):
+        self.size -= sent
+        while sent:
+            first = self.chunks[0]
+            if sent >= len(first):
+                self.chunks.popleft()
+                sent -= len(first)
+            else:
+                self.chunks[0] = first[sent:]
+                sent = 0
+
+    def clear(self):
+        self.chunks.clear()
+        self.size = 0
+
+
+# общий для всех соединений worker'а буфер приема: цикл однопоточный,
+# а принятые байты сразу копируются в recv_buffer соединения
+RECV_SIZE = 64 * 1024
+_recv_area = memoryview(bytearray(RECV_SIZE))
+
 socket_map = {}
 
 
@@ -27,6 +148,16 @@ class ExitNow(Exception):
     pass
 
 
+# плавная остановка запрошена сигналом, см. request_stop
+_stop_requested = False
+
+
+def request_stop(signum=None, frame=None):
+    """Плавная остановка циклов событий процесса; годится как обработчик сигнала"""
+    global _stop_requested
+    _stop_requested = True
+
+
 _reraised_exceptions = (ExitNow, KeyboardInterrupt, SystemExit)
 
 
@@ -86,56 +217,237 @@ def _exception(obj):
         obj.handle_error()
 
 
-def epoll_poller(timeout=0.0, map=None):
-    """A poller which uses epoll(), supported on Linux 2.5.44 and newer."""
-    _stopping = False
-    r = []
-    if map is None:
-        map = socket_map
-    pollster = select.epoll()
-    if map:
-        for fd, obj in map.items():
-            flags = 0
-            if obj.readable():
-                flags |= select.POLLIN | select.POLLPRI
-            if obj.writable():
-                flags |= select.POLLOUT
-            if flags:
-                # Only check for exceptions if object was either readable
-                # or writable.
-                flags |= select.POLLERR | select.POLLHUP | select.POLLNVAL
-                pollster.register(fd, flags)
+class BaseReactor(object):
+    """Общее для реакторов worker'а: map, канал пробуждения от сигналов,
+    рассылка остановки и замер времени обработчиков.
+
+    Наследник реализует poll(timeout), а если следит за интересом
+    обработчиков - и register/modify/unregister.
+    """
+
+    def __init__(self, map=None, slow_callback=None):
+        if map is None:
+            map = socket_map
+        self.map = map
+        # порог в секундах, дольше которого обработчик события попадает в лог
+        self.slow_callback = slow_callback
+        # время обработки событий последней итерации, без ожидания в poll
+        self.dispatch_time = 0.0
+        # остановка уже разослана обработчикам
+        self.stopped = False
+        # канал, которым сигнал будит poll (signal.set_wakeup_fd)
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        for fd in (self.wakeup_r, self.wakeup_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        _reactors[id(map)] = self
+
+    def register(self, obj):
+        pass
+
+    def modify(self, obj):
+        pass
+
+    def unregister(self, fd):
+        pass
+
+    def stop_channels(self):
+        """Рассылает handle_stop_event всем обработчикам"""
+        # снимок обработчиков, а не номеров: номер закрытого при остановке
+        # соединения может тут же достаться новому, принятому слушающим сокетом
+        for obj in list(self.map.values()):
+            if obj._fileno is None:
+                continue
+            stopping(obj)
+            self.modify(obj)
+
+    def dispatcher(self):
+        return readwrite if self.slow_callback is None else self.timed_readwrite
+
+    def finish_dispatch(self, started, events):
+        self.dispatch_time = time.time() - started
+        if self.slow_callback is not None and self.dispatch_time >= self.slow_callback:
+            logging.warning('{}: slow poll iteration {:.1f} ms, {:d} events'.format(
+                multiprocessing.current_process().name, self.dispatch_time * 1000, events))
+
+    def drain_wakeup(self):
+        try:
+            while os.read(self.wakeup_r, 4096):
+                pass
+        except OSError as err:
+            if err.args[0] not in (EWOULDBLOCK, EAGAIN):
+                raise
+
+    def timed_readwrite(self, obj, flags):
+        started = time.time()
+        readwrite(obj, flags)
+        elapsed = time.time() - started
+        if elapsed >= self.slow_callback:
+            logging.warning('{}: slow callback {:.1f} ms, events {:#x}: {!r}'.format(
+                multiprocessing.current_process().name, elapsed * 1000, flags, obj))
+
+    def close(self):
+        _reactors.pop(id(self.map), None)
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+
+
+class EpollReactor(BaseReactor):
+    """Долгоживущий epoll одного worker'а.
+
+    Дескрипторы регистрируются один раз при добавлении в map,
+    флаги меняются только когда обработчик меняет интерес
+    (например, send_buffer стал непустым), поэтому стоимость
+    итерации зависит от числа готовых событий, а не соединений.
+    """
+
+    def __init__(self, map=None, edge_triggered=False, slow_callback=None):
+        self.edge_triggered = edge_triggered
+        self.pollster = select.epoll()
+        self.interest = {}
+        super(EpollReactor, self).__init__(map, slow_callback)
+        self.pollster.register(self.wakeup_r, select.EPOLLIN)
+        for obj in self.map.values():
+            self.register(obj)
+
+    def flags_for(self, obj):
+        flags = 0
+        if obj.accepting and obj.exclusive:
+            # общий слушающий сокет: будим только один из worker'ов.
+            # EPOLLEXCLUSIVE допускает лишь EPOLLIN/EPOLLOUT/EPOLLET
+            return select.EPOLLIN | EPOLLEXCLUSIVE if obj.readable() else 0
+        if obj.readable():
+            flags |= select.EPOLLIN | select.EPOLLPRI
+        # accepting sockets should not be writable
+        if obj.writable() and not obj.accepting:
+            flags |= select.EPOLLOUT
+        if flags:
+            flags |= select.EPOLLERR | select.EPOLLHUP
+            # слушающий сокет оставляем level-triggered,
+            # чтобы не пропустить ожидающие accept соединения
+            if self.edge_triggered and not obj.accepting:
+                flags |= select.EPOLLET
+        return flags
+
+    def register(self, obj):
+        fd = obj._fileno
+        if fd is None or fd in self.interest:
+            return
+        flags = self.flags_for(obj)
+        try:
+            self.pollster.register(fd, flags)
+        except (IOError, OSError) as err:
+            if err.args[0] != EINVAL or not flags & EPOLLEXCLUSIVE:
+                raise
+            # ядро старше 4.5 не знает EPOLLEXCLUSIVE
+            obj.exclusive = False
+            flags = self.flags_for(obj)
+            self.pollster.register(fd, flags)
+        self.interest[fd] = flags
+
+    def modify(self, obj):
+        fd = obj._fileno
+        if fd is None:
+            return
+        if fd not in self.interest:
+            self.register(obj)
+            return
+        flags = self.flags_for(obj)
+        # в edge-triggered режиме повторно взводим EPOLLOUT,
+        # пока обработчику есть что отправлять
+        if flags & EPOLLEXCLUSIVE and flags == self.interest[fd]:
+            return
+        if (flags | self.interest[fd]) & EPOLLEXCLUSIVE:
+            # EPOLL_CTL_MOD для EPOLLEXCLUSIVE запрещен, перерегистрируем
+            self.unregister(fd)
+            self.register(obj)
+        elif flags != self.interest[fd] or (self.edge_triggered and flags & select.EPOLLOUT):
+            self.pollster.modify(fd, flags)
+            self.interest[fd] = flags
+
+    def unregister(self, fd):
+        if self.interest.pop(fd, None) is None:
+            return
         try:
-            r = pollster.poll(timeout)
-        except select.error, err:
+            self.pollster.unregister(fd)
+        except (IOError, OSError, ValueError):
+            pass
+
+    def poll(self, timeout=0.0):
+        _stopping = False
+        r = []
+        map = self.map
+        if not map:
+            return
+        if _stop_requested and not self.stopped:
+            timeout = 0
+        try:
+            r = self.pollster.poll(timeout)
+        except (IOError, select.error) as err:
             if err.args[0] != EINTR:
                 raise
         except KeyboardInterrupt:
             _stopping = True
 
+        started = time.time()
+        if _stop_requested and not self.stopped:
+            self.stopped = _stopping = True
         if _stopping:
-            for fd in map:
-                stopping(map[fd])
+            self.stop_channels()
 
+        dispatch = self.dispatcher()
         for fd, flags in r:
+            if fd == self.wakeup_r:
+                self.drain_wakeup()
+                continue
             obj = map.get(fd)
             if obj is None:
                 continue
-            readwrite(obj, flags)
+            dispatch(obj, flags)
+            # обработчик мог закрыться или сменить интерес
+            if obj._fileno == fd:
+                self.modify(obj)
 
-        if r == [] and len(map) == 1:
+        if len(map) == 1 and (r == [] or self.stopped):
+            # остался один слушающий сокет - при остановке закрываем и его
             obj = map.values()[0]
             closing(obj)
+        self.finish_dispatch(started, len(r))
 
+    def close(self):
+        self.interest.clear()
+        self.pollster.close()
+        super(EpollReactor, self).close()
 
-def select_poller(timeout=0.0, map=None):
-    """A poller which uses select(), available on most platforms."""
-    _stopping = False
-    if map is None:
-        map = socket_map
-    if map:
-        r = []; w = []; e = []
+
+# select() не принимает дескрипторы с номером от FD_SETSIZE
+FD_SETSIZE = 1024
+
+
+class SelectReactor(BaseReactor):
+    """Реактор на select(): интерес обработчиков опрашивается
+    на каждой итерации, дескрипторы - не больше FD_SETSIZE (1024).
+    Для систем без epoll и для сравнения с EpollReactor.
+    """
+
+    # соединений worker'а, при которых номера их сокетов остаются меньше
+    # FD_SETSIZE: у каждого соединения может быть открыт еще и файл,
+    # часть дескрипторов занята слушающим сокетом, каналами и журналами
+    max_connections = (FD_SETSIZE - 64) // 2
+
+    def poll(self, timeout=0.0):
+        _stopping = False
+        map = self.map
+        if not map:
+            return
+        r = [self.wakeup_r]; w = []; e = []
         for fd, obj in list(map.items()):
+            if fd >= FD_SETSIZE:
+                # select.select бросил бы ValueError и уронил worker
+                # со всеми соединениями - закрываем только это
+                logging.error('{}: descriptor {:d} is over FD_SETSIZE, closing {!r}'.format(
+                    multiprocessing.current_process().name, fd, obj))
+                obj.handle_close()
+                continue
             is_r = obj.readable()
             is_w = obj.writable()
             if is_r:
@@ -145,77 +457,519 @@ def select_poller(timeout=0.0, map=None):
                 w.append(fd)
             if is_r or is_w:
                 e.append(fd)
-        if [] == r == w == e:
-            time.sleep(timeout)
-            return
-
+        if _stop_requested and not self.stopped:
+            timeout = 0
         try:
             r, w, e = select.select(r, w, e, timeout)
-        except (OSError, select.error) as e:
-            if e.args[0] != EINTR:
+        except (OSError, select.error) as err:
+            if err.args[0] != EINTR:
                 raise
+            r = w = e = []
         except KeyboardInterrupt:
+            r = w = e = []
             _stopping = True
 
+        started = time.time()
+        if _stop_requested and not self.stopped:
+            self.stopped = _stopping = True
         if _stopping:
-            for fd in map:
-                stopping(map[fd])
+            self.stop_channels()
 
+        events = {}
         for fd in r:
-            obj = map.get(fd)
-            if obj is None:
-                continue
-            read(obj)
-
+            events[fd] = select.POLLIN
         for fd in w:
-            obj = map.get(fd)
-            if obj is None:
-                continue
-            write(obj)
-
+            events[fd] = events.get(fd, 0) | select.POLLOUT
         for fd in e:
+            events[fd] = events.get(fd, 0) | select.POLLPRI
+        dispatch = self.dispatcher()
+        for fd, flags in events.items():
+            if fd == self.wakeup_r:
+                self.drain_wakeup()
+                continue
             obj = map.get(fd)
             if obj is None:
                 continue
-            _exception(obj)
+            dispatch(obj, flags)
 
-        if r == w == e == [] and len(map) == 1:
+        if len(map) == 1 and (not events or self.stopped):
+            # остался один слушающий сокет - при остановке закрываем и его
             obj = map.values()[0]
             closing(obj)
+        self.finish_dispatch(started, len(events))
+
+
+# сколько байт send_buffer отдавать транспорту asyncio за одно событие записи:
+# неотправленное транспорт копирует в свой буфер
+TRANSPORT_WRITE_SIZE = 256 * 1024
+
+
+class AsyncioTransport(object):
+    """Соединение поверх транспорта asyncio.
+
+    Для asyncio это Protocol: сокет читает и пишет транспорт, принятые
+    байты приходят в data_received. Для обработчика это obj.transport:
+    read забирает принятое, write отдает транспорту часть send_buffer,
+    close и abort закрывают соединение через транспорт. События протокола
+    доходят до обработчика теми же handle_*_event, что и от других реакторов.
+    """
+
+    # сколько транспорт дописывает буфер после close, потом - abort
+    drain_timeout = 10.0
+
+    def __init__(self, reactor, obj):
+        self.reactor = reactor
+        self.obj = obj
+        self.transport = None
+        self.received = []
+        self.reading = True
+        # в буфере транспорта есть неотправленные байты
+        self.paused = False
+        self.closed = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # пауза записи при первом же байте в буфере транспорта: следующая
+        # часть ответа готовится, когда предыдущая целиком ушла в сокет
+        transport.set_write_buffer_limits(0)
+        if self.closed:
+            # обработчик закрылся раньше, чем транспорт был создан
+            transport.abort()
+            return
+        if not self.reading:
+            transport.pause_reading()
+
+    def data_received(self, data):
+        self.received.append(data)
+        self.reactor.ready(self.obj, select.POLLIN)
+
+    def eof_received(self):
+        # read() ничего не добавит - обработчик закроется, как на EOF сокета
+        self.reactor.ready(self.obj, select.POLLIN)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        # транспорт снимает свой add_writer уже после этого вызова
+        self.reactor.loop.call_soon(self.reactor.modify, self.obj)
+
+    def connection_lost(self, exc):
+        self.reactor.draining.discard(self)
+        if not self.closed:
+            self.closed = True
+            self.reactor.ready(self.obj, select.POLLHUP)
+
+    def set_reading(self, reading):
+        """Пауза чтения, пока обработчик не readable()"""
+        if reading == self.reading:
+            return
+        self.reading = reading
+        if self.transport is None or self.closed:
+            return
+        if reading:
+            self.transport.resume_reading()
+        else:
+            self.transport.pause_reading()
+
+    def drained(self):
+        """Буфер транспорта пуст: можно писать дальше и отдавать sendfile"""
+        return self.transport is not None and not self.paused
+
+    def read(self):
+        data = ''.join(self.received)
+        del self.received[:]
+        return data
+
+    def write(self, buffers):
+        """Отдает транспорту начало buffers, не больше TRANSPORT_WRITE_SIZE
+        байт; возвращает, сколько отдано"""
+        if not self.drained() or self.closed:
+            return 0
+        parts = []
+        size = 0
+        for view in buffers:
+            part = view[:TRANSPORT_WRITE_SIZE - size]
+            parts.append(part.tobytes())
+            size += len(part)
+            if size >= TRANSPORT_WRITE_SIZE:
+                break
+        self.transport.write(''.join(parts))
+        return size
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.transport is None:
+            return
+        self.transport.close()
+        if self.transport.get_write_buffer_size():
+            self.reactor.draining.add(self)
+            self.reactor.loop.call_later(self.drain_timeout, self.transport.abort)
+
+    def abort(self):
+        self.closed = True
+        if self.transport is not None:
+            self.transport.abort()
+
+
+class AsyncioReactor(BaseReactor):
+    """Реактор на цикле событий asyncio (trollius в python 2).
+
+    Обработчики с supports_transport работают поверх транспортов asyncio
+    (см. AsyncioTransport), остальные - слушающий сокет, канал пула
+    потоков - ждут готовности через add_reader/add_writer. Сроки
+    соединений по-прежнему отсчитывает колесо таймеров в loop().
+    """
+
+    def __init__(self, map=None, slow_callback=None):
+        self.loop = asyncio.new_event_loop()
+        # fd -> AsyncioTransport или None, если fd ждет готовности
+        self.channels = {}
+        # fd -> (add_reader, add_writer) этого реактора
+        self.interest = {}
+        # закрытые транспорты, которые еще дописывают буфер
+        self.draining = set()
+        self.woken = False
+        self.events = 0
+        self.busy = 0.0
+        super(AsyncioReactor, self).__init__(map, slow_callback)
+        self.loop.add_reader(self.wakeup_r, self.wakeup)
+        for obj in self.map.values():
+            self.register(obj)
+
+    def register(self, obj):
+        fd = obj._fileno
+        if fd is None or fd in self.channels:
+            return
+        if obj.supports_transport:
+            if not obj.connected:
+                # транспорт создается, когда станет известно, что сокет подключен
+                return
+            channel = obj.transport = AsyncioTransport(self, obj)
+            asyncio.ensure_future(self.loop.create_connection(lambda: channel, sock=obj.socket),
+                                  loop=self.loop)
+        else:
+            channel = None
+        self.channels[fd] = channel
+        self.interest[fd] = (False, False)
+        self.update(obj)
+
+    def modify(self, obj):
+        fd = obj._fileno
+        if fd is None:
+            return
+        if fd not in self.channels:
+            self.register(obj)
+            return
+        self.update(obj)
 
+    def update(self, obj):
+        fd = obj._fileno
+        channel = self.channels[fd]
+        if channel is None:
+            reading = obj.readable()
+            # accepting sockets should not be writable
+            writing = obj.writable() and not obj.accepting
+        else:
+            # читает транспорт; событие записи нужно, когда его буфер пуст,
+            # и тогда у fd нет своего add_writer транспорта
+            channel.set_reading(obj.readable())
+            reading = False
+            writing = obj.writable() and channel.drained()
+        was_reading, was_writing = self.interest[fd]
+        if reading != was_reading:
+            if reading:
+                self.loop.add_reader(fd, self.ready, obj, select.POLLIN)
+            else:
+                self.loop.remove_reader(fd)
+        if writing != was_writing:
+            if writing:
+                self.loop.add_writer(fd, self.ready, obj, select.POLLOUT)
+            else:
+                self.loop.remove_writer(fd)
+        self.interest[fd] = (reading, writing)
+
+    def unregister(self, fd):
+        if self.channels.pop(fd, None) is None and fd not in self.interest:
+            return
+        reading, writing = self.interest.pop(fd)
+        if reading:
+            self.loop.remove_reader(fd)
+        if writing:
+            self.loop.remove_writer(fd)
+
+    def ready(self, obj, flags):
+        """Событие fd или транспорта: обработчик, затем его новый интерес"""
+        fd = obj._fileno
+        if fd is None:
+            return
+        if flags & select.POLLOUT and self.channels.get(fd) is not None:
+            # add_writer поверх транспорта разовый: запись в обработчике
+            # может зарегистрировать на fd add_writer самого транспорта
+            self.loop.remove_writer(fd)
+            self.interest[fd] = (False, False)
+        started = time.time()
+        self.dispatcher()(obj, flags)
+        self.busy += time.time() - started
+        self.events += 1
+        if obj._fileno == fd:
+            self.modify(obj)
+        self.wake()
+
+    def wakeup(self):
+        self.drain_wakeup()
+        self.wake()
+
+    def wake(self):
+        """poll возвращается после текущей итерации цикла asyncio"""
+        if not self.woken:
+            self.woken = True
+            self.loop.stop()
+
+    def run(self, timeout):
+        self.woken = False
+        timer = self.loop.call_later(timeout, self.wake)
+        try:
+            self.loop.run_forever()
+        finally:
+            timer.cancel()
+
+    def poll(self, timeout=0.0):
+        _stopping = False
+        map = self.map
+        if not map:
+            return
+        if _stop_requested and not self.stopped:
+            timeout = 0
+        self.events = 0
+        self.busy = 0.0
+        try:
+            self.run(timeout)
+        except KeyboardInterrupt:
+            _stopping = True
+
+        started = time.time()
+        if _stop_requested and not self.stopped:
+            self.stopped = _stopping = True
+        if _stopping:
+            self.stop_channels()
 
-def loop(timeout=30.0, map=None, count=None):
+        if len(map) == 1 and (not self.events or self.stopped):
+            # остался один слушающий сокет - при остановке закрываем и его
+            obj = map.values()[0]
+            closing(obj)
+        self.finish_dispatch(started - self.busy, self.events)
+
+    def close(self):
+        # закрытые соединения дописывают то, что уже отдано транспорту
+        deadline = time.time() + AsyncioTransport.drain_timeout
+        while self.draining and time.time() < deadline:
+            self.run(0.1)
+        for fd, channel in self.channels.items():
+            if channel is not None:
+                # обработчик пережил цикл (loop с count): дальше - сам сокет
+                channel.obj.transport = None
+            self.unregister(fd)
+        self.loop.remove_reader(self.wakeup_r)
+        self.loop.close()
+        super(AsyncioReactor, self).close()
+
+
+ENGINES = {'select': SelectReactor}
+if hasattr(select, 'epoll'):
+    ENGINES['epoll'] = EpollReactor
+if asyncio is not None:
+    ENGINES['asyncio'] = AsyncioReactor
+DEFAULT_ENGINE = 'epoll' if 'epoll' in ENGINES else 'select'
+
+
+_reactors = {}
+
+
+def get_reactor(map=None):
     if map is None:
         map = socket_map
+    return _reactors.get(id(map))
 
-    if hasattr(select, 'epoll'):
-        poller = epoll_poller
-    else:
-        poller = select_poller
 
-    if count is None:
-        while map:
-            poller(timeout, map)
+class TimerWheel(object):
+    """Хешированное колесо таймеров.
+
+    Объект с дедлайном лежит в ячейке тика, на котором срок истекает;
+    постановка, отмена и перенос срока - операции над set, O(1).
+    Сроки дальше одного оборота колеса остаются в ячейке до своего круга.
+    """
+
+    def __init__(self, tick=0.1, size=512):
+        self.tick = tick
+        self.size = size
+        self.slots = [set() for _ in range(size)]
+        # последний обработанный тик
+        self.current = int(time.time() / tick)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, obj, deadline):
+        """Ставит (или переносит) срок объекта; deadline=None - отмена"""
+        self.cancel(obj)
+        if deadline is None:
+            return
+        tick = max(int(math.ceil(deadline / self.tick)), self.current + 1)
+        slot = tick % self.size
+        self.slots[slot].add(obj)
+        obj._deadline = deadline
+        obj._timer_slot = slot
+        self.count += 1
+
+    def cancel(self, obj):
+        slot = obj._timer_slot
+        if slot is not None:
+            self.slots[slot].discard(obj)
+            obj._deadline = obj._timer_slot = None
+            self.count -= 1
+
+    def expired(self, now):
+        """Снимает с колеса и возвращает объекты со сроком не позже now"""
+        target = int(now / self.tick)
+        fired = []
+        if self.count:
+            steps = min(target - self.current, self.size)
+            for tick in range(self.current + 1, self.current + 1 + steps):
+                slot = self.slots[tick % self.size]
+                if not slot:
+                    continue
+                for obj in [obj for obj in slot if obj._deadline <= now]:
+                    self.cancel(obj)
+                    fired.append(obj)
+        self.current = max(self.current, target)
+        return fired
+
+    def timeout(self, now, limit):
+        """Сколько можно ждать событий до ближайшего срока, не больше limit"""
+        if not self.count:
+            return limit
+        horizon = min(int(limit / self.tick) + 1, self.size)
+        for tick in range(self.current + 1, self.current + 1 + horizon):
+            if self.slots[tick % self.size]:
+                return max(min(tick * self.tick - now, limit), 0.0)
+        return limit
+
+
+_wheels = {}
+
+
+def get_wheel(map=None):
+    """Колесо таймеров каналов map, создается при первом обращении"""
+    if map is None:
+        map = socket_map
+    wheel = _wheels.get(id(map))
+    if wheel is None:
+        wheel = _wheels[id(map)] = TimerWheel()
+    return wheel
+
+
+def check_timeouts(wheel, now):
+    for obj in wheel.expired(now):
+        if obj._fileno is not None:
+            obj.handle_timeout_event(now)
+
+
+def loop(timeout=30.0, map=None, count=None, edge_triggered=False,
+         observer=None, slow_callback=None, stop_signals=(), engine=DEFAULT_ENGINE):
+    """Ожидание событий не дольше timeout и не дольше ближайшего
+    срока в колесе таймеров.
+
+    engine - имя реактора из ENGINES; edge_triggered - только для epoll.
 
+    observer(seconds) вызывается после каждой итерации реактора
+    со временем, ушедшим на обработку событий.
+
+    slow_callback - порог в секундах: обработчики событий, итерации реактора
+    и обработка таймеров дольше него пишутся в лог.
+
+    stop_signals - сигналы плавной остановки: слушающий сокет перестает
+    принимать соединения, начатые ответы дописываются,
+    простаивающие соединения закрываются, и цикл завершается.
+    """
+    if map is None:
+        map = socket_map
+
+    if engine not in ENGINES:
+        raise ValueError('unknown engine {!r}, expected one of: {}'.format(
+            engine, ', '.join(sorted(ENGINES))))
+    if engine == 'epoll':
+        reactor = EpollReactor(map, edge_triggered, slow_callback)
     else:
-        while map and count > 0:
-            poller(timeout, map)
-            count = count - 1
+        reactor = ENGINES[engine](map, slow_callback)
+
+    previous = {}
+    for signum in stop_signals:
+        previous[signum] = signal.signal(signum, request_stop)
+        # без SA_RESTART сигнал прерывает ожидание реактора, но не send/recv
+        signal.siginterrupt(signum, False)
+    if stop_signals:
+        previous_wakeup_fd = signal.set_wakeup_fd(reactor.wakeup_w)
+
+    wheel = get_wheel(map)
+    try:
+        while map and (count is None or count > 0):
+            reactor.poll(wheel.timeout(time.time(), timeout))
+            if observer is not None:
+                observer(reactor.dispatch_time)
+            now = time.time()
+            check_timeouts(wheel, now)
+            if slow_callback is not None:
+                elapsed = time.time() - now
+                if elapsed >= slow_callback:
+                    logging.warning('{}: slow timers {:.1f} ms, {:d} pending'.format(
+                        multiprocessing.current_process().name, elapsed * 1000, len(wheel)))
+            if count is not None:
+                count = count - 1
+    finally:
+        if stop_signals:
+            signal.set_wakeup_fd(previous_wakeup_fd)
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+        reactor.close()
 
 
 class BaseStreamHandler(object):
+    """Сокет и буферы соединения в цикле событий.
+
+    Реактор видит обработчик только через readable()/writable()
+    и handle_*_event. Логика наследников читает и пишет только через
+    read, write/flush, sendfile, close и abort: сами они работают с сокетом,
+    а при supports_transport реактор может подставить transport
+    (AsyncioTransport), и тогда байты идут через него.
+    """
 
     connected = False
     accepting = False
     connecting = False
     closing = False
+    # срок в колесе таймеров, см. set_deadline
+    _deadline = None
+    _timer_slot = None
     refusing = False
+    exclusive = False
     addr = None
+    accept_failures = 0
+    # предел recv_buffer, после которого сокет перестает читаться
+    recv_buffer_limit = None
+    # обработчик может работать поверх транспорта, см. AsyncioTransport
+    supports_transport = False
+    transport = None
 
     def __init__(self, sock=None, map=None):
-        self.send_buffer = ''
+        self.send_buffer = OutputQueue()
         self.recv_buffer = ''
         self.buf_bytes = 0
+        self.bytes_sent = 0
         if map is None:
             self._map = socket_map
         else:
@@ -235,6 +989,9 @@ class BaseStreamHandler(object):
                 else:
                     self.del_channel(map)
                     raise
+            # сокет регистрируется в реакторе до того,
+            # как стало известно, подключен ли он
+            self.update_interest()
         else:
             self.socket = None
 
@@ -257,15 +1014,35 @@ class BaseStreamHandler(object):
         if map is None:
             map = self._map
         map[self._fileno] = self
+        reactor = get_reactor(map)
+        if reactor is not None:
+            reactor.register(self)
 
     def del_channel(self, map=None):
         fd = self._fileno
         if map is None:
             map = self._map
+        get_wheel(map).cancel(self)
         if fd in map:
             del map[fd]
+        reactor = get_reactor(map)
+        if reactor is not None:
+            reactor.unregister(fd)
         self._fileno = None
 
+    def set_deadline(self, deadline):
+        """handle_timeout_event будет вызван в момент deadline (по time.time());
+        новый срок заменяет прежний, None - отменить"""
+        if self._fileno is None:
+            deadline = None
+        get_wheel(self._map).schedule(self, deadline)
+
+    def update_interest(self):
+        """Сообщает реактору, что readable()/writable() могли измениться"""
+        reactor = get_reactor(self._map)
+        if reactor is not None:
+            reactor.modify(self)
+
     def create_socket(self, family, type):
         self.family_and_type = family, type
         sock = socket.socket(family, type)
@@ -287,11 +1064,18 @@ class BaseStreamHandler(object):
         except socket.error:
             pass
 
+    def set_reuse_port(self):
+        # несколько сокетов на одном порту, ядро распределяет
+        # между ними входящие соединения
+        self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+
     def readable(self):
+        if self.recv_buffer_limit is not None and len(self.recv_buffer) >= self.recv_buffer_limit:
+            return False
         return not self.refusing
 
     def writable(self):
-        return (not self.connected) or len(self.send_buffer)
+        return (not self.connected) or bool(self.send_buffer)
 
     def listen(self, num):
         self.accepting = True
@@ -309,7 +1093,10 @@ class BaseStreamHandler(object):
         except TypeError:
             return None
         except socket.error as err:
-            if err.args[0] in (EWOULDBLOCK, ECONNABORTED, EAGAIN):
+            if err.args[0] in (EWOULDBLOCK, EAGAIN):
+                return None
+            elif err.args[0] in ACCEPT_FAILURES:
+                self.accept_failures += 1
                 return None
             else:
                 raise
@@ -335,6 +1122,27 @@ class BaseStreamHandler(object):
                 raise
         return result
 
+    def sendfile(self, fileobj, offset, count):
+        """Отправка части файла ядром, минуя буферы python. Поверх
+        транспорта - тоже в сокет, когда буфер транспорта пуст"""
+        if self.transport is not None and not self.transport.drained():
+            return 0
+        try:
+            sent = _sendfile(self._fileno, fileobj.fileno(), offset, count)
+        except OSError as err:
+            if err.args[0] in (EWOULDBLOCK, EAGAIN):
+                return 0
+            elif err.args[0] in DISCONNECTED:
+                self.handle_close()
+                return 0
+            else:
+                raise
+        if not sent and count:
+            # файл укоротился - обещанную длину ответа уже не отдать
+            self.handle_close()
+        self.bytes_sent += sent
+        return sent
+
     def recv(self, buffer_size):
         try:
             return self.socket.recv(buffer_size)
@@ -350,6 +1158,18 @@ class BaseStreamHandler(object):
             else:
                 raise
 
+    def recv_into(self, buffer, nbytes=0):
+        try:
+            return self.socket.recv_into(buffer, nbytes)
+        except socket.error as err:
+            if err.args[0] in DISCONNECTED:
+                self.handle_close()
+                return 0
+            elif err.args[0] in (EWOULDBLOCK, EAGAIN):
+                return 0
+            else:
+                raise
+
     def sendall(self, data):
         while data:
             self.buf_bytes = self.send(data)
@@ -360,23 +1180,51 @@ class BaseStreamHandler(object):
         if self.closing:
             self.send('')
 
-    def write(self, part='', buffered=True, send_size=2048):
+    def sendmsg(self, buffers):
+        result = 0
+        try:
+            result = self.socket.sendmsg(buffers)
+        except socket.error as err:
+            if err.args[0] in DISCONNECTED:
+                self.handle_close()
+            elif err.args[0] not in (EWOULDBLOCK, EAGAIN):
+                raise
+        return result
+
+    def write(self, part='', buffered=True):
         if part:
-            self.send_buffer += part
+            was_empty = not self.send_buffer
+            self.send_buffer.append(part)
+            if was_empty:
+                self.update_interest()
         if not buffered:
-            # в случае когда нужно отправлять chunk-ми,
-            # очищаем не весь буфер для того,
-            # чтобы оставаться writeable
-            if self.send_buffer:
-                data = self.send_buffer[:send_size]
-                self.send_buffer = self.send_buffer[send_size:]
-                self.sendall(data)
+            self.flush()
+
+    def flush(self):
+        """Отправка из send_buffer, сколько примет сокет; остаток
+        дождется следующего события записи"""
+        if not self.send_buffer:
+            return 0
+        if self.transport is not None:
+            sent = self.transport.write(self.send_buffer.views())
+        elif HAVE_SENDMSG:
+            sent = self.sendmsg(self.send_buffer.views())
+        else:
+            sent = self.send(self.send_buffer.peek())
+        if sent:
+            self.send_buffer.consume(sent)
+            self.bytes_sent += sent
+        return sent
 
     def read(self):
-        while True:
-            part = self.recv(1024)
-            if part:
-                self.recv_buffer += part
+        if self.transport is not None:
+            self.recv_buffer += self.transport.read()
+            return self.recv_buffer
+        limit = self.recv_buffer_limit
+        while limit is None or len(self.recv_buffer) < limit:
+            received = self.recv_into(_recv_area)
+            if received:
+                self.recv_buffer += _recv_area[:received].tobytes()
             else:
                 break
         return self.recv_buffer
@@ -386,12 +1234,24 @@ class BaseStreamHandler(object):
         self.accepting = False
         self.connecting = False
         self.del_channel()
+        if self.transport is not None:
+            # сокет закроет транспорт, дописав свой буфер
+            self.transport.close()
+            return
         try:
             self.socket.close()
         except socket.error as err:
             if err.args[0] not in (ENOTCONN, EBADF):
                 raise
 
+    def abort(self):
+        """Закрытие с RST: неотправленное отбрасывается, в том числе
+        из буфера сокета в ядре"""
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        if self.transport is not None:
+            self.transport.abort()
+        self.handle_close()
+
     def set_refusing(self):
         # сервер останавливается, поэтому
         # входящие соединения не принимаем
@@ -419,8 +1279,10 @@ class BaseStreamHandler(object):
             return
 
         if not self.connected:
-            if self.connecting:
-                self.handle_connect_event()
+            if not self.connecting:
+                # соединение закрыто обработчиком чтения той же итерации
+                return
+            self.handle_connect_event()
         self.handle_write()
 
     def handle_connect_event(self):
@@ -459,6 +1321,9 @@ class BaseStreamHandler(object):
                 multiprocessing.current_process().name)
             )
 
+    def handle_timeout_event(self, now):
+        pass
+
     def handle_error(self):
         self.handle_close()
 
@@ -479,3 +1344,133 @@ class BaseStreamHandler(object):
 
     def handle_close(self):
         self.close()
+
+
+class Waker(BaseStreamHandler):
+    """Конец self-pipe в реакторе: поток пишет байт, цикл событий
+    просыпается и забирает готовые результаты пула"""
+
+    def __init__(self, pool, map=None):
+        super(Waker, self).__init__(map=map)
+        self.pool = pool
+        self.signalled = False
+        self.stopping = False
+        self.rfd, self.wfd = os.pipe()
+        for fd in (self.rfd, self.wfd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._fileno = self.rfd
+        self.add_channel()
+
+    def __repr__(self):
+        return '<Waker fd {} at {:#x}>'.format(self.rfd, id(self))
+
+    def wake(self):
+        """Вызывается из потоков пула"""
+        if not self.signalled:
+            self.signalled = True
+            try:
+                os.write(self.wfd, 'x')
+            except OSError as err:
+                # канал полон - цикл и так проснется
+                if err.args[0] not in (EWOULDBLOCK, EAGAIN):
+                    raise
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            while os.read(self.rfd, 4096):
+                pass
+        except OSError as err:
+            if err.args[0] not in (EWOULDBLOCK, EAGAIN):
+                raise
+        # флаг сбрасывается после опустошения канала, но до разбора очереди:
+        # результат, добавленный позже, снова запишет байт и разбудит цикл
+        self.signalled = False
+        self.pool.complete()
+        if self.stopping and not self.pool.pending:
+            self.handle_close()
+
+    def handle_stop_event(self):
+        # сервер останавливается: ждем начатые задания и уходим из map,
+        # чтобы не мешать остановке слушающего сокета
+        self.stopping = True
+        if not self.pool.pending:
+            self.handle_close()
+
+    def close(self):
+        if self._fileno is not None:
+            self.del_channel()
+            os.close(self.rfd)
+            os.close(self.wfd)
+            self.pool.shutdown()
+
+
+class ThreadPool(object):
+    """Потоки worker'а для блокирующих вызовов: stat, open, read.
+
+    GIL отпускается на время системного вызова, поэтому медленный диск
+    задерживает только ждущее его соединение, а не весь цикл событий.
+    callback(result, error) вызывается в цикле событий.
+    """
+
+    def __init__(self, size=4, queue_depth=64, map=None):
+        self.jobs = Queue.Queue(queue_depth)
+        self.done = deque()
+        self.pending = 0
+        self.closed = False
+        self.waker = Waker(self, map)
+        self.threads = []
+        for i in range(size):
+            thread = threading.Thread(target=self.work, name='pool{:d}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, func, args, callback):
+        """False - очередь полна или пул остановлен, вызов нужно сделать на месте"""
+        if self.closed:
+            return False
+        try:
+            self.jobs.put_nowait((func, args, callback))
+        except Queue.Full:
+            return False
+        self.pending += 1
+        return True
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            func, args, callback = job
+            result = error = None
+            try:
+                result = func(*args)
+            except Exception as err:
+                error = err
+            self.done.append((callback, result, error))
+            self.waker.wake()
+
+    def complete(self):
+        while self.done:
+            callback, result, error = self.done.popleft()
+            self.pending -= 1
+            try:
+                callback(result, error)
+            except _reraised_exceptions:
+                raise
+            except:
+                owner = getattr(callback, '__self__', None)
+                if owner is None:
+                    # остальные задания и сам пул ошибка не касается
+                    logging.exception('{}: thread pool callback {!r} failed'.format(
+                        multiprocessing.current_process().name, callback))
+                    continue
+                owner.handle_error()
+
+    def shutdown(self):
+        self.closed = True
+        for _ in self.threads:
+            self.jobs.put(None)
@@ -23,6 +23,114 @@ DEFAULT_ERROR_MESSAGE = """<html>
 
 DEFAULT_ERROR_CONTENT_TYPE = "text/html"
 
+START_LINE, HEADERS, DONE = range(3)
+
+_date_cache = [None, '']
+
+
+def http_date():
+    """Текущая дата для заголовка Date, форматируется не чаще раза в секунду"""
+    now = int(time.time())
+    if now != _date_cache[0]:
+        _date_cache[0] = now
+        _date_cache[1] = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(now))
+    return _date_cache[1]
+
+
+def parse_byte_ranges(header, size):
+    """Диапазоны [(начало, конец), ...] из заголовка Range для файла size байт.
+
+    None - заголовок некорректен и должен игнорироваться,
+    пустой список - ни один диапазон не удовлетворим.
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec.strip():
+        return None
+    ranges = []
+    for item in spec.split(','):
+        first, sep, last = item.strip().partition('-')
+        first, last = first.strip(), last.strip()
+        # только цифры: int() пропустил бы знак, '--5' не диапазон
+        if not sep or not (first or last) or not (first or '0').isdigit() or \
+                not (last or '0').isdigit():
+            return None
+        if not first:
+            # последние last байт
+            suffix = int(last)
+            if suffix <= 0:
+                continue
+            start, end = max(size - suffix, 0), size
+        else:
+            start = int(first)
+            end = int(last) + 1 if last else None
+        if end is not None and end <= start:
+            return None
+        if start >= size:
+            continue
+        if end is None:
+            end = size
+        ranges.append((start, min(end, size)))
+    return ranges
+
+
+class RequestParser(object):
+    """Инкрементальный разбор заголовков запроса.
+
+    Строки разбираются по мере поступления, каждая - один раз;
+    размер заголовков и их число ограничены.
+    """
+
+    def __init__(self, max_header_size=8192, max_headers=100):
+        self.max_header_size = max_header_size
+        self.max_headers = max_headers
+        self.reset()
+
+    def reset(self):
+        self.state = START_LINE
+        self.startline = None
+        self.headers = {}
+        self.header_count = 0
+        self.size = 0
+        self.error = None
+
+    def feed(self, data):
+        """Разбирает полные строки из data, возвращает число использованных байт"""
+        pos = 0
+        while self.state != DONE:
+            end = data.find('\n', pos)
+            if end < 0:
+                if self.size + len(data) - pos > self.max_header_size:
+                    self.fail()
+                return pos
+            line = data[pos:end].rstrip('\r')
+            self.size += end + 1 - pos
+            pos = end + 1
+            if self.size > self.max_header_size:
+                self.fail()
+                return pos
+            if self.state == START_LINE:
+                # пустые строки перед запросом допускаются RFC 7230
+                if not line:
+                    self.size = 0
+                    continue
+                self.startline = line
+                # у запроса HTTP/0.9 заголовков нет
+                self.state = DONE if len(line.split()) == 2 else HEADERS
+            elif not line:
+                self.state = DONE
+            elif ':' in line:
+                self.header_count += 1
+                if self.header_count > self.max_headers:
+                    self.fail()
+                    return pos
+                keyword, value = line.split(':', 1)
+                self.headers[keyword.strip().lower()] = value.strip()
+        return pos
+
+    def fail(self):
+        self.error = 414 if self.state == START_LINE else 431
+        self.state = DONE
+
 
 class BaseHTTPRequestHandler(async_handlers.BaseStreamHandler):
 
@@ -32,58 +140,187 @@ class BaseHTTPRequestHandler(async_handlers.BaseStreamHandler):
     server_version = "SimpleHTTP/" + __version__
     responses = {
         200: ('OK', 'Request fulfilled, document follows'),
+        206: ('Partial Content', 'Partial content follows'),
+        304: ('Not Modified',
+              'Document has not changed since given time'),
         400: ('Bad Request',
               'Bad request syntax or unsupported method'),
         404: ('Not Found', 'Nothing matches the given URI'),
+        414: ('Request-URI Too Long', 'URI is too long.'),
+        416: ('Requested Range Not Satisfiable',
+              'Cannot satisfy request range.'),
+        431: ('Request Header Fields Too Large',
+              'The server is unwilling to process the request because '
+              'its header fields are too large.'),
         403: ('Forbidden',
               'Request forbidden -- authorization will not help'),
         405: ('Method Not Allowed',
               'Specified method is invalid for this resource.'),
         500: ('Internal Server Error', 'Server got itself in trouble'),
+        503: ('Service Unavailable',
+              'The server cannot process the request due to a high load'),
         505: ('HTTP Version Not Supported', 'Cannot fulfill request.')
     }
+    # заготовки заголовков по (статус, Content-Type), заполняются по мере ответов
+    header_templates = {}
+    # писать ли каждый ответ 4xx/5xx в журнал ошибок
+    log_errors = True
+
+    # сколько секунд держать простаивающее keep-alive соединение
+    keep_alive_timeout = 15
+    # за сколько секунд от первого байта запроса должны прийти все заголовки
+    header_timeout = 10
+    # ответ отдается окнами по send_timeout секунд: за окно клиент должен
+    # забрать хотя бы min_send_rate байт в секунду (и хотя бы байт)
+    send_timeout = 10
+    min_send_rate = 1024
+    # сколько запросов обслужить в одном соединении
+    max_keep_alive_requests = 100
+    # ограничения на заголовки запроса
+    max_header_size = 8192
+    max_headers = 100
+    # HTTP-логика работает и поверх транспорта asyncio
+    supports_transport = True
+    # сколько непрочитанных (в т.ч. pipelined) байт держать в recv_buffer
+    recv_buffer_limit = 64 * 1024
+    # тело запроса статике не нужно: до max_body_size байт его пропускаем,
+    # чтобы найти следующий запрос, с большим телом соединение закрываем
+    max_body_size = 64 * 1024
 
     def __init__(self, sock=None, map=None):
+        # состояние запроса нужно до регистрации сокета в реакторе,
+        # который сразу спрашивает readable()/writable()
+        self.chunk_size = 2048
+        self.requests_served = 0
+        self.last_activity = time.time()
+        self.parser = RequestParser(self.max_header_size, self.max_headers)
+        # стартовая строка последнего запроса, переживает reset_request
+        self.requestline = None
+        # worker останавливается: после текущего ответа соединение закрываем
+        self.stopping = False
+        # сколько байт тела последнего запроса еще пропустить в recv_buffer
+        self.body_remaining = 0
+        self.reset_request()
         super(BaseHTTPRequestHandler, self).__init__(sock, map)
-        self.rawrequest = ''
+        if self.connected:
+            # первого запроса ждем как заголовков: соединение уже открыто
+            self.reading_since = self.last_activity
+            self.set_deadline(self.reading_since + self.header_timeout)
+
+    def __repr__(self):
+        base = super(BaseHTTPRequestHandler, self).__repr__()
+        if self.requestline is None:
+            return base
+        return '{} "{}"'.format(base, self.requestline)
+
+    __str__ = __repr__
+
+    def reset_request(self):
+        """Сброс состояния перед следующим запросом в том же соединении"""
+        self.command = None
+        self.path = ''
+        self.request_version = self.default_request_version
+        self.headers = {}
         self.content_type = ''
         self.content = ''
         self.content_length = 0
-        self.chunked = False
-        self.chunk_size = 2048
+        # готовые Content-Type/Content-Length и тело из кэша
+        self.entity_headers = ''
+        # дополнительные заголовки ответа, см. send_header
+        self.response_headers = []
+        self.body = ''
         self.resource = False
+        self.responding = False
+        self.close_connection = True
+        # код отправленного ответа и момент, когда запрос пришел целиком
+        self.status = None
+        self.request_started = None
+        # с какого момента читаются заголовки очередного запроса
+        self.reading_since = None
+        # отправлено байт и время на начало текущего окна отдачи ответа
+        self.send_mark = 0
+        self.send_mark_time = None
+        # bytes_sent к началу ответа
+        self.response_offset = 0
+
+    def writable(self):
+        # пока файл не дочитан, остаемся writeable даже с пустым буфером
+        return self.resource or super(BaseHTTPRequestHandler, self).writable()
 
     def send_headers(self, code):
-        self.send_header('Server', self.version_string())
-        self.send_header('Date', self.date_time_string())
-        if self.chunked:
-            self.send_header("Transfer-Encoding", 'chunked')
-        if code != 200:
-            self.send_error(code)
-        if self.content_type:
-            self.send_header("Content-Type", self.content_type)
-            self.send_header('Content-Length', self.content_length)
+        """Все заголовки ответа одной строкой"""
+        if self.request_version == 'HTTP/0.9':
+            return
+        if self.entity_headers:
+            # Content-Type и Content-Length уже собраны кэшем
+            parts = [self.header_template(code, ''), 'Date: ',
+                     self.date_time_string(), '\r\n', self.entity_headers]
+        elif self.content_type:
+            parts = [self.header_template(code, self.content_type), 'Date: ',
+                     self.date_time_string(), '\r\nContent-Length: ',
+                     str(self.content_length), '\r\n']
+        else:
+            parts = [self.header_template(code, ''), 'Date: ',
+                     self.date_time_string(), '\r\n']
+        parts.extend(self.response_headers)
+        if self.close_connection:
+            parts.append('Connection: close\r\n\r\n')
+        else:
+            parts.append('Connection: keep-alive\r\n\r\n')
+        self.write(''.join(parts))
+
+    def header_template(self, code, content_type):
+        """Неизменная часть заголовков для пары (статус, Content-Type)"""
+        if content_type.startswith('multipart/'):
+            # boundary у каждого ответа свой: такая заготовка не повторится
+            return self.header_template(code, '') + "Content-Type: {}\r\n".format(content_type)
+        key = code, content_type
+        template = self.header_templates.get(key)
+        if template is None:
+            if code in self.responses:
+                message = self.responses[code][0]
+            else:
+                message = ''
+            template = "{} {:d} {}\r\nServer: {}\r\n".format(
+                self.protocol_version, code, message, self.version_string())
+            if content_type:
+                template += "Content-Type: {}\r\n".format(content_type)
+            self.header_templates[key] = template
+        return template
 
     def send_response(self, code):
-        self.send_status_code(code)
+        self.begin_response()
+        self.status = code
+        if code >= 400:
+            self.send_error(code)
         self.send_headers(code)
-        self.end_headers()
-        if code != 200:
+        if code >= 400:
             self.send_error_body()
+        elif self.body and self.command != 'HEAD' and code != 304:
+            self.write(self.body)
+
+    def begin_response(self):
+        """Соединение занято ответом: pipelined запросы ждут,
+        вместо простоя считается скорость отдачи"""
+        self.responding = True
+        self.send_mark = self.response_offset = self.bytes_sent
+        self.send_mark_time = time.time()
+        self.set_deadline(self.send_mark_time + self.send_timeout)
 
     def send_error_body(self):
         if self.command != 'HEAD':
-            self.write(self.content, buffered=False,
-                       send_size=self.chunk_size)
+            self.write(self.content)
 
     def send_error(self, code):
         try:
             short, long = self.responses[code]
         except KeyError:
             short, long = '???', '???'
-        logging.error("{} - {} {} - Status code: {:d} {}".format(
-            self.addr[0], self.command, self.path, code, short)
-        )
+        if self.log_errors:
+            logging.error("{} - {} {} - Status code: {:d} {}".format(
+                self.addr[0], self.command, self.path, code, short)
+            )
+        self.entity_headers = ''
         if self.command != 'HEAD':
             self.content = DEFAULT_ERROR_MESSAGE.format(
                 code=code, message=short, explain=long
@@ -91,25 +328,25 @@ class BaseHTTPRequestHandler(async_handlers.BaseStreamHandler):
             self.content_type = DEFAULT_ERROR_CONTENT_TYPE
             self.content_length = len(self.content)
 
-    def send_status_code(self, code):
-        if code in self.responses:
-            message = self.responses[code][0]
-        else:
-            message = ''
-        if self.request_version != 'HTTP/0.9':
-            self.write("{} {:d} {}\r\n".format(
-                self.protocol_version, code, message)
-            )
+    @classmethod
+    def serialize_error(cls, code, date, headers=()):
+        """Ответ целиком, с закрытием соединения - для отказа
+        без разбора запроса, например при перегрузке"""
+        short, long = cls.responses[code]
+        content = DEFAULT_ERROR_MESSAGE.format(code=code, message=short, explain=long)
+        extra = ''.join("{}: {}\r\n".format(keyword, value) for keyword, value in headers)
+        return ''.join(("{} {:d} {}\r\n".format(cls.protocol_version, code, short),
+                        "Server: {} {}\r\n".format(cls.server_version, cls.sys_version),
+                        "Date: {}\r\n".format(date),
+                        "Content-Type: {}\r\n".format(DEFAULT_ERROR_CONTENT_TYPE),
+                        "Content-Length: {:d}\r\n".format(len(content)),
+                        extra,
+                        "Connection: close\r\n\r\n",
+                        content))
 
     def send_header(self, keyword, value):
-        """Send a MIME header."""
-        if self.request_version != 'HTTP/0.9':
-            self.write("{}: {}\r\n".format(keyword, value))
-
-    def end_headers(self):
-        """Send the blank line ending the MIME headers."""
-        if self.request_version != 'HTTP/0.9':
-            self.write("\r\n")
+        """Add a MIME header to the response being prepared."""
+        self.response_headers.append("{}: {}\r\n".format(keyword, value))
 
     def version_string(self):
         """Return the server software version string."""
@@ -117,74 +354,160 @@ class BaseHTTPRequestHandler(async_handlers.BaseStreamHandler):
 
     def date_time_string(self, timestamp=None):
         """Return the current date and time formatted for a message header."""
+        if timestamp is None:
+            return http_date()
         return time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(timestamp))
 
     def handle_read(self):
         """Обработчик события чтения"""
-        self.rawrequest = self.read()
-        if self.rawrequest:
+        received = len(self.recv_buffer)
+        self.read()
+        if len(self.recv_buffer) == received:
+            # событие чтения без данных - клиент закрыл соединение
+            self.handle_close()
+            return
+        self.last_activity = time.time()
+        self.process_requests()
+
+    def process_requests(self):
+        """Обработка накопленных в recv_buffer запросов по порядку (pipelining)"""
+        while self.connected and not self.responding and self.recv_buffer:
+            if self.body_remaining:
+                skipped = min(self.body_remaining, len(self.recv_buffer))
+                self.recv_buffer = self.recv_buffer[skipped:]
+                self.body_remaining -= skipped
+                continue
+            used = self.parser.feed(self.recv_buffer)
+            self.recv_buffer = self.recv_buffer[used:]
+            self.request_started = self.last_activity
+            self.requestline = self.parser.startline
+            if self.parser.error:
+                # версия клиента неизвестна, отвечаем полноценным статусом
+                self.request_version = self.protocol_version
+                self.close_connection = True
+                self.send_response(self.parser.error)
+                break
+            if self.parser.state != DONE:
+                # заголовки пришли не полностью, ждем продолжения
+                break
             self.handle_request()
+            self.parser.reset()
+        if self.connected and not self.responding:
+            self.set_read_deadline()
+
+    def set_read_deadline(self):
+        """Срок для ожидающего запроса соединения: заголовки начатого запроса
+        должны прийти за header_timeout с первого байта (медленная досылка
+        срок не продлевает), простой между запросами - keep_alive_timeout"""
+        if self.recv_buffer or self.parser.state != START_LINE or self.body_remaining:
+            if self.reading_since is None:
+                self.reading_since = self.last_activity
+                self.set_deadline(self.reading_since + self.header_timeout)
         else:
-            self.handle_close()
+            self.reading_since = None
+            self.set_deadline(self.last_activity + self.keep_alive_timeout)
 
     def handle_request(self):
         """Парсинг и вызов обработчика запроса"""
         if not self.validate_start_line():
             return
+        self.parse_headers()
         name = 'handle_' + self.command.lower()
         if not hasattr(self, name):
+            # тело неизвестного запроса не разбираем, поэтому закрываемся
+            self.close_connection = True
             self.send_response(405)
             return
         method = getattr(self, name)
         method()
 
+    def parse_headers(self):
+        """Выбор режима соединения по заголовкам запроса; тело, которое
+        нельзя пропустить (chunked, слишком длинное), закрывает соединение"""
+        self.headers = self.parser.headers
+        conntype = self.headers.get('connection', '').lower()
+        if conntype == 'close':
+            self.close_connection = True
+        elif conntype == 'keep-alive':
+            self.close_connection = self.request_version == 'HTTP/0.9'
+        else:
+            # HTTP/1.1 по умолчанию держит соединение, HTTP/1.0 - нет
+            self.close_connection = self.request_version in ('HTTP/0.9', 'HTTP/1.0')
+        if self.stopping or self.requests_served + 1 >= self.max_keep_alive_requests:
+            self.close_connection = True
+        # иначе байты тела будут разобраны как следующий запрос
+        length = self.headers.get('content-length')
+        if 'transfer-encoding' in self.headers:
+            self.close_connection = True
+        elif length is not None:
+            if length.isdigit() and int(length) <= self.max_body_size:
+                self.body_remaining = int(length)
+            else:
+                self.close_connection = True
+
     def handle_write(self):
         """Обработчик события записи"""
-        if self.resource:
-            if self.chunked:
-                # большой файл отдаем chunk-ми
-                # в буфере всегда остается какая-то часть от
-                # предыдущей итерации, чтобы оставаться writeable
-                buffering = False
-            else:
-                # все прочитанное из файла складываем в буфер и выходим из обработчика
-                # при следующем возникновении события на запись, отправляем
-                buffering = True
-            looping = True
-
-            while looping:
-                part = self.read_resourse()
-                _bytes = len(part)
-                if _bytes < self.chunk_size:
-                    # из файла ничего не прочитали
-                    # или же все, что меньше chunk_size
-                    # отправляем последний chunk и надо закрываться
-                    buffering = False
-                    looping = False
-                    self.closing = True
-
-                if self.chunked:
-                    # записываем длину блока
-                    chunk_len = hex(_bytes)
-                    chunk_len = chunk_len.lstrip('0x')
-                    self.write(chunk_len + '\r\n')
-                    looping = False
-                    part += '\r\n'
-
-                self.write(part, buffered=buffering,
-                           send_size=self.chunk_size)
-        else:
-            self.closing = True
-            self.write('', buffered=False,
-                       send_size=self.chunk_size)
-        if self.closing:
+        if self.resource and not self.send_buffer:
+            # заголовки и предыдущая часть ушли, отдаем тело дальше
+            self.send_resource()
+        self.write(buffered=False)
+        if not self.connected:
+            return
+        if not self.send_buffer and not self.resource:
+            self.finish_request()
+
+    def finish_request(self):
+        """Ответ отправлен: закрываем соединение или ждем следующий запрос"""
+        self.requests_served += 1
+        if self.close_connection:
             self.handle_close()
+            return
+        self.reset_request()
+        self.last_activity = time.time()
+        self.process_requests()
+
+    def handle_stop_event(self):
+        """Плавная остановка: начатый ответ (или запрос) доводим до конца
+        и закрываемся, простаивающее соединение закрываем сразу"""
+        self.stopping = True
+        self.close_connection = True
+        if (not self.responding and not self.recv_buffer and not self.body_remaining
+                and self.parser.state == START_LINE):
+            self.handle_close()
+
+    def handle_timeout_event(self, now):
+        """Истек срок из set_deadline"""
+        if self.responding:
+            window = now - self.send_mark_time
+            if self.bytes_sent - self.send_mark >= max(self.min_send_rate * window, 1):
+                # клиент читает достаточно быстро - следующее окно
+                self.send_mark = self.bytes_sent
+                self.send_mark_time = now
+                self.set_deadline(now + self.send_timeout)
+                return
+            logging.info('{} - {} - client reads slower than {:d} B/s, closing'.format(
+                self.addr[0], self.requestline, self.min_send_rate))
+            # RST вместо FIN: ядро не будет дальше отдавать недочитанный буфер
+            self.abort()
+            return
+        # заголовки не пришли за header_timeout или простой дольше keep_alive_timeout
+        self.handle_close()
+
+    def send_resource(self):
+        """Очередная часть тела ответа из файла"""
+        part = self.read_resourse()
+        if part:
+            self.write(part)
+        else:
+            self.resource = False
 
     def read_resourse(self):
         """Чтение из файла"""
         raise NotImplementedError
 
     def handle_error(self):
+        # заголовки несостоявшегося ответа (Content-Encoding и т.п.) не нужны
+        self.response_headers = []
         self.send_response(500)
         super(BaseHTTPRequestHandler, self).handle_error()
 
@@ -194,8 +517,7 @@ class BaseHTTPRequestHandler(async_handlers.BaseStreamHandler):
     def validate_start_line(self):
         self.command = None  # set in case of error on the first line
         self.request_version = version = self.default_request_version
-        self.startline = self.rawrequest.split('\n')[0]
-        self.startline = self.startline.rstrip('\r')
+        self.startline = self.parser.startline
         words = self.startline.split(None, 2)
         if len(words) == 3:
             command, path, version = words
@@ -218,7 +540,7 @@ class BaseHTTPRequestHandler(async_handlers.BaseStreamHandler):
                 self.send_response(400)
                 return False
             if version_number >= (2, 0):
-                self.send_error(505)
+                self.send_response(505)
                 return False
         elif len(words) == 2:
             command, path = words
@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import sys
+import time
+import json
+import errno
+import shutil
+import socket
+import signal
+import tempfile
+import resource
+import subprocess
+import multiprocessing
+from optparse import OptionParser
+
+import async_handlers
+
+HTTPD = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'httpd.py')
+CONTENT_LENGTH = re.compile(r'^content-length:\s*(\d+)', re.I | re.M)
+
+# файлы генерируемого DOCUMENT_ROOT: имя -> размер
+FILES = {'index.html': 1024,
+         'small.css': 4 * 1024,
+         'medium.jpg': 512 * 1024,
+         'large.jpg': 16 * 1024 * 1024}
+
+# name: (метод, путь, keep-alive, медленных клиентов, простаивающих соединений)
+SCENARIOS = [
+    ('keepalive-small', 'GET', '/index.html', True, 0, 0),
+    ('close-small', 'GET', '/index.html', False, 0, 0),
+    ('head-small', 'HEAD', '/index.html', True, 0, 0),
+    ('keepalive-medium', 'GET', '/medium.jpg', True, 0, 0),
+    ('keepalive-large', 'GET', '/large.jpg', True, 0, 0),
+    ('404-storm', 'GET', '/missing-{:d}.html', True, 0, 0),
+    ('slow-clients', 'GET', '/index.html', True, 100, 0),
+    ('idle-connections', 'GET', '/index.html', True, 0, 1000),
+]
+
+_area = memoryview(bytearray(256 * 1024))
+
+
+class Scenario(object):
+
+    def __init__(self, name, method, path, keep_alive, slow, idle):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.keep_alive = keep_alive
+        self.slow = slow
+        self.idle = idle
+        self.counter = 0
+
+    def request(self):
+        self.counter += 1
+        path = self.path.format(self.counter % 100)
+        connection = 'keep-alive' if self.keep_alive else 'close'
+        return '{} {} HTTP/1.1\r\nHost: localhost\r\nConnection: {}\r\n\r\n'.format(
+            self.method, path, connection)
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.running = True
+        self.latencies = []
+        self.statuses = {}
+        self.bytes = 0
+        self.errors = 0
+        self.reconnects = 0
+
+    def record(self, latency, status, size):
+        self.latencies.append(latency)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.bytes += size
+
+    def as_dict(self):
+        return {'latencies': self.latencies, 'statuses': self.statuses,
+                'bytes': self.bytes, 'errors': self.errors,
+                'reconnects': self.reconnects}
+
+
+class Connection(async_handlers.BaseStreamHandler):
+    """Клиентское соединение, которое переподключается после закрытия"""
+
+    def __init__(self, server_addr, scenario, stats, map):
+        super(Connection, self).__init__(map=map)
+        self.server_addr = server_addr
+        self.scenario = scenario
+        self.stats = stats
+        self.connect()
+
+    def connect(self):
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connecting = True
+        err = self.socket.connect_ex(self.server_addr)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error(err, async_handlers._strerror(err))
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        self.write(buffered=False)
+
+    def handle_read(self):
+        received = False
+        while self.connected:
+            size = self.recv_into(_area)
+            if not size:
+                break
+            received = True
+            self.consume(_area[:size])
+        if not received and self.connected:
+            # событие чтения без данных - сервер закрыл соединение
+            self.handle_close()
+
+    def consume(self, data):
+        pass
+
+    def handle_error(self):
+        self.stats.errors += 1
+        self.handle_close()
+
+    def handle_close(self):
+        self.close()
+        self.send_buffer.clear()
+        if self.stats.running:
+            self.stats.reconnects += 1
+            self.connect()
+
+
+class BenchClient(Connection):
+    """Шлет запросы сценария один за другим и меряет время ответа"""
+
+    def handle_connect(self):
+        self.send_request()
+
+    def send_request(self):
+        self.head = ''
+        self.remaining = None
+        self.size = 0
+        self.started = time.time()
+        self.write(self.scenario.request(), buffered=False)
+
+    def consume(self, data):
+        self.size += len(data)
+        if self.remaining is None:
+            self.head += data.tobytes()
+            end = self.head.find('\r\n\r\n')
+            if end < 0:
+                return
+            self.status = int(self.head.split(' ', 2)[1])
+            length = CONTENT_LENGTH.search(self.head[:end])
+            if self.scenario.method == 'HEAD' or self.status == 304 or length is None:
+                length = 0
+            else:
+                length = int(length.group(1))
+            self.remaining = length - (len(self.head) - end - 4)
+        else:
+            self.remaining -= len(data)
+        if self.remaining <= 0:
+            self.stats.record(time.time() - self.started, self.status, self.size)
+            if not self.stats.running:
+                self.close()
+            elif self.scenario.keep_alive:
+                self.send_request()
+            else:
+                self.close()
+                self.connect()
+
+
+class SlowClient(Connection):
+    """Отправляет запрос по байту раз в interval секунд"""
+
+    interval = 0.1
+
+    def handle_connect(self):
+        self.pending = self.scenario.request()
+        self.next_byte = time.time()
+
+    def tick(self, now):
+        if self.connected and self.pending and now >= self.next_byte:
+            self.write(self.pending[0], buffered=False)
+            self.pending = self.pending[1:]
+            self.next_byte = now + self.interval
+
+    def consume(self, data):
+        if '\r\n\r\n' in data.tobytes() and not self.pending:
+            self.handle_connect()
+
+
+class IdleClient(Connection):
+    """Открытое соединение без запросов"""
+
+
+def drive(scenario, server_addr, duration, connections, results):
+    """Один процесс нагрузки: свой реактор и свои соединения"""
+    map = {}
+    reactor = async_handlers.EpollReactor(map)
+    stats = Stats()
+    idle = [IdleClient(server_addr, scenario, stats, map) for _ in range(scenario.idle)]
+    slow = [SlowClient(server_addr, scenario, stats, map) for _ in range(scenario.slow)]
+    for _ in range(connections):
+        BenchClient(server_addr, scenario, stats, map)
+    # простаивающие и медленные соединения в статистику не попадают
+    stats.reconnects = 0
+    now = time.time()
+    deadline = now + duration
+    while now < deadline:
+        reactor.poll(0.01)
+        now = time.time()
+        for client in slow:
+            client.tick(now)
+    stats.running = False
+    for obj in list(map.values()):
+        obj.close()
+    reactor.close()
+    results.put(stats.as_dict())
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def worker_rss(master_pid):
+    """RSS (KiB) дочерних процессов сервера, по /proc"""
+    rss = {}
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/{}/status'.format(pid)) as status_file:
+                status = dict(line.split(':', 1) for line in status_file if ':' in line)
+        except IOError:
+            continue
+        if int(status.get('PPid', 0)) == master_pid and 'VmRSS' in status:
+            rss[int(pid)] = int(status['VmRSS'].split()[0])
+    return rss
+
+
+def run_scenario(scenario, server_addr, duration, connections, processes, server_pid):
+    results = multiprocessing.Queue()
+    per_process = max(connections // processes, 1)
+    clients = [multiprocessing.Process(target=drive,
+                                       args=(scenario, server_addr, duration,
+                                             per_process, results))
+               for _ in range(processes)]
+    started = time.time()
+    for client in clients:
+        client.start()
+    collected = [results.get() for _ in clients]
+    elapsed = time.time() - started
+    for client in clients:
+        client.join()
+
+    latencies = sorted(latency for result in collected for latency in result['latencies'])
+    statuses = {}
+    for result in collected:
+        for status, count in result['statuses'].items():
+            statuses[status] = statuses.get(status, 0) + count
+    ms = lambda value: None if value is None else round(value * 1000, 3)
+    return {'scenario': scenario.name,
+            'requests': len(latencies),
+            'requests_per_sec': round(len(latencies) / float(duration), 1),
+            'elapsed': round(elapsed, 2),
+            'latency_ms': {'p50': ms(percentile(latencies, 0.5)),
+                           'p99': ms(percentile(latencies, 0.99)),
+                           'p999': ms(percentile(latencies, 0.999)),
+                           'max': ms(latencies[-1] if latencies else None)},
+            'statuses': dict((str(status), count) for status, count in statuses.items()),
+            'bytes': sum(result['bytes'] for result in collected),
+            'errors': sum(result['errors'] for result in collected),
+            'reconnects': sum(result['reconnects'] for result in collected),
+            'worker_rss_kib': worker_rss(server_pid)}
+
+
+def make_document_root():
+    root = tempfile.mkdtemp(prefix='httpd-bench-')
+    for name, size in FILES.items():
+        with open(os.path.join(root, name), 'wb') as content_file:
+            if name.endswith('.jpg'):
+                content_file.write(os.urandom(size))
+            else:
+                content_file.write(('x' * 63 + '\n') * (size // 64))
+    return root
+
+
+def wait_for_port(addr, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(addr, timeout=1).close()
+            return True
+        except socket.error:
+            time.sleep(0.1)
+    return False
+
+
+def start_server(opts, root, engine=None):
+    args = [sys.executable, HTTPD, '-H', '127.0.0.1', '-p', str(opts.port),
+            '-w', str(opts.workers), '-r', root, '-l', os.devnull]
+    if engine:
+        args += ['--engine', engine]
+    return subprocess.Popen(args + opts.server_args.split(), preexec_fn=os.setsid)
+
+
+def stop_server(server):
+    # Ctrl+C для всей группы процессов: мастеру и воркерам
+    os.killpg(server.pid, signal.SIGINT)
+    deadline = time.time() + 5
+    while server.poll() is None and time.time() < deadline:
+        time.sleep(0.1)
+    if server.poll() is None:
+        os.killpg(server.pid, signal.SIGKILL)
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+if __name__ == '__main__':
+    op = OptionParser(usage='%prog [options] [scenario ...]')
+    op.add_option("-p", "--port", action="store", type=int, default=8089)
+    op.add_option("-w", "--workers", action="store", type=int, default=2)
+    op.add_option("-d", "--duration", action="store", type=float, default=10.0)
+    op.add_option("-c", "--connections", action="store", type=int, default=50)
+    op.add_option("-P", "--processes", action="store", type=int, default=2,
+                  help="load generator processes")
+    op.add_option("-s", "--server-args", action="store", default='',
+                  help="extra httpd.py options, e.g. \"--reuse-port -e\"")
+    op.add_option("-o", "--output", action="store", default=None)
+    op.add_option("-e", "--engines", action="store", default='',
+                  help="comma-separated httpd.py --engine values to compare, "
+                       "e.g. epoll,select,asyncio; by default the server's own default")
+    (opts, args) = op.parse_args()
+
+    scenarios = [Scenario(*scenario) for scenario in SCENARIOS
+                 if not args or scenario[0] in args]
+    engines = [engine for engine in opts.engines.split(',') if engine] or [None]
+    unknown = [engine for engine in engines if engine and engine not in async_handlers.ENGINES]
+    if unknown:
+        op.error('unknown engine {}, expected one of: {}'.format(
+            ', '.join(unknown), ', '.join(sorted(async_handlers.ENGINES))))
+    raise_fd_limit()
+    root = make_document_root()
+    server_addr = ('127.0.0.1', opts.port)
+    report = {'workers': opts.workers, 'connections': opts.connections,
+              'duration': opts.duration, 'server_args': opts.server_args,
+              'python': sys.version.split()[0], 'results': []}
+    try:
+        for engine in engines:
+            server = start_server(opts, root, engine)
+            try:
+                if not wait_for_port(server_addr):
+                    raise SystemExit('httpd.py did not start on port {:d}'.format(opts.port))
+                for scenario in scenarios:
+                    result = run_scenario(scenario, server_addr, opts.duration,
+                                          opts.connections, opts.processes, server.pid)
+                    result['engine'] = engine or 'default'
+                    report['results'].append(result)
+            finally:
+                stop_server(server)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if opts.output:
+        with open(opts.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
@@ -0,0 +1,1273 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import stat
+import time
+import mmap
+import zlib
+import fcntl
+import struct
+import shutil
+import urllib
+import logging
+import tempfile
+import posixpath
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
+
+OK = 200
+NOT_FOUND = 404
+FORBIDDEN = 403
+
+
+class CacheEntry(object):
+
+    __slots__ = ('data', 'content_type', 'content_length', 'headers',
+                 'mtime', 'ino', 'size', 'checked')
+
+    def __init__(self, data, content_type, st, checked):
+        self.data = data
+        self.content_type = content_type
+        self.content_length = len(data)
+        self.headers = 'Content-Type: {}\r\nContent-Length: {:d}\r\n'.format(
+            content_type, self.content_length)
+        self.mtime = st.st_mtime
+        self.ino = st.st_ino
+        self.size = st.st_size
+        self.checked = checked
+
+    def matches(self, st):
+        return (self.mtime, self.ino, self.size) == (st.st_mtime, st.st_ino, st.st_size)
+
+
+def read_file(path, max_size):
+    """(stat, содержимое) обычного файла не больше max_size или None.
+    Общего состояния не меняет, поэтому выполняется и в пуле потоков"""
+    try:
+        with open(path, 'rb') as content_file:
+            st = os.fstat(content_file.fileno())
+            if not stat.S_ISREG(st.st_mode) or st.st_size > max_size:
+                return None
+            data = content_file.read()
+    except (IOError, OSError):
+        return None
+    if len(data) != st.st_size:
+        # файл меняется прямо сейчас
+        return None
+    return st, data
+
+
+class PooledReads(object):
+    """Чтение файлов кэша в пуле потоков. У кэша - max_file_size,
+    pending (путь -> метка чтения) и preload; invalidate снимает метку,
+    и прочитанное до изменения файла в кэш не попадает"""
+
+    def submit(self, path, content_type, pool):
+        """Чтение файла в пуле; False - очередь пула полна"""
+        if path in self.pending:
+            return True
+        token = object()
+        callback = lambda loaded, error: self.loaded(path, content_type, token, loaded, error)
+        if not pool.submit(read_file, (path, self.max_file_size), callback):
+            return False
+        self.pending[path] = token
+        return True
+
+    def loaded(self, path, content_type, token, loaded, error):
+        """Результат чтения из пула, в цикле событий; запись не закрепляется"""
+        if self.pending.get(path) is not token:
+            # файл изменился, пока читался
+            return
+        del self.pending[path]
+        if loaded is not None:
+            st, data = loaded
+            self.preload(path, content_type, st, data)
+
+
+class FileCache(PooledReads):
+    """Кэш небольших статических файлов одного worker'а.
+
+    Вытеснение LRU, ограничено числом записей и суммарным размером.
+    Запись сверяется по mtime/inode со stat, который передает вызывающий;
+    без него - собственным stat не чаще check_interval секунд. Сервер
+    всегда передает stat из PathResolver, так что частоту проверок
+    задает его ttl (--resolve-ttl).
+
+    С пулом потоков файл при промахе читается в пуле, а запрос
+    отдается из самого файла; запись появится в кэше, когда
+    цикл событий получит результат.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=32 * 1024 * 1024,
+                 max_file_size=256 * 1024, check_interval=1.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.check_interval = check_interval
+        self.entries = OrderedDict()
+        # чтения в пуле, см. PooledReads
+        self.pending = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path, content_type, st=None, pool=None):
+        """Запись кэша для файла или None, если файл в кэш не помещается
+        или читается в пуле потоков pool.
+
+        Свежий stat файла, если он известен, заменяет периодическую проверку.
+        """
+        now = time.time()
+        entry = self.entries.pop(path, None)
+        if entry is not None and st is not None:
+            if not entry.matches(st):
+                self.bytes -= entry.content_length
+                entry = None
+        elif entry is not None and now - entry.checked >= self.check_interval:
+            if self.revalidate(entry, path, now):
+                entry.checked = now
+            else:
+                self.bytes -= entry.content_length
+                entry = None
+        if entry is not None:
+            # переносим в конец - самые свежие записи
+            self.entries[path] = entry
+            self.hits += 1
+            return entry
+        self.misses += 1
+        if st is not None and st.st_size > self.max_file_size:
+            return None
+        if pool is not None and self.submit(path, content_type, pool):
+            return None
+        return self.load(path, content_type, now)
+
+    def revalidate(self, entry, path, now):
+        try:
+            return entry.matches(os.stat(path))
+        except OSError:
+            return False
+
+    def load(self, path, content_type, now):
+        loaded = read_file(path, self.max_file_size)
+        if loaded is None:
+            return None
+        st, data = loaded
+        return self.store(path, CacheEntry(data, content_type, st, now))
+
+    def preload(self, path, content_type, st, data):
+        """Запись из уже прочитанного содержимого файла (прогрев)"""
+        self.invalidate(path)
+        self.store(path, CacheEntry(data, content_type, st, time.time()))
+
+    def store(self, path, entry):
+        self.entries[path] = entry
+        self.bytes += entry.content_length
+        self.evict()
+        return entry
+
+    def evict(self):
+        while self.entries and (len(self.entries) > self.max_entries or
+                                self.bytes > self.max_bytes):
+            _, entry = self.entries.popitem(last=False)
+            self.bytes -= entry.content_length
+            self.evictions += 1
+
+    def invalidate(self, path):
+        self.pending.pop(path, None)
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.bytes -= entry.content_length
+
+    def release(self, entry):
+        """Ответ с телом из записи отправлен"""
+
+    def clear(self):
+        self.entries.clear()
+        self.pending.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': len(self.entries),
+                'bytes': self.bytes}
+
+
+# заголовок общего кэша: запись (cursor), вытеснение (tail), записей, вытеснено,
+# занятых ячеек индекса (записи и надгробия), перешагнутых закрепленных записей
+SHARED_HEADER = struct.Struct('<QQQQQQ')
+# закрепленная запись, через которую перешагнул хвост: позиция, длина, ячейка
+RETAINED = struct.Struct('<QII')
+MAX_RETAINED = 16
+# ячейка индекса: crc32 пути, состояние, позиция в кольце, длины заголовков,
+# пути и тела, mtime, inode и размер файла
+SHARED_SLOT = struct.Struct('<IIQIIIdQQ')
+# перед каждой записью в кольце: ячейка индекса и полная длина записи
+BLOB_HEADER = struct.Struct('<II')
+EMPTY, USED, DELETED, STALE = range(4)
+# заполнитель конца круга, на который запись не поместилась,
+# или места перед закрепленной записью
+SKIP = 0xffffffff
+
+
+def align(size, to=8):
+    return (size + to - 1) // to * to
+
+
+class SharedEntry(object):
+
+    __slots__ = ('slot', 'headers', 'data', 'content_length')
+
+    def __init__(self, slot, headers, data):
+        self.slot = slot
+        self.headers = headers
+        self.data = data
+        self.content_length = len(data)
+
+
+class SharedFileCache(PooledReads):
+    """Кэш небольших файлов в общей памяти всех worker'ов.
+
+    Создается мастером до fork: анонимный MAP_SHARED mmap с хеш-индексом
+    (открытая адресация, ячейки фиксированного размера) и кольцом данных,
+    в которое записи пишутся по порядку, а вытесняются с хвоста (FIFO).
+    Память не зависит от числа worker'ов.
+
+    Поиск, вставку и вытеснение сериализует fcntl.lockf на временном
+    файле: блокировка принадлежит процессу, и ядро снимает ее,
+    если worker умрет, держа ее. Тело отдается memoryview прямо из
+    общей памяти; пока ответ отправляется, запись закреплена в строке
+    закреплений worker'а. Строку пишет только ее worker; обнуляет ее
+    мастер через reset, когда worker собран (supervisor.Supervisor
+    не выдает строку, пока ее владелец жив).
+
+    Закрепленную запись на хвосте вытеснение перешагивает, запоминая ее
+    место (до MAX_RETAINED записей), и новые записи обходят его, пока
+    она не освободится: медленный клиент не останавливает вставки
+    остальных. Удаленные ячейки индекса остаются надгробиями, которые
+    удлиняют поиск; когда их больше четверти таблицы, compact
+    перестраивает индекс.
+
+    С пулом потоков файл при промахе читается в пуле, как у FileCache.
+    """
+
+    def __init__(self, workers, max_entries=1024, max_bytes=32 * 1024 * 1024,
+                 max_file_size=256 * 1024, generations=2):
+        self.max_entries = max_entries
+        self.max_file_size = max_file_size
+        self.capacity = align(max_bytes)
+        self.table_size = 1
+        while self.table_size < max_entries * 2:
+            self.table_size *= 2
+        self.table_offset = SHARED_HEADER.size + MAX_RETAINED * RETAINED.size
+        self.data_offset = align(self.table_offset + self.table_size * SHARED_SLOT.size)
+        self.arena = mmap.mmap(-1, self.data_offset + self.capacity)
+        self.view = mapped_view(self.arena)
+        self.pins = multiprocessing.RawArray('H', workers * generations * self.table_size)
+        self.rows = workers * generations
+        self.lock_file = tempfile.TemporaryFile()
+        # чтения в пуле этого процесса, см. PooledReads
+        self.pending = {}
+        self.base = 0
+        self.hits = 0
+        self.misses = 0
+        self.compactions = 0
+
+    def bind(self, worker):
+        """Закрепления пишутся в строку worker'а"""
+        self.base = worker * self.table_size
+
+    def reset(self, worker):
+        """Worker собран мастером: закрепления, которые он не успел снять"""
+        base = worker * self.table_size
+        self.lock()
+        try:
+            for slot in range(base, base + self.table_size):
+                self.pins[slot] = 0
+        finally:
+            self.unlock()
+
+    def lock(self):
+        fcntl.lockf(self.lock_file, fcntl.LOCK_EX)
+
+    def unlock(self):
+        fcntl.lockf(self.lock_file, fcntl.LOCK_UN)
+
+    def get(self, path, content_type, st=None, pool=None):
+        """Закрепленная запись для файла или None (в том числе пока файл
+        читается в пуле pool); после ответа - release.
+        Без st файл проверяется stat при каждом обращении"""
+        if st is None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                return None
+        if st.st_size > self.max_file_size:
+            return None
+        key = zlib.crc32(path) & 0xffffffff
+        self.lock()
+        try:
+            slot, fields = self.find(path, key)
+            if slot is not None:
+                if fields[6:] == (st.st_mtime, st.st_ino, st.st_size):
+                    self.hits += 1
+                    return self.pin(slot, fields)
+                self.remove(slot)
+        finally:
+            self.unlock()
+        self.misses += 1
+        if pool is not None and self.submit(path, content_type, pool):
+            return None
+        return self.load(path, key, content_type)
+
+    def load(self, path, key, content_type):
+        loaded = read_file(path, self.max_file_size)
+        if loaded is None:
+            return None
+        st, data = loaded
+        return self.insert(path, key, content_type, st, data)
+
+    def preload(self, path, content_type, st, data):
+        """Запись из уже прочитанного содержимого файла (прогрев мастером:
+        строки закреплений принадлежат worker'ам, поэтому без закрепления)"""
+        if st.st_size <= self.max_file_size:
+            self.insert(path, zlib.crc32(path) & 0xffffffff, content_type, st, data, pin=False)
+
+    def insert(self, path, key, content_type, st, data, pin=True):
+        """Закрепленная запись с содержимым data или None, если места нет
+        (или pin=False)"""
+        headers = 'Content-Type: {}\r\nContent-Length: {:d}\r\n'.format(
+            content_type, len(data))
+        size = align(BLOB_HEADER.size + len(headers) + len(path) + len(data))
+        if size > self.capacity:
+            return None
+        self.lock()
+        try:
+            slot, fields = self.find(path, key)
+            if slot is not None:
+                # другой worker успел раньше
+                if fields[6:] == (st.st_mtime, st.st_ino, st.st_size):
+                    return self.pin(slot, fields) if pin else None
+                self.remove(slot)
+            header = self.header()
+            if header[4] - header[2] > self.table_size // 4:
+                self.compact()
+            slot = self.free_slot(key)
+            if slot is None:
+                return None
+            position = self.allocate(size)
+            if position is None:
+                return None
+            offset = self.data_offset + position % self.capacity
+            BLOB_HEADER.pack_into(self.arena, offset, slot, size)
+            start = offset + BLOB_HEADER.size
+            self.arena[start:start + len(headers) + len(path) + len(data)] = headers + path + data
+            occupied = 1 if self.read_slot(slot)[1] == EMPTY else 0
+            self.write_slot(slot, key, USED, position, len(headers), len(path), len(data), st)
+            self.add_entries(1, occupied)
+            return self.pin(slot, self.read_slot(slot)) if pin else None
+        finally:
+            self.unlock()
+
+    def read_slot(self, slot):
+        return SHARED_SLOT.unpack_from(self.arena, self.table_offset + slot * SHARED_SLOT.size)
+
+    def write_slot(self, slot, key, state, position=0, headers_len=0, path_len=0,
+                   data_len=0, st=None):
+        validators = (st.st_mtime, st.st_ino, st.st_size) if st is not None else (0.0, 0, 0)
+        SHARED_SLOT.pack_into(self.arena, self.table_offset + slot * SHARED_SLOT.size,
+                              key, state, position, headers_len, path_len, data_len,
+                              *validators)
+
+    def set_state(self, slot, state):
+        fields = list(self.read_slot(slot))
+        fields[1] = state
+        SHARED_SLOT.pack_into(self.arena, self.table_offset + slot * SHARED_SLOT.size, *fields)
+
+    def find(self, path, key):
+        """Ячейка пути и ее поля или (None, None)"""
+        mask = self.table_size - 1
+        slot = key & mask
+        for _ in range(self.table_size):
+            fields = self.read_slot(slot)
+            slot_key, state, position, headers_len, path_len = fields[:5]
+            if state == EMPTY:
+                break
+            if state == USED and slot_key == key and path_len == len(path):
+                start = (self.data_offset + position % self.capacity +
+                         BLOB_HEADER.size + headers_len)
+                if self.arena[start:start + path_len] == path:
+                    return slot, fields
+            slot = (slot + 1) & mask
+        return None, None
+
+    def free_slot(self, key):
+        mask = self.table_size - 1
+        slot = key & mask
+        for _ in range(self.table_size):
+            if self.read_slot(slot)[1] in (EMPTY, DELETED):
+                return slot
+            slot = (slot + 1) & mask
+        return None
+
+    def pinned(self, slot):
+        pins = self.pins
+        return any(pins[row * self.table_size + slot] for row in range(self.rows))
+
+    def pin(self, slot, fields):
+        self.pins[self.base + slot] += 1
+        _, _, position, headers_len, path_len, data_len = fields[:6]
+        start = self.data_offset + position % self.capacity + BLOB_HEADER.size
+        headers = self.arena[start:start + headers_len]
+        start += headers_len + path_len
+        return SharedEntry(slot, headers, self.view[start:start + data_len])
+
+    def release(self, entry):
+        # под блокировкой: вытеснение в другом процессе читает счетчик
+        self.lock()
+        try:
+            offset = self.base + entry.slot
+            if self.pins[offset]:
+                self.pins[offset] -= 1
+            else:
+                # счетчик 'H' при переходе через ноль закрепил бы запись навсегда
+                logging.error('{}: shared cache slot {:d} released more times than '
+                              'pinned'.format(multiprocessing.current_process().name,
+                                              entry.slot))
+        finally:
+            self.unlock()
+
+    def remove(self, slot):
+        """Запись устарела: закрепленная остается в кольце до освобождения"""
+        self.set_state(slot, STALE if self.pinned(slot) else DELETED)
+        self.add_entries(-1)
+
+    def compact(self):
+        """Перестройка индекса: надгробия снова становятся пустыми ячейками.
+
+        Незакрепленные записи вставляются заново, их заголовки в кольце
+        переписываются на новые ячейки. Закрепленные остаются в своих
+        ячейках устаревшими: по пути поиска они могут стать недостижимы.
+        """
+        moving = []
+        occupied = 0
+        for slot in range(self.table_size):
+            fields = self.read_slot(slot)
+            state = fields[1]
+            if state in (USED, STALE) and self.pinned(slot):
+                if state == USED:
+                    self.set_state(slot, STALE)
+                occupied += 1
+                continue
+            if state == USED:
+                moving.append(fields)
+            self.write_slot(slot, 0, EMPTY)
+        for fields in moving:
+            slot = self.free_slot(fields[0])
+            SHARED_SLOT.pack_into(self.arena, self.table_offset + slot * SHARED_SLOT.size,
+                                  *fields)
+            offset = self.data_offset + fields[2] % self.capacity
+            blob_size = BLOB_HEADER.unpack_from(self.arena, offset)[1]
+            BLOB_HEADER.pack_into(self.arena, offset, slot, blob_size)
+            occupied += 1
+        header = self.header()
+        header[2] = len(moving)
+        header[4] = occupied
+        SHARED_HEADER.pack_into(self.arena, 0, *header)
+        self.compactions += 1
+
+    def header(self):
+        return list(SHARED_HEADER.unpack_from(self.arena, 0))
+
+    def add_entries(self, count, occupied=0):
+        header = self.header()
+        header[2] += count
+        header[4] += occupied
+        SHARED_HEADER.pack_into(self.arena, 0, *header)
+
+    def retained(self, count):
+        return [RETAINED.unpack_from(self.arena, SHARED_HEADER.size + i * RETAINED.size)
+                for i in range(count)]
+
+    def placement(self, cursor, size, retained):
+        """Позиция не раньше cursor, с которой запись размера size
+        не пересекает конец круга и перешагнутые закрепленные записи,
+        и заполнители [(позиция, длина)] перед ней"""
+        position = cursor
+        fillers = []
+        moved = True
+        while moved:
+            moved = False
+            offset = position % self.capacity
+            if offset + size > self.capacity:
+                fillers.append((position, self.capacity - offset))
+                position += self.capacity - offset
+                moved = True
+                continue
+            for hole, hole_size, _ in retained:
+                # ближайшее место записи в кругах, которые еще впереди
+                hole += (position - hole) // self.capacity * self.capacity
+                if hole + hole_size <= position:
+                    hole += self.capacity
+                if hole < position + size:
+                    if hole > position:
+                        fillers.append((position, hole - position))
+                    position = hole + hole_size
+                    moved = True
+                    break
+        return position, fillers
+
+    def allocate(self, size):
+        """Позиция (от начала времен) для записи размера size или None,
+        если место занято закрепленными записями"""
+        cursor, tail, entries, evictions, occupied, count = self.header()
+        retained = []
+        for region in self.retained(count):
+            position, _, slot = region
+            if self.pinned(slot):
+                retained.append(region)
+            elif self.read_slot(slot)[1:3] == (STALE, position):
+                # ответ отправлен, место освободится на своем круге
+                self.set_state(slot, DELETED)
+        result = None
+        while True:
+            position, fillers = self.placement(cursor, size, retained)
+            if position + size - tail <= self.capacity and entries < self.max_entries:
+                result = position
+                break
+            if cursor == tail:
+                if position == cursor:
+                    break
+                # кольцо пусто: начинаем с первого подходящего места
+                cursor = tail = position
+                continue
+            blob_slot, blob_size = BLOB_HEADER.unpack_from(
+                self.arena, self.data_offset + tail % self.capacity)
+            if blob_slot != SKIP:
+                state, position = self.read_slot(blob_slot)[1:3]
+                if position == tail and state in (USED, STALE):
+                    if self.pinned(blob_slot):
+                        if len(retained) >= MAX_RETAINED:
+                            break
+                        # отправляется: перешагиваем, запись останется на месте
+                        retained.append((tail, blob_size, blob_slot))
+                        self.set_state(blob_slot, STALE)
+                    else:
+                        self.set_state(blob_slot, DELETED)
+                    if state == USED:
+                        entries -= 1
+                        evictions += 1
+            tail += blob_size
+        if result is not None:
+            for position, filler in fillers:
+                BLOB_HEADER.pack_into(self.arena, self.data_offset + position % self.capacity,
+                                      SKIP, filler)
+            cursor = result + size
+        for i, region in enumerate(retained):
+            RETAINED.pack_into(self.arena, SHARED_HEADER.size + i * RETAINED.size, *region)
+        SHARED_HEADER.pack_into(self.arena, 0, cursor, tail, entries, evictions, occupied,
+                                len(retained))
+        return result
+
+    def invalidate(self, path):
+        self.pending.pop(path, None)
+        key = zlib.crc32(path) & 0xffffffff
+        self.lock()
+        try:
+            slot, _ = self.find(path, key)
+            if slot is not None:
+                self.remove(slot)
+        finally:
+            self.unlock()
+
+    def stats(self):
+        cursor, tail, entries, evictions, occupied, retained = self.header()
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': evictions, 'entries': entries,
+                'bytes': cursor - tail, 'tombstones': occupied - entries,
+                'retained': retained, 'compactions': self.compactions}
+
+
+def make_etag(st, now=None):
+    """ETag из inode, размера и mtime. Файл, измененный в текущую секунду,
+    может измениться еще раз с тем же mtime, поэтому его ETag слабый"""
+    etag = '"{:x}-{:x}-{:x}"'.format(st.st_ino, st.st_size, int(st.st_mtime * 1000000))
+    if now is None:
+        now = time.time()
+    if now - st.st_mtime < 1:
+        etag = 'W/' + etag
+    return etag
+
+
+def variant_etag(etag, encoding):
+    """ETag сжатого варианта: у каждого представления свой"""
+    return etag[:-1] + '-' + encoding + '"'
+
+
+def etag_base(etag):
+    """Часть ETag, по которой сравниваются версии файла: без W/ и кодировки"""
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    return etag.strip('"').split('-')[:3]
+
+
+class Resolution(object):
+
+    __slots__ = ('code', 'path', 'stat', 'content_type', 'etag', 'last_modified', 'expires')
+
+    def __init__(self, code, path=None, st=None, content_type='', expires=0):
+        self.code = code
+        self.path = path
+        self.stat = st
+        self.content_type = content_type
+        self.expires = expires
+        self.etag = None
+        self.last_modified = None
+        if st is not None:
+            self.etag = make_etag(st)
+            self.last_modified = time.strftime("%a, %d %b %Y %H:%M:%S GMT",
+                                               time.gmtime(st.st_mtime))
+
+
+class PathResolver(object):
+    """Отображение URL в файл DOCUMENT_ROOT.
+
+    Результат (путь, stat, Content-Type, статус) запоминается на ttl секунд,
+    в том числе для 404/403, так что повторный URL не стоит ни одного
+    системного вызова. Путь нормализуется и не может выйти за root_dir.
+    """
+
+    def __init__(self, root_dir, content_types, index_file,
+                 ttl=1.0, max_entries=4096):
+        # пустой root_dir - текущий каталог, а не корень файловой системы
+        self.root_dir = os.path.abspath(root_dir or os.curdir)
+        self.real_root = os.path.join(os.path.realpath(self.root_dir), '')
+        self.content_types = content_types
+        self.index_file = index_file
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        # меняется при каждой invalidate: поиск, начатый раньше, не запоминается
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, url_path):
+        resolution = self.cached(url_path)
+        if resolution is None:
+            resolution = self.store(url_path, self.lookup(url_path))
+        return resolution
+
+    def cached(self, url_path):
+        """Разрешение из кэша или None, если его нужно искать на диске"""
+        resolution = self.entries.get(url_path)
+        if resolution is not None and resolution.expires > time.time():
+            self.hits += 1
+            return resolution
+        self.misses += 1
+        return None
+
+    def store(self, url_path, resolution, generation=None):
+        """Запоминает разрешение; generation - значение self.generation
+        на момент начала поиска, если поиск шел в другом потоке"""
+        resolution.expires = time.time() + self.ttl
+        if generation is not None and generation != self.generation:
+            # файлы менялись, пока шел поиск
+            return resolution
+        if self.ttl > 0:
+            self.entries.pop(url_path, None)
+            self.entries[url_path] = resolution
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return resolution
+
+    def lookup(self, url_path):
+        """Поиск файла на диске; общего состояния не меняет,
+        поэтому может выполняться в пуле потоков"""
+        path = urllib.unquote(url_path)
+        if '\0' in path:
+            return Resolution(NOT_FOUND)
+        try_index_file = False
+        # normpath срезает '/' на конце, а '/page.html/' - запрос каталога
+        directory = path.endswith('/')
+        # '..' не поднимется выше корня: normpath('/../a') == '/a'
+        path = posixpath.normpath('/' + path)
+        full_path = self.root_dir + path
+        content_type = None
+        if not directory:
+            content_type = self.content_types.get(posixpath.splitext(path)[1].lower())
+        if content_type is None:
+            directory_path = full_path
+            full_path = os.path.join(full_path, self.index_file)
+            content_type = self.content_types[os.path.splitext(self.index_file)[1].lower()]
+            try_index_file = True
+        code = FORBIDDEN if try_index_file else NOT_FOUND
+        real_path = os.path.realpath(full_path)
+        # символическая ссылка наружу из DOCUMENT_ROOT
+        if not os.path.join(real_path, '').startswith(self.real_root):
+            return Resolution(FORBIDDEN, content_type=content_type)
+        try:
+            st = os.stat(real_path)
+        except OSError:
+            if try_index_file and os.path.isfile(directory_path):
+                # файл, запрошенный как каталог
+                code = NOT_FOUND
+            return Resolution(code, content_type=content_type)
+        if not stat.S_ISREG(st.st_mode):
+            return Resolution(code, content_type=content_type)
+        return Resolution(OK, real_path, st, content_type)
+
+    def preload(self, resolutions, expires):
+        """Разрешения, найденные заранее (Manifest), действуют до expires"""
+        if expires <= time.time():
+            return
+        for url_path, resolution in resolutions.iteritems():
+            if len(self.entries) >= self.max_entries:
+                break
+            resolution.expires = expires
+            self.entries[url_path] = resolution
+
+    def invalidate(self, url_path=None):
+        if url_path is None:
+            self.generation += 1
+            self.entries.clear()
+        else:
+            self.entries.pop(url_path, None)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self.entries)}
+
+
+class Manifest(object):
+    """Снимок DOCUMENT_ROOT, который мастер строит до fork.
+
+    Для каждого файла известного типа (и каталога с index) - разрешение
+    URL со stat, Content-Type и ETag, ровно как его нашел бы resolver;
+    для файлов не больше max_file_size - еще и содержимое. Каталоги
+    обходятся по уровням, каталоги одного уровня - параллельно в пуле
+    потоков: listdir, stat и read отпускают GIL. Символические ссылки
+    на каталоги не обходятся, их файлы найдутся при запросе.
+    """
+
+    def __init__(self, resolver, max_file_size=0):
+        self.resolver = resolver
+        self.max_file_size = max_file_size
+        # URL -> Resolution
+        self.resolutions = {}
+        # путь файла -> содержимое
+        self.contents = {}
+        self.files = 0
+        self.bytes = 0
+        self.started = 0.0
+        self.finished = 0.0
+        self.seconds = 0.0
+
+    def scan(self, threads=4):
+        self.started = time.time()
+        pool = ThreadPool(max(threads, 1))
+        try:
+            level = ['']
+            while level:
+                subdirs = []
+                for found, dirs in pool.imap_unordered(self.scan_dir, level):
+                    for url_path, resolution, data in found:
+                        self.resolutions[url_path] = resolution
+                        if data is not None:
+                            self.contents[resolution.path] = data
+                            self.files += 1
+                            self.bytes += len(data)
+                    subdirs.extend(dirs)
+                level = subdirs
+            self.finished = time.time()
+            self.seconds = self.finished - self.started
+        finally:
+            pool.close()
+            pool.join()
+
+    def scan_dir(self, rel_dir):
+        """Разрешения URL одного каталога и его подкаталоги; в потоке пула"""
+        full_dir = os.path.join(self.resolver.root_dir, rel_dir)
+        found = []
+        dirs = []
+        try:
+            names = os.listdir(full_dir)
+        except OSError:
+            return found, dirs
+        # сам каталог отдается по URL со '/' на конце, его содержимое
+        # прочитается вместе с index-файлом
+        urls = [('/' + rel_dir + '/' if rel_dir else '/', False)]
+        for name in names:
+            rel_path = posixpath.join(rel_dir, name)
+            full_path = os.path.join(full_dir, name)
+            if os.path.isdir(full_path):
+                if not os.path.islink(full_path):
+                    dirs.append(rel_path)
+            elif posixpath.splitext(name)[1].lower() in self.resolver.content_types:
+                urls.append(('/' + rel_path, True))
+        for url_path, is_file in urls:
+            url_path = urllib.quote(url_path)
+            resolution = self.resolver.lookup(url_path)
+            if resolution.code == OK:
+                found.append((url_path, resolution, self.read(resolution) if is_file else None))
+        return found, dirs
+
+    def read(self, resolution):
+        """Содержимое файла, если он не больше max_file_size и не изменился после stat"""
+        st = resolution.stat
+        if not self.max_file_size or st.st_size > self.max_file_size:
+            return None
+        try:
+            with open(resolution.path, 'rb') as content_file:
+                current = os.fstat(content_file.fileno())
+                if (current.st_mtime, current.st_ino, current.st_size) != \
+                        (st.st_mtime, st.st_ino, st.st_size):
+                    return None
+                data = content_file.read()
+        except (IOError, OSError):
+            return None
+        if len(data) != st.st_size:
+            # файл меняется прямо сейчас
+            return None
+        return data
+
+    def stats(self):
+        return {'urls': len(self.resolutions), 'files': self.files,
+                'bytes': self.bytes, 'seconds': round(self.seconds, 3)}
+
+
+# zlib.compressobj: формат gzip для gzip, zlib-обертка для deflate (RFC 7230 4.2.2)
+ENCODING_WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+class CompressedEntry(object):
+
+    __slots__ = ('encoding', 'data', 'path', 'size', 'mtime', 'ino', 'source_size', 'spooled',
+                 'sibling', 'checked')
+
+    def __init__(self, encoding, st, data=None, path=None, size=0, spooled=False,
+                 sibling=None):
+        # encoding None - сжатие не выгодно, отдаем исходный файл
+        self.encoding = encoding
+        self.data = data
+        self.path = path
+        self.size = size
+        self.mtime = st.st_mtime
+        self.ino = st.st_ino
+        self.source_size = st.st_size
+        self.spooled = spooled
+        # размер, mtime и inode соседнего .gz, который отдается вместо сжатия
+        self.sibling = sibling
+        # stat исходного файла, с которым .gz сверялся последним
+        self.checked = st
+
+    def matches(self, st):
+        return (self.mtime, self.ino, self.source_size) == (st.st_mtime, st.st_ino, st.st_size)
+
+
+def compress_file(path, spool_path, encoding, level, chunk_size):
+    """Потоковое сжатие path в spool_path, в памяти только chunk_size;
+    возвращает размер результата. Общего состояния не меняет,
+    поэтому выполняется в пуле потоков"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, ENCODING_WBITS[encoding])
+    size = 0
+    try:
+        with open(spool_path, 'wb') as target, open(path, 'rb') as source:
+            part = source.read(chunk_size)
+            while part:
+                data = compressor.compress(part)
+                target.write(data)
+                size += len(data)
+                part = source.read(chunk_size)
+            data = compressor.flush()
+            target.write(data)
+            size += len(data)
+    except (IOError, OSError):
+        try:
+            os.unlink(spool_path)
+        except OSError:
+            pass
+        raise
+    return size
+
+
+def remove_spooled(entry):
+    """Удаляет временный файл варианта, сжатого в файл"""
+    if entry.spooled:
+        try:
+            os.unlink(entry.path)
+        except OSError:
+            pass
+
+
+class CompressionCache(object):
+    """Сжатые варианты файлов по ключу (путь, кодировка), действительные
+    пока не изменились mtime/inode/размер исходного файла.
+
+    Свежий соседний .gz отдается как есть. Небольшие файлы сжимаются
+    в память (суммарно не больше max_bytes). Большие сжимаются во
+    временный файл в пуле потоков, чтобы не останавливать цикл событий;
+    пока вариант готовится, и без пула, отдается исходный файл.
+    С пулом в нем же сжимаются небольшие файлы и проверяется соседний .gz.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, max_memory_file=256 * 1024,
+                 max_compress_size=16 * 1024 * 1024, min_size=256, level=6,
+                 max_spooled=64, chunk_size=64 * 1024, root_dir=''):
+        # соседний .gz, как и сам файл, не может быть вне DOCUMENT_ROOT
+        self.real_root = os.path.join(os.path.realpath(root_dir or os.curdir), '')
+        self.max_bytes = max_bytes
+        self.max_memory_file = max_memory_file
+        self.max_compress_size = max_compress_size
+        self.min_size = min_size
+        self.level = level
+        self.max_spooled = max_spooled
+        self.chunk_size = chunk_size
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.spooled = 0
+        self.spool_dir = None
+        # ключ -> метка варианта, который готовится в пуле;
+        # invalidate снимает метку, и устаревший вариант не сохраняется
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path, st, encoding, pool=None):
+        """Вариант для отдачи или None - отдавать исходный файл;
+        pool - пул потоков, в котором готовятся варианты"""
+        key = path, encoding
+        entry = self.entries.pop(key, None)
+        if entry is not None and not (entry.matches(st) and
+                                      self.sibling_matches(entry, st, pool)):
+            self.discard(entry)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            entry = self.load(path, st, encoding, pool)
+            if entry is None:
+                return None
+            self.store(key, entry)
+        else:
+            self.hits += 1
+            self.entries[key] = entry
+        return entry if entry.encoding is not None else None
+
+    def expected_encoding(self, path, st, encoding, pool=None):
+        """Кодировка, которую получит безусловный запрос, - для ETag ответа
+        304, без сжатия и stat. Решает уже готовый вариант, на холодном
+        кэше - размер файла. Выгодно ли сжатие, до сжатия неизвестно:
+        такой файл получает ETag сжатого варианта, пока вариант не готов"""
+        entry = self.entries.get((path, encoding))
+        if entry is not None and entry.matches(st):
+            return entry.encoding
+        if (st.st_size < self.min_size or st.st_size > self.max_compress_size or
+                pool is None and st.st_size > self.max_memory_file):
+            return None
+        return encoding
+
+    def load(self, path, st, encoding, pool=None):
+        """Вариант, построенный на месте, или None - он готовится в пуле
+        (или очередь пула полна, а файл слишком велик для цикла событий)"""
+        if st.st_size < self.min_size:
+            return CompressedEntry(None, st)
+        if pool is not None and (self.submit(path, st, encoding, pool) or
+                                 st.st_size > self.max_memory_file):
+            return None
+        try:
+            return self.build(path, st, encoding)
+        except (IOError, OSError):
+            return None
+
+    def build(self, path, st, encoding, spool_dir=None):
+        """Свежий соседний .gz, вариант, сжатый в память, или, если задан
+        spool_dir, - сжатый в файл там; CompressedEntry(None) - сжатие
+        не выгодно. Общего состояния не меняет, поэтому выполняется
+        и в пуле потоков"""
+        if encoding == 'gzip':
+            entry = self.precompressed(path, st)
+            if entry is not None:
+                return entry
+        if st.st_size > self.max_compress_size:
+            return CompressedEntry(None, st)
+        if st.st_size <= self.max_memory_file:
+            entry = self.compress(path, st, encoding)
+        elif spool_dir is not None:
+            entry = self.spool(path, st, encoding, spool_dir)
+        else:
+            return CompressedEntry(None, st)
+        if entry.size >= st.st_size:
+            remove_spooled(entry)
+            return CompressedEntry(None, st)
+        return entry
+
+    def precompressed(self, path, st):
+        """Соседний path.gz, если он не старше исходного файла.
+        Отдается и перепроверяется по реальному пути: символическая
+        ссылка наружу из DOCUMENT_ROOT не отдается"""
+        gz_path = os.path.realpath(path + '.gz')
+        if not gz_path.startswith(self.real_root):
+            return None
+        try:
+            gz_st = os.stat(gz_path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(gz_st.st_mode) or gz_st.st_mtime < st.st_mtime:
+            return None
+        return CompressedEntry('gzip', st, path=gz_path, size=gz_st.st_size,
+                               sibling=(gz_st.st_size, gz_st.st_mtime, gz_st.st_ino))
+
+    def sibling_matches(self, entry, st, pool=None):
+        """Соседний .gz не изменился. stat для него повторяется, только
+        когда resolver заново сделал stat исходного файла; с пулом
+        вариант тогда ищется в пуле заново"""
+        if entry.sibling is None or entry.checked is st:
+            return True
+        if pool is not None:
+            return False
+        try:
+            gz_st = os.stat(entry.path)
+        except OSError:
+            return False
+        if (gz_st.st_size, gz_st.st_mtime, gz_st.st_ino) != entry.sibling:
+            return False
+        entry.checked = st
+        return True
+
+    def compress(self, path, st, encoding):
+        with open(path, 'rb') as source:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, ENCODING_WBITS[encoding])
+            data = compressor.compress(source.read()) + compressor.flush()
+        return CompressedEntry(encoding, st, data=data, size=len(data))
+
+    def spool(self, path, st, encoding, spool_dir):
+        """Потоковое сжатие во временный файл в spool_dir"""
+        fd, spool_path = tempfile.mkstemp(dir=spool_dir)
+        os.close(fd)
+        size = compress_file(path, spool_path, encoding, self.level, self.chunk_size)
+        return CompressedEntry(encoding, st, path=spool_path, size=size, spooled=True)
+
+    def submit(self, path, st, encoding, pool):
+        """Вариант готовится в пуле и появится в кэше, когда цикл событий
+        получит результат; False - очередь пула полна"""
+        key = path, encoding
+        if key in self.pending:
+            return True
+        if self.spool_dir is None and st.st_size > self.max_memory_file:
+            self.spool_dir = tempfile.mkdtemp(prefix='httpd-compressed-')
+        token = object()
+        callback = lambda entry, error: self.built(key, token, entry, error)
+        if not pool.submit(self.build, (path, st, encoding, self.spool_dir), callback):
+            return False
+        self.pending[key] = token
+        return True
+
+    def built(self, key, token, entry, error):
+        """Вариант из пула, в цикле событий"""
+        if self.pending.get(key) is not token:
+            # файл изменился или кэш закрыт, пока вариант готовился
+            if entry is not None:
+                remove_spooled(entry)
+            return
+        del self.pending[key]
+        if error is None:
+            self.store(key, entry)
+
+    def store(self, key, entry):
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.discard(previous)
+        if entry.data is not None:
+            self.bytes += len(entry.data)
+        if entry.spooled:
+            self.spooled += 1
+        self.entries[key] = entry
+        self.evict()
+
+    def discard(self, entry):
+        if entry.data is not None:
+            self.bytes -= len(entry.data)
+        if entry.spooled:
+            self.spooled -= 1
+            remove_spooled(entry)
+
+    def evict(self):
+        while self.entries and (self.bytes > self.max_bytes or
+                                self.spooled > self.max_spooled):
+            _, entry = self.entries.popitem(last=False)
+            self.discard(entry)
+
+    def invalidate(self, path):
+        keys = [(path, encoding) for encoding in ENCODING_WBITS]
+        if path.endswith('.gz'):
+            # изменился соседний .gz - устарел gzip-вариант исходного файла
+            keys.append((path[:-3], 'gzip'))
+        for key in keys:
+            self.pending.pop(key, None)
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.discard(entry)
+
+    def close(self):
+        for entry in self.entries.values():
+            self.discard(entry)
+        self.entries.clear()
+        self.pending.clear()
+        if self.spool_dir is not None:
+            shutil.rmtree(self.spool_dir, ignore_errors=True)
+            self.spool_dir = None
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self.entries), 'bytes': self.bytes,
+                'spooled': self.spooled}
+
+
+def mapped_view(mapping):
+    """memoryview поверх mmap без копирования; в python 2 mmap
+    поддерживает только старый buffer-интерфейс"""
+    try:
+        return memoryview(buffer(mapping))
+    except NameError:
+        return memoryview(mapping)
+
+
+class Mapping(object):
+
+    __slots__ = ('map', 'size', 'mtime', 'ino', 'refs', 'retired')
+
+    def __init__(self, map, st):
+        self.map = map
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.ino = st.st_ino
+        self.refs = 0
+        self.retired = False
+
+    def matches(self, st):
+        return (self.mtime, self.ino, self.size) == (st.st_mtime, st.st_ino, st.st_size)
+
+    def view(self):
+        return mapped_view(self.map)
+
+
+class MmapPool(object):
+    """Отображенные в память файлы средних размеров.
+
+    Отображение живет, пока на него есть ссылки из ответов (refs);
+    при смене mtime/inode или превышении max_bytes оно выводится
+    из пула и закрывается, как только освободится.
+
+    С пулом потоков файл при промахе отображается в пуле, а запрос
+    отдается из самого файла.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, min_file_size=64 * 1024,
+                 max_file_size=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.min_file_size = min_file_size
+        self.max_file_size = max_file_size
+        self.entries = OrderedDict()
+        # путь -> метка отображения в пуле, см. PooledReads
+        self.pending = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def acquire(self, path, st, pool=None):
+        """Отображение файла с увеличенным счетчиком ссылок или None
+        (в том числе пока файл отображается в пуле pool)"""
+        if not self.min_file_size <= st.st_size <= self.max_file_size:
+            return None
+        entry = self.entries.pop(path, None)
+        if entry is not None and not entry.matches(st):
+            self.retire(entry)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            if pool is not None and self.submit(path, st, pool):
+                return None
+            entry = self.map_file(path, st)
+            if entry is None:
+                return None
+            self.bytes += entry.size
+        else:
+            self.hits += 1
+        self.entries[path] = entry
+        entry.refs += 1
+        self.evict()
+        return entry
+
+    def submit(self, path, st, pool):
+        """Отображение в пуле; False - очередь пула полна"""
+        if path in self.pending:
+            return True
+        token = object()
+        callback = lambda entry, error: self.mapped(path, token, entry, error)
+        if not pool.submit(self.map_file, (path, st), callback):
+            return False
+        self.pending[path] = token
+        return True
+
+    def mapped(self, path, token, entry, error):
+        """Результат отображения из пула, в цикле событий"""
+        if self.pending.get(path) is not token:
+            # файл изменился, пока отображался
+            if entry is not None:
+                entry.map.close()
+            return
+        del self.pending[path]
+        if entry is None:
+            return
+        previous = self.entries.pop(path, None)
+        if previous is not None:
+            self.retire(previous)
+        self.entries[path] = entry
+        self.bytes += entry.size
+        self.evict()
+
+    def release(self, entry):
+        entry.refs -= 1
+        if entry.retired and not entry.refs:
+            entry.map.close()
+
+    def map_file(self, path, st):
+        """Общего состояния не меняет, поэтому выполняется и в пуле потоков"""
+        try:
+            with open(path, 'rb') as content_file:
+                current = os.fstat(content_file.fileno())
+                if current.st_size != st.st_size:
+                    return None
+                return Mapping(mmap.mmap(content_file.fileno(), 0, access=mmap.ACCESS_READ),
+                               current)
+        except (IOError, OSError, ValueError, mmap.error):
+            return None
+
+    def retire(self, entry):
+        self.bytes -= entry.size
+        entry.retired = True
+        if not entry.refs:
+            entry.map.close()
+
+    def evict(self):
+        if self.bytes <= self.max_bytes:
+            return
+        # самые давние сначала; занятые ответами отображения пропускаем
+        for path, entry in list(self.entries.items()):
+            if self.bytes <= self.max_bytes:
+                break
+            if not entry.refs:
+                del self.entries[path]
+                self.retire(entry)
+
+    def invalidate(self, path):
+        self.pending.pop(path, None)
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.retire(entry)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self.entries), 'bytes': self.bytes}
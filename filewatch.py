@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+import os
+import errno
+import struct
+import ctypes
+import ctypes.util
+import logging
+import multiprocessing
+
+import async_handlers
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+# struct inotify_event без имени: wd, mask, cookie, len
+EVENT = struct.Struct('iIII')
+
+_libc = []
+
+
+def libc():
+    if not _libc:
+        _libc.append(ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True))
+    return _libc[0]
+
+
+def _check(result):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+class Inotify(object):
+    """inotify через ctypes: в python 2 своего модуля нет"""
+
+    def __init__(self):
+        self.fd = _check(libc().inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+
+    def add_watch(self, path, mask):
+        return _check(libc().inotify_add_watch(self.fd, path, mask))
+
+    def read_events(self):
+        """Все накопленные события: (wd, mask, cookie, имя)"""
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except OSError as err:
+                if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return events
+                raise
+            if not data:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, size = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                name = data[offset:offset + size].rstrip('\0')
+                offset += size
+                events.append((wd, mask, cookie, name))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileWatcher(async_handlers.BaseStreamHandler):
+    """Изменения в дереве root_dir через inotify в цикле событий worker'а.
+
+    callback(path) получает полный путь измененного файла или каталога
+    (по разу на путь за одно чтение событий), None - если события
+    потеряны при переполнении очереди ядра. Каталоги, появившиеся позже,
+    сразу ставятся на наблюдение. Если лимит fs.inotify.max_user_watches
+    исчерпан, watching становится False и вызывается on_fallback:
+    дальше изменения замечает только периодическая проверка stat.
+    """
+
+    def __init__(self, root_dir, callback, on_fallback=None, map=None):
+        super(FileWatcher, self).__init__(map=map)
+        self.callback = callback
+        self.on_fallback = on_fallback
+        self.inotify = Inotify()
+        self.watching = True
+        # наблюдаемые каталоги: wd -> путь. У перемещенного каталога
+        # путь устаревает, но изменения в нем все равно доходят до callback
+        self.dirs = {}
+        self.events = 0
+        self._fileno = self.inotify.fd
+        self.add_channel()
+        self.watch_tree(os.path.realpath(root_dir or os.curdir))
+
+    def __repr__(self):
+        return '<FileWatcher fd {} at {:#x}>'.format(self.inotify.fd, id(self))
+
+    def watch_tree(self, top):
+        for dirpath, _, _ in os.walk(top):
+            if not self.watch(dirpath):
+                return
+
+    def watch(self, path):
+        try:
+            wd = self.inotify.add_watch(path, WATCH_MASK)
+        except OSError as err:
+            if err.args[0] == errno.ENOSPC:
+                self.fall_back()
+                return False
+            if err.args[0] in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                # каталог успели удалить или он закрыт
+                return True
+            raise
+        self.dirs[wd] = path
+        return True
+
+    def fall_back(self):
+        if self.watching:
+            self.watching = False
+            logging.warning('{}: inotify watch limit reached after {:d} directories, '
+                            'falling back to stat polling'.format(
+                                multiprocessing.current_process().name, len(self.dirs)))
+            if self.on_fallback is not None:
+                self.on_fallback()
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        changed = []
+        for wd, mask, cookie, name in self.inotify.read_events():
+            self.events += 1
+            if mask & IN_Q_OVERFLOW:
+                changed.append(None)
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            directory = self.dirs.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name) if name else directory
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and self.watching:
+                self.watch_tree(path)
+            if path not in changed:
+                changed.append(path)
+        for path in changed:
+            self.callback(path)
+
+    def handle_stop_event(self):
+        # не мешаем остановке слушающего сокета
+        self.handle_close()
+
+    def handle_close(self):
+        self.close()
+
+    def close(self):
+        if self._fileno is not None:
+            self.del_channel()
+            self.inotify.close()
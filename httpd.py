@@ -2,14 +2,26 @@
 # -*- coding: utf-8 -*-
 
 import os
+import time
+import errno
 import socket
-import urllib
+import uuid
+import struct
+import signal
 import logging
+import email.utils
 import multiprocessing
+from collections import deque
 from optparse import OptionParser
 
 import async_handlers
 import async_simplehttp
+import filecache
+import metrics
+import profiler
+import accesslog
+import filewatch
+import supervisor
 
 CONTENT_TYPES = {'.html': 'text/html',
                  '.css': 'text/css',
@@ -21,18 +33,88 @@ CONTENT_TYPES = {'.html': 'text/html',
                  '.gif': 'image/gif',
                  '.swf': 'application/x-shockwave-flash',
                  '.ico': 'image/x-icon'}
-OK = 200
-NOT_FOUND = 404
-FORBIDDEN = 403
+# типы, которые имеет смысл сжимать
+COMPRESSIBLE_TYPES = frozenset(('text/html', 'text/css', 'text/javascript', 'text/plain'))
+# в порядке предпочтения при равном q
+ENCODINGS = ('gzip', 'deflate')
+OK = filecache.OK
+PARTIAL_CONTENT = 206
+NOT_MODIFIED = 304
+REQUESTED_RANGE_NOT_SATISFIABLE = 416
+NOT_FOUND = filecache.NOT_FOUND
+FORBIDDEN = filecache.FORBIDDEN
 INDEX_FILE = 'index.html'
+TCP_INFO = getattr(socket, 'TCP_INFO', 11)
+TCP_INFO_SIZE = 104
+
+
+def read_at(fileobj, offset, size):
+    fileobj.seek(offset)
+    return fileobj.read(size)
 
 
 class HTTPRequestHandler(async_simplehttp.BaseHTTPRequestHandler):
 
-    def __init__(self, sock=None, map=None, root_dir=''):
+    # отдавать тело файла через sendfile, если он доступен
+    use_sendfile = async_handlers.HAVE_SENDFILE
+    # кэш небольших файлов worker'а, None - без кэша
+    file_cache = None
+    # кэш сжатых вариантов, None - без сжатия
+    compression_cache = None
+    # max-age для Cache-Control по расширению файла, 'default' - для остальных
+    cache_control = {}
+    # при большем числе диапазонов в Range отдаем файл целиком
+    max_ranges = 16
+    # пул mmap для файлов средних размеров, None - не отображать
+    mmap_pool = None
+    # счетчики worker'ов в общей памяти, None - не считать
+    metrics = None
+    # URL сводки счетчиков, пустой - не отдавать
+    status_path = '/server-status'
+    # пул потоков worker'а для stat, open, загрузки кэшей и сжатия,
+    # None - все в цикле событий
+    thread_pool = None
+    # журнал запросов worker'а, None - не вести
+    access_log = None
+    # буфер журнала ошибок worker'а, None - logging пишет сразу
+    log_buffer = None
+    # снимок DOCUMENT_ROOT, построенный мастером до fork, None - без прогрева
+    manifest = None
+    # значения счетчиков кэшей, уже прибавленные к metrics
+    published = {}
+
+    # сколько секунд помнить разрешение URL в файл (и 404/403)
+    resolve_ttl = 1.0
+    resolvers = {}
+
+    def __init__(self, sock=None, map=None, root_dir='', server=None):
+        # слушающий сокет, которому сообщаем о закрытии соединения
+        self.server = None
+        self.counted = False
+        self.bytes_counted = 0
+        # задание в пуле потоков и файл, который оно читает
+        self.job_pending = False
+        self.job_file = None
         super(HTTPRequestHandler, self).__init__(sock, map)
         self.root_dir = root_dir
+        self.resolver = self.get_resolver(root_dir)
         self.chunk_size = 1024 * 1024
+        if self.metrics is not None and self.connected:
+            self.counted = True
+            self.metrics.incr('active_connections')
+        if server is not None:
+            self.server = server
+            server.connection_opened()
+
+    @classmethod
+    def get_resolver(cls, root_dir):
+        """Общий для всех соединений worker'а кэш разрешения путей"""
+        resolver = cls.resolvers.get(root_dir)
+        if resolver is None:
+            resolver = filecache.PathResolver(root_dir, CONTENT_TYPES, INDEX_FILE,
+                                              ttl=cls.resolve_ttl)
+            cls.resolvers[root_dir] = resolver
+        return resolver
 
     def handle_get(self):
         """Обработчик GET-запроса"""
@@ -40,104 +122,916 @@ class HTTPRequestHandler(async_simplehttp.BaseHTTPRequestHandler):
 
     def handle_head(self):
         """Обработчик HEAD-запроса"""
-        code = self.get_content()
+        url_path = self.path.split('?', 1)[0]
+        if self.metrics is not None and url_path == self.status_path:
+            code = self.get_status()
+        else:
+            resolution = self.resolver.cached(url_path)
+            if resolution is None:
+                self.lookup_generation = self.resolver.generation
+                if self.defer(self.resolver.lookup, (url_path,), self.lookup_done):
+                    return
+                resolution = self.resolver.store(url_path, self.resolver.lookup(url_path))
+            code = self.get_content(resolution)
         self.send_response(code)
 
-    def get_content(self):
-        code = OK
-        try_index_file = False
-        full_path = self.root_dir + urllib.unquote(self.path.split('?', 1)[0])
-        try:
-            self.content_type = CONTENT_TYPES[os.path.splitext(full_path)[1].lower()]
-        except KeyError:
-            full_path = os.path.join(full_path, INDEX_FILE)
-            self.content_type = CONTENT_TYPES[os.path.splitext(full_path)[1].lower()]
-            try_index_file = True
-        if os.path.exists(full_path):
-            self.content = full_path
-            self.resource = True
-        elif try_index_file:
-            code = FORBIDDEN
+    def defer(self, func, args, callback):
+        """Блокирующий вызов в пуле потоков; False - пула нет или его очередь полна"""
+        if self.thread_pool is None or not self.thread_pool.submit(func, args, callback):
+            return False
+        self.job_pending = True
+        if not self.responding:
+            self.begin_response()
+        return True
+
+    def lookup_done(self, resolution, error):
+        """Файл для URL найден в пуле потоков"""
+        self.job_pending = False
+        if error is not None:
+            raise error
+        resolution = self.resolver.store(self.path.split('?', 1)[0], resolution,
+                                         self.lookup_generation)
+        if self.connected:
+            self.send_response(self.get_content(resolution))
+
+    def get_status(self):
+        """Сводка счетчиков всех worker'ов; ?format=prometheus - для Prometheus"""
+        if 'format=prometheus' in self.path.partition('?')[2].split('&'):
+            self.body = self.metrics.render_prometheus()
+            self.content_type = 'text/plain; version=0.0.4'
         else:
-            code = NOT_FOUND
-        if self.command == 'HEAD':
-            self.content_length = len(self.rawrequest.rstrip())
-            # для того, чтобы пропустить чтение-запись файла
-            self.resource = False
-        elif self.resource:
-            self.content_length = os.path.getsize(full_path)
-            # большой файл отправляем не сразу весь целиком, а chunk-ми
-            if self.content_length > self.chunk_size:
-                self.chunked = True
-            # возвращаем генератор
-            self._reader = self.reader()
+            self.body = self.metrics.render_text()
+            self.content_type = 'text/plain'
+        self.content_length = len(self.body)
+        self.send_header('Cache-Control', 'no-cache')
+        return OK
+
+    @classmethod
+    def set_resolve_ttl(cls, ttl):
+        cls.resolve_ttl = ttl
+        for resolver in cls.resolvers.values():
+            resolver.ttl = ttl
+
+    @classmethod
+    def preload_manifest(cls, root_dir):
+        """Разрешения из снимка мастера действуют, как если бы их нашли
+        в конце обхода: столько, сколько живет разрешение в этом worker'е"""
+        if cls.manifest is not None:
+            cls.get_resolver(root_dir).preload(cls.manifest.resolutions,
+                                               cls.manifest.finished + cls.resolve_ttl)
+
+    @classmethod
+    def invalidate_path(cls, path):
+        """Изменился файл или каталог path в DOCUMENT_ROOT, None - неизвестно что"""
+        # разрешения URL (и 404) находятся заново, со свежим stat и ETag;
+        # кэши сверяют записи с этим stat, а invalidate освобождает память
+        # и ловит перезапись с тем же размером в ту же долю секунды
+        for resolver in cls.resolvers.values():
+            resolver.invalidate()
+        if path is None:
+            return
+        for cache in (cls.file_cache, cls.mmap_pool, cls.compression_cache):
+            if cache is not None:
+                cache.invalidate(path)
+
+    @classmethod
+    def publish_stats(cls):
+        """Копирует счетчики кэшей и журналов worker'а в общую память"""
+        hits = misses = 0
+        for resolver in cls.resolvers.values():
+            stats = resolver.stats()
+            hits += stats['hits']
+            misses += stats['misses']
+        cls.publish_counter('resolver_hits', hits)
+        cls.publish_counter('resolver_misses', misses)
+        for name, cache in (('file_cache', cls.file_cache),
+                            ('mmap', cls.mmap_pool),
+                            ('compression', cls.compression_cache)):
+            if cache is not None:
+                stats = cache.stats()
+                cls.publish_counter(name + '_hits', stats['hits'])
+                cls.publish_counter(name + '_misses', stats['misses'])
+        if cls.access_log is not None:
+            stats = cls.access_log.stats()
+            cls.publish_counter('access_log_dropped', stats['dropped'])
+            cls.publish_counter('access_log_skipped', stats['skipped'])
+        if cls.log_buffer is not None:
+            cls.publish_counter('error_log_dropped', cls.log_buffer.stats()['dropped'])
+
+    @classmethod
+    def publish_counter(cls, name, total):
+        """Счетчик прибавляется к строке worker'а приращением, а не
+        записывается целиком: в строке, доставшейся от собранного
+        worker'а, его значения остаются в сумме"""
+        cls.metrics.incr(name, total - cls.published.get(name, 0))
+        cls.published[name] = total
+
+    def get_content(self, resolution=None):
+        if resolution is None:
+            resolution = self.resolver.resolve(self.path.split('?', 1)[0])
+        self.content_type = resolution.content_type
+        if resolution.code != OK:
+            return resolution.code
+        self.content = resolution.path
+        self.content_length = resolution.stat.st_size
+        compressible = (self.compression_cache is not None and
+                        self.content_type in COMPRESSIBLE_TYPES)
+        if compressible:
+            self.send_header('Vary', 'Accept-Encoding')
+        self.send_validators(resolution)
+        if self.not_modified(resolution):
+            # файл не открываем, тело не отдаем; ETag - того представления,
+            # которое получил бы безусловный запрос (RFC 7232 4.1), но
+            # вариант ради ответа "не изменился" не строится
+            etag = resolution.etag
+            encoding = self.accepted_encoding() if compressible else None
+            if encoding is not None and self.requested_ranges(resolution) is None:
+                encoding = self.compression_cache.expected_encoding(
+                    resolution.path, resolution.stat, encoding, self.thread_pool)
+                if encoding is not None:
+                    etag = filecache.variant_etag(etag, encoding)
+            self.send_header('ETag', etag)
+            self.content_type = ''
+            return NOT_MODIFIED
+        self.etag = resolution.etag
+        code = self.select_representation(resolution, compressible)
+        self.send_header('ETag', self.etag)
         return code
 
-    def read_resourse(self):
-        return self._reader.next()
+    def select_representation(self, resolution, compressible):
+        """Выбор тела ответа: диапазоны, сжатый вариант, кэш или сам файл"""
+        full_path = resolution.path
+        ranges = self.requested_ranges(resolution)
+        if ranges is not None:
+            # диапазоны отдаем только из несжатого файла
+            return self.open_ranges(full_path, ranges)
+        variant = self.compressed_variant(resolution, compressible)
+        if variant is not None:
+            self.send_header('Content-Encoding', variant.encoding)
+            self.etag = filecache.variant_etag(self.etag, variant.encoding)
+            self.content_length = variant.size
+            if variant.data is not None:
+                self.body = variant.data
+                return OK
+            # соседний .gz или большой файл, сжатый во временный
+            return self.open_resource(variant.path)
+        self.send_header('Accept-Ranges', 'bytes')
+        if self.file_cache is not None:
+            # с пулом промах читается в нем, а этот ответ идет из файла
+            entry = self.file_cache.get(full_path, self.content_type, resolution.stat,
+                                        self.thread_pool)
+            if entry is not None:
+                # запись общего кэша закреплена, пока тело не отправлено
+                self.cache_entry = entry
+                self.entity_headers = entry.headers
+                self.body = entry.data
+                return OK
+        if self.mmap_pool is not None and self.command == 'GET':
+            mapping = self.mmap_pool.acquire(full_path, resolution.stat, self.thread_pool)
+            if mapping is not None:
+                # тело уходит в сокет прямо из отображения, без копирования
+                self.mapping = mapping
+                self.body = mapping.view()
+                return OK
+        return self.open_resource(full_path)
+
+    def compressed_variant(self, resolution, compressible):
+        """Сжатый вариант по Accept-Encoding или None - отдается исходный файл"""
+        if not compressible:
+            return None
+        encoding = self.accepted_encoding()
+        if encoding is None:
+            return None
+        return self.compression_cache.get(resolution.path, resolution.stat, encoding,
+                                          self.thread_pool)
+
+    def requested_ranges(self, resolution):
+        """Диапазоны из Range для GET или None, если отдаем файл целиком"""
+        header = self.headers.get('range')
+        if header is None or self.command != 'GET':
+            return None
+        if_range = self.headers.get('if-range')
+        if if_range is not None and not self.if_range_matches(if_range, resolution):
+            return None
+        ranges = async_simplehttp.parse_byte_ranges(header, resolution.stat.st_size)
+        if ranges is not None and len(ranges) > self.max_ranges:
+            return None
+        return ranges
+
+    def if_range_matches(self, if_range, resolution):
+        """If-Range: диапазон отдается, только если файл той же версии"""
+        if_range = if_range.strip()
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            # только сильное сравнение (RFC 7233 3.2)
+            return not resolution.etag.startswith('W/') and if_range == resolution.etag
+        return if_range == resolution.last_modified
+
+    def open_ranges(self, full_path, ranges):
+        size = self.content_length
+        if not ranges:
+            self.send_header('Content-Range', 'bytes */{:d}'.format(size))
+            return REQUESTED_RANGE_NOT_SATISFIABLE
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            self.send_header('Content-Range', 'bytes {:d}-{:d}/{:d}'.format(start, end - 1, size))
+            self.content_length = end - start
+            self.open_resource(full_path, [('', start, end)])
+            return PARTIAL_CONTENT
+        boundary = uuid.uuid4().hex
+        regions = []
+        for start, end in ranges:
+            part_headers = ('\r\n--{}\r\nContent-Type: {}\r\n'
+                            'Content-Range: bytes {:d}-{:d}/{:d}\r\n\r\n').format(
+                boundary, self.content_type, start, end - 1, size)
+            regions.append((part_headers, start, end))
+        regions.append(('\r\n--{}--\r\n'.format(boundary), 0, 0))
+        self.content_type = 'multipart/byteranges; boundary=' + boundary
+        self.content_length = sum(len(part_headers) + end - start
+                                  for part_headers, start, end in regions)
+        self.open_resource(full_path, regions)
+        return PARTIAL_CONTENT
+
+    def send_validators(self, resolution):
+        self.send_header('Last-Modified', resolution.last_modified)
+        max_age = self.cache_control.get(os.path.splitext(resolution.path)[1].lower(),
+                                         self.cache_control.get('default'))
+        if max_age is not None:
+            self.send_header('Cache-Control', 'max-age={:d}'.format(max_age))
+
+    def not_modified(self, resolution):
+        """Условный запрос, а файл не изменился: сначала If-None-Match,
+        без него If-Modified-Since"""
+        if_none_match = self.headers.get('if-none-match')
+        if if_none_match is not None:
+            # для GET/HEAD сравнение слабое (RFC 7232 2.3.2)
+            current = filecache.etag_base(resolution.etag)
+            for etag in if_none_match.split(','):
+                etag = etag.strip()
+                if etag == '*' or filecache.etag_base(etag) == current:
+                    return True
+            return False
+        if_modified_since = self.headers.get('if-modified-since')
+        if if_modified_since is None:
+            return False
+        since = email.utils.parsedate_tz(if_modified_since)
+        if since is None:
+            return False
+        try:
+            since = email.utils.mktime_tz(since)
+        except (OverflowError, ValueError):
+            return False
+        return int(resolution.stat.st_mtime) <= since
+
+    def open_resource(self, full_path, regions=None):
+        """Подготовка отдачи тела из файла.
+
+        regions - части тела: (заголовок части, начало, конец в файле);
+        по умолчанию весь файл.
+        """
+        self.content = full_path
+        if self.command == 'HEAD':
+            # HEAD отвечает теми же заголовками, что и GET, но без тела
+            return OK
+        if regions is None:
+            regions = [('', 0, self.content_length)]
+        self.regions = deque(regions)
+        self.file_offset = self.file_end = 0
+        self.resource = True
+        # open на медленном диске блокирует так же, как stat;
+        # тело затем отдает sendfile, если он есть
+        if not self.defer(open, (full_path, 'rb'), self.open_done):
+            self._file = open(full_path, 'rb')
+        return OK
+
+    def open_done(self, fileobj, error):
+        """Файл тела открыт в пуле потоков"""
+        self.job_pending = False
+        if error is not None:
+            raise error
+        if not self.connected:
+            fileobj.close()
+            return
+        self._file = fileobj
+        # пока шло открытие, writable() был False
+        self.update_interest()
+
+    def accepted_encoding(self):
+        """Поддерживаемая кодировка из Accept-Encoding с наибольшим q или None"""
+        header = self.headers.get('accept-encoding')
+        if not header:
+            return None
+        accepted = {}
+        for item in header.split(','):
+            params = item.split(';')
+            quality = 1.0
+            for param in params[1:]:
+                name, _, value = param.partition('=')
+                if name.strip().lower() == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            accepted[params[0].strip().lower()] = quality
+        default = accepted.get('*', 0.0)
+        best = max(ENCODINGS, key=lambda encoding: accepted.get(encoding, default))
+        if accepted.get(best, default) > 0:
+            return best
+        return None
+
+    def send_resource(self):
+        """Очередная часть тела: заголовок части multipart или кусок файла"""
+        if self.job_pending:
+            # кусок файла еще читается в пуле потоков
+            return
+        if self.file_offset >= self.file_end:
+            if not self.regions:
+                self.resource = False
+                return
+            part_headers, self.file_offset, self.file_end = self.regions.popleft()
+            if part_headers:
+                self.write(part_headers)
+                return
+        count = self.file_end - self.file_offset
+        if self.use_sendfile:
+            # тело отдает ядро прямо из файла
+            try:
+                sent = self.sendfile(self._file, self.file_offset, count)
+            except OSError as err:
+                if err.args[0] not in (errno.EINVAL, errno.ENOSYS):
+                    raise
+                # файловая система не умеет sendfile - дочитываем как обычно
+                self.use_sendfile = False
+                return
+        else:
+            size = min(count, self.chunk_size)
+            if self.defer(read_at, (self._file, self.file_offset, size), self.read_done):
+                self.job_file = self._file
+            else:
+                self.read_done(read_at(self._file, self.file_offset, size), None)
+            return
+        self.file_offset += sent
+
+    def read_done(self, part, error):
+        """Кусок файла прочитан, в пуле потоков или на месте"""
+        fileobj, self.job_file = self.job_file, None
+        self.job_pending = False
+        if fileobj is not None and fileobj is not self._file:
+            # соединение закрылось, пока поток читал: файл закрываем здесь
+            fileobj.close()
+            return
+        if error is not None:
+            raise error
+        if not part:
+            # файл укоротился - обещанную длину ответа уже не отдать
+            self.handle_close()
+            return
+        self.write(part)
+        self.file_offset += len(part)
+
+    def writable(self):
+        if self.job_pending:
+            # пока поток занят, событие записи нужно только для send_buffer
+            return bool(self.send_buffer)
+        return super(HTTPRequestHandler, self).writable()
+
+    def finish_request(self):
+        if self.metrics is not None or self.access_log is not None:
+            seconds = time.time() - self.request_started
+            if self.metrics is not None:
+                self.metrics.request(self.command, self.status, seconds)
+                self.count_bytes()
+            if self.access_log is not None:
+                self.access_log.record(self.addr[0], self.command, self.path,
+                                       self.request_version, self.status,
+                                       self.bytes_sent - self.response_offset, seconds)
+        super(HTTPRequestHandler, self).finish_request()
+
+    def count_bytes(self):
+        self.metrics.incr('bytes_sent', self.bytes_sent - self.bytes_counted)
+        self.bytes_counted = self.bytes_sent
+
+    def reset_request(self):
+        super(HTTPRequestHandler, self).reset_request()
+        self.close_resource()
 
-    def reader(self):
-        with open(self.content, 'rb') as content_file:
-            part = True
-            while part:
-                part = content_file.read(self.chunk_size)
-                yield part
+    def close_resource(self):
+        if getattr(self, '_file', None) is not None and self._file is not self.job_file:
+            # файл, который читает поток, закроет read_done
+            self._file.close()
+        self._file = None
+        self.regions = None
+        self.resource = False
+        if getattr(self, 'mapping', None) is not None:
+            # в очереди не должно остаться срезов отображения,
+            # которое пул может закрыть
+            self.send_buffer.clear()
+            self.body = ''
+            self.mmap_pool.release(self.mapping)
+        self.mapping = None
+        if getattr(self, 'cache_entry', None) is not None:
+            # тело могло остаться в очереди срезом общей памяти
+            self.send_buffer.clear()
+            self.body = ''
+            self.file_cache.release(self.cache_entry)
+        self.cache_entry = None
 
     def handle_close(self):
-        """Закрывает сокет, генератор, удаляет себя из мапа"""
+        """Закрывает сокет, файл, удаляет себя из мапа"""
         super(HTTPRequestHandler, self).handle_close()
-        if hasattr(self, '_reader'):
-            self._reader.close()
+        self.close_resource()
+        if self.counted:
+            # байты недоотправленного ответа тоже ушли в сеть
+            self.counted = False
+            self.count_bytes()
+            self.metrics.incr('active_connections', -1)
+        if self.server is not None:
+            server, self.server = self.server, None
+            server.connection_closed()
+
+
+class LingeringClose(async_handlers.BaseStreamHandler):
+    """Соединение, которому ответ отправлен и сделан shutdown(SHUT_WR).
+
+    Все, что еще пришлет клиент, читается и выбрасывается, пока он
+    не закроет соединение или не пройдет linger секунд.
+    """
+
+    linger = 1.0
+
+    def __init__(self, sock, map=None):
+        super(LingeringClose, self).__init__(sock, map)
+        self.set_deadline(time.time() + self.linger)
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            data = self.socket.recv(65536)
+        except socket.error as err:
+            if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ''
+        if not data:
+            self.handle_close()
+
+    def handle_timeout_event(self, now):
+        self.handle_close()
 
 
 class TCPServer(async_handlers.BaseStreamHandler):
 
-    def __init__(self, addr, handlerclass, map=None, root_dir=''):
+    # сколько соединений принимать за одно событие готовности
+    accept_batch = 16
+    # предел открытых соединений worker'а, 0 - без предела
+    max_connections = 0
+    # при достижении предела принимать и сразу отвечать 503,
+    # а не оставлять соединения в очереди accept
+    reject_overloaded = False
+
+    def __init__(self, addr, handlerclass, map=None, root_dir='',
+                 backlog=socket.SOMAXCONN, reuse_port=False, exclusive=False):
         super(TCPServer, self).__init__(map=map)
         self.root_dir = root_dir
         self.handlerclass = handlerclass
+        self.exclusive = exclusive
+        # свой сокет worker'а: у него своя очередь accept
+        self.reuse_port = reuse_port
+        self.accepted = 0
+        self.accept_queue_full_events = 0
+        self.connections = 0
+        # accept приостановлен: worker заполнен, соединения достаются другим
+        self.paused = False
+        self.pauses = 0
+        self.rejected = 0
+        # готовый ответ 503, пересобирается при смене Date
+        self.overload_date = None
+        self.overload_response = ''
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         self.set_reuse_addr()
+        if reuse_port:
+            self.set_reuse_port()
         self.bind(addr)
-        self.listen(5)
+        self.listen(backlog)
+
+    def readable(self):
+        return not self.paused and super(TCPServer, self).readable()
 
     def handle_accept(self):
-        pair = self.accept()
-        if pair is not None:
+        if self.accept_queue_full():
+            self.accept_queue_full_events += 1
+            if self.handlerclass.metrics is not None:
+                self.handlerclass.metrics.incr('accept_queue_full_events')
+        self.accept_connections(self.accept_batch, self.reject_overloaded)
+
+    def accept_connections(self, limit, reject_overloaded):
+        """Принимает до limit соединений из очереди, None - всю очередь"""
+        accepted = 0
+        while limit is None or accepted < limit:
+            accepted += 1
+            overloaded = self.max_connections and self.connections >= self.max_connections
+            if overloaded and not reject_overloaded:
+                self.pause_accepting()
+                return
+            failures = self.accept_failures
+            pair = self.accept()
+            if pair is None:
+                if self.accept_failures != failures and self.handlerclass.metrics is not None:
+                    self.handlerclass.metrics.incr('accept_failures')
+                return
             sock, addr = pair
             #worker_name = multiprocessing.current_process().name
             #logging.info('{}: Incoming connection from {}'.format(worker_name, addr))
-            _ = self.handlerclass(sock, root_dir=self.root_dir)
+            self.accepted += 1
+            if self.handlerclass.metrics is not None:
+                self.handlerclass.metrics.incr('accepted')
+            if overloaded:
+                self.reject(sock)
+            else:
+                handler = self.handlerclass(sock, root_dir=self.root_dir, server=self)
+                if self.refusing:
+                    # принято при остановке: ответ на первый запрос, и закрываемся
+                    handler.stopping = True
+
+    def pause_accepting(self):
+        """Worker заполнен: снимаем интерес к слушающему сокету, и ядро
+        отдает соединения worker'ам, которые его не сняли"""
+        self.paused = True
+        self.pauses += 1
+        self.update_interest()
+
+    def reject(self, sock):
+        """Ответ 503 без разбора запроса и без обработчика соединения"""
+        date = async_simplehttp.http_date()
+        if date != self.overload_date:
+            self.overload_date = date
+            self.overload_response = self.handlerclass.serialize_error(
+                503, date, (('Retry-After', 1),))
+        self.rejected += 1
+        if self.handlerclass.metrics is not None:
+            self.handlerclass.metrics.incr('rejected')
+        try:
+            sock.setblocking(0)
+            sock.send(self.overload_response)
+            sock.shutdown(socket.SHUT_WR)
+        except socket.error:
+            sock.close()
+            return
+        # запрос обычно еще не пришел: закрыть сразу - и он придет
+        # на закрытый сокет, ядро ответит RST, а клиент потеряет 503
+        LingeringClose(sock, self._map)
+
+    def connection_opened(self):
+        self.connections += 1
+
+    def connection_closed(self):
+        self.connections -= 1
+        if self.paused and self.connections < self.max_connections:
+            self.paused = False
+            self.update_interest()
+
+    def accept_queue_full(self):
+        """Очередь accept заполнена до backlog: соединения, пришедшие сейчас,
+        ядро может отбросить. Сами отброшенные соединения ядро считает
+        только для всей системы (ListenOverflows в /proc/net/netstat)"""
+        try:
+            info = self.socket.getsockopt(socket.IPPROTO_TCP, TCP_INFO, TCP_INFO_SIZE)
+        except socket.error:
+            return False
+        # для слушающего сокета tcpi_unacked - длина очереди, tcpi_sacked - backlog
+        queued, backlog = struct.unpack_from('II', info, 24)
+        return queued >= backlog
+
+    def accept_stats(self):
+        return {'accepted': self.accepted,
+                'accept_failures': self.accept_failures,
+                'accept_queue_full_events': self.accept_queue_full_events,
+                'accept_pauses': self.pauses,
+                'rejected': self.rejected}
+
+    def handle_timeout_event(self, now):
+        if self.handlerclass.metrics is not None:
+            self.handlerclass.publish_stats()
+            self.set_deadline(now + 1.0)
+
+    def handle_stop_event(self):
+        if not (self.reuse_port and self.acceptable()):
+            super(TCPServer, self).handle_stop_event()
+            return
+        # пока сокет SO_REUSEPORT открыт, ядро направляет в его очередь часть
+        # новых соединений, а при закрытии сбрасывает их. Разбираем очередь
+        # (сверх предела - 503) и закрываем сокет, не дожидаясь конца
+        # ответов: дальше соединения достаются остальным worker'ам
+        super(TCPServer, self).handle_stop_event()
+        self.accept_connections(None, True)
+        self.handle_close_event()
+
+    def handle_close_event(self):
+        if self.isrefusing():
+            logging.info('{}: {}'.format(multiprocessing.current_process().name,
+                                         self.accept_stats()))
+        super(TCPServer, self).handle_close_event()
 
 
 HTTPServer = TCPServer
 
 
+def serve(opts, server=None, worker=0):
+    """Цикл worker'а; без server создает свой слушающий сокет с SO_REUSEPORT"""
+    # остановка, запрошенная до цикла событий или после него, не обрывает
+    # worker посреди запуска или записи журналов
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, async_handlers.request_stop)
+    if server is None:
+        server = HTTPServer((opts.host, opts.port), HTTPRequestHandler,
+                            root_dir=opts.root, backlog=opts.backlog,
+                            reuse_port=True)
+    observer = None
+    if opts.shared_cache and HTTPRequestHandler.file_cache is not None:
+        HTTPRequestHandler.file_cache.bind(worker)
+    if HTTPRequestHandler.metrics is not None:
+        HTTPRequestHandler.metrics.bind(worker)
+        # счетчики кэшей раз в секунду копируются в общую память
+        server.set_deadline(time.time() + 1.0)
+        observer = lambda seconds: HTTPRequestHandler.metrics.observe('loop_seconds', seconds)
+    slow_callback = opts.slow_callback / 1000.0 if opts.slow_callback > 0 else None
+    if opts.threads > 0:
+        # потоки не переживают fork, поэтому пул у каждого worker'а свой
+        HTTPRequestHandler.thread_pool = async_handlers.ThreadPool(opts.threads,
+                                                                   opts.thread_queue)
+    if opts.log_buffer > 0:
+        # журнал ошибок пишет поток, цикл событий только кладет записи в буфер
+        HTTPRequestHandler.log_buffer = accesslog.buffer_logging(opts.log_buffer,
+                                                                 opts.log_flush_interval)
+    if opts.access_log:
+        HTTPRequestHandler.access_log = accesslog.AccessLog(
+            opts.access_log, capacity=opts.log_buffer,
+            interval=opts.log_flush_interval, sample=opts.access_log_sample)
+        HTTPRequestHandler.access_log.start()
+    name = multiprocessing.current_process().name
+    if opts.watch:
+        try:
+            watcher = filewatch.FileWatcher(
+                opts.root, HTTPRequestHandler.invalidate_path,
+                on_fallback=lambda: HTTPRequestHandler.set_resolve_ttl(opts.resolve_ttl))
+        except OSError as err:
+            logging.warning('{}: inotify is not available ({}), '
+                            'falling back to stat polling'.format(name, err))
+        else:
+            if watcher.watching:
+                # об изменениях сообщает inotify, stat - только страховка
+                HTTPRequestHandler.set_resolve_ttl(opts.watch_ttl)
+    # после выбора TTL: с inotify снимок живет watch_ttl, без него - resolve_ttl
+    HTTPRequestHandler.preload_manifest(opts.root)
+    sampler = None
+    if opts.profile:
+        sampler = profiler.StackSampler('{}.{}'.format(opts.profile, name),
+                                        interval=opts.profile_interval / 1000.0)
+        sampler.start()
+    try:
+        # SIGTERM/SIGINT: перестать принимать соединения и дописать начатые ответы
+        async_handlers.loop(edge_triggered=opts.edge_triggered, observer=observer,
+                            slow_callback=slow_callback,
+                            stop_signals=(signal.SIGTERM, signal.SIGINT),
+                            engine=opts.engine)
+    finally:
+        if sampler is not None:
+            sampler.stop()
+        if HTTPRequestHandler.access_log is not None:
+            HTTPRequestHandler.access_log.close()
+        if HTTPRequestHandler.log_buffer is not None:
+            accesslog.restore_logging(HTTPRequestHandler.log_buffer)
+    if HTTPRequestHandler.access_log is not None:
+        logging.info('{}: access log {}'.format(name, HTTPRequestHandler.access_log.stats()))
+    if HTTPRequestHandler.log_buffer is not None:
+        logging.info('{}: error log {}'.format(name, HTTPRequestHandler.log_buffer.stats()))
+    for root_dir, resolver in HTTPRequestHandler.resolvers.items():
+        logging.info('{}: path resolver {}'.format(name, resolver.stats()))
+    if HTTPRequestHandler.file_cache is not None:
+        logging.info('{}: file cache {}'.format(name, HTTPRequestHandler.file_cache.stats()))
+    if HTTPRequestHandler.mmap_pool is not None:
+        logging.info('{}: mmap pool {}'.format(name, HTTPRequestHandler.mmap_pool.stats()))
+    if HTTPRequestHandler.compression_cache is not None:
+        logging.info('{}: compression cache {}'.format(
+            name, HTTPRequestHandler.compression_cache.stats()))
+        HTTPRequestHandler.compression_cache.close()
+
+
+def release_worker(worker):
+    """Мастер собрал завершенный worker: его строки в общей памяти свободны"""
+    if HTTPRequestHandler.metrics is not None:
+        HTTPRequestHandler.metrics.release(worker)
+    if isinstance(HTTPRequestHandler.file_cache, filecache.SharedFileCache):
+        HTTPRequestHandler.file_cache.reset(worker)
+
+
+def prewarm(opts):
+    """Снимок DOCUMENT_ROOT для следующего поколения worker'ов.
+
+    Содержимое небольших файлов сразу кладется в кэш файлов: собственный
+    кэш worker'ов создан до fork, поэтому worker'ы получают его копией
+    при записи, общий кэш один на всех.
+    """
+    cache = HTTPRequestHandler.file_cache
+    resolver = filecache.PathResolver(opts.root, CONTENT_TYPES, INDEX_FILE)
+    manifest = filecache.Manifest(resolver, cache.max_file_size if cache is not None else 0)
+    manifest.scan(opts.prewarm_threads)
+    for resolution in manifest.resolutions.itervalues():
+        data = manifest.contents.pop(resolution.path, None)
+        if data is not None:
+            cache.preload(resolution.path, resolution.content_type, resolution.stat, data)
+    HTTPRequestHandler.manifest = manifest
+    stats = manifest.stats()
+    logging.info('Manifest of {}: {} URLs, {} files ({:d} bytes) preloaded in {:.3f}s'.format(
+        opts.root or os.curdir, stats['urls'], stats['files'], stats['bytes'],
+        stats['seconds']))
+
+
+def parse_cpus(value):
+    """--cpu-affinity: auto - все CPU по кругу, иначе список вида 0,2-3"""
+    if value == 'auto':
+        return range(multiprocessing.cpu_count())
+    cpus = []
+    for part in value.split(','):
+        first, _, last = part.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
 if __name__ == '__main__':
-    workers = []
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8080)
     op.add_option("-H", "--host", action="store", default='localhost')
     op.add_option("-w", "--workers", action="store", type=int, default=5)
     op.add_option("-r", "--root", action="store", default='')
     op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("--access-log", action="store", default=None, metavar="FILE",
+                  help="one line per request: address, request line, status, bytes, seconds")
+    op.add_option("--access-log-sample", action="store", type=float, default=1.0,
+                  metavar="RATE", help="fraction of requests written to the access log")
+    op.add_option("--log-buffer", action="store", type=int, default=0, metavar="RECORDS",
+                  help="write the error log of each worker from a thread through a buffer "
+                       "of RECORDS entries, dropping records when it is full; 0 - write "
+                       "from the event loop. Also sizes the access log buffer (default 65536)")
+    op.add_option("--log-flush-interval", action="store", type=float, default=0.5,
+                  metavar="SECONDS")
+    op.add_option("-e", "--edge-triggered", action="store_true", default=False)
+    op.add_option("--engine", type="choice", choices=sorted(async_handlers.ENGINES),
+                  default=async_handlers.DEFAULT_ENGINE,
+                  help="event loop: {} (select handles at most {:d} descriptors "
+                       "per worker)".format(" or ".join(sorted(async_handlers.ENGINES)),
+                                            async_handlers.FD_SETSIZE))
+    op.add_option("-k", "--keepalive-timeout", action="store", type=float,
+                  default=HTTPRequestHandler.keep_alive_timeout)
+    op.add_option("--header-timeout", action="store", type=float,
+                  default=HTTPRequestHandler.header_timeout,
+                  help="seconds to receive request headers, counted from the first byte")
+    op.add_option("--send-timeout", action="store", type=float,
+                  default=HTTPRequestHandler.send_timeout,
+                  help="window in which the client must read at least --min-send-rate")
+    op.add_option("--min-send-rate", action="store", type=int,
+                  default=HTTPRequestHandler.min_send_rate, metavar="BYTES_PER_SEC")
+    op.add_option("-m", "--max-requests", action="store", type=int,
+                  default=HTTPRequestHandler.max_keep_alive_requests)
+    op.add_option("--no-sendfile", action="store_true", default=False)
+    op.add_option("-b", "--backlog", action="store", type=int, default=socket.SOMAXCONN)
+    op.add_option("--reuse-port", action="store_true", default=False)
+    op.add_option("--exclusive", action="store_true", default=False)
+    op.add_option("--max-connections", action="store", type=int,
+                  default=TCPServer.max_connections,
+                  help="open connections per worker; a full worker stops accepting "
+                       "(with --reuse-port its own accept queue waits); 0 - no limit, "
+                       "but at most 480 with --engine select")
+    op.add_option("--accept-batch", action="store", type=int, default=TCPServer.accept_batch,
+                  help="connections accepted per readiness event")
+    op.add_option("--reject-overloaded", action="store_true", default=False,
+                  help="answer 503 to connections over --max-connections "
+                       "instead of leaving them in the accept queue")
+    op.add_option("--cache-size", action="store", type=int, default=32,
+                  help="file cache size per worker, MiB; 0 disables the cache")
+    op.add_option("--cache-entries", action="store", type=int, default=1024)
+    op.add_option("--cache-max-file", action="store", type=int, default=256,
+                  help="largest cached file, KiB")
+    op.add_option("--watch", action="store_true", default=False,
+                  help="invalidate cached lookups and files on inotify events from "
+                       "DOCUMENT_ROOT instead of re-checking them every --resolve-ttl")
+    op.add_option("--watch-ttl", action="store", type=float, default=60,
+                  help="lookup lifetime while all of DOCUMENT_ROOT is watched")
+    op.add_option("--shared-cache", action="store_true", default=False,
+                  help="keep one file cache of --cache-size MiB in shared memory "
+                       "for all workers instead of one per worker")
+    op.add_option("--prewarm", action="store_true", default=False,
+                  help="scan DOCUMENT_ROOT in the master before starting workers "
+                       "(and on SIGHUP) and fill the lookup and file caches from it")
+    op.add_option("--prewarm-threads", action="store", type=int, default=4,
+                  help="threads scanning DOCUMENT_ROOT directories in parallel")
+    op.add_option("--resolve-ttl", action="store", type=float,
+                  default=HTTPRequestHandler.resolve_ttl)
+    op.add_option("--compress-cache-size", action="store", type=int, default=16,
+                  help="compressed variants kept in memory per worker, MiB; "
+                       "0 disables compression")
+    op.add_option("--mmap-size", action="store", type=int, default=0,
+                  help="budget of memory-mapped files per worker, MiB; 0 disables mmap")
+    op.add_option("--mmap-max-file", action="store", type=int, default=16,
+                  help="largest memory-mapped file, MiB")
+    op.add_option("--max-age", action="append", default=[], metavar="EXT=SECONDS",
+                  help="Cache-Control max-age for an extension (.css=3600) "
+                       "or for all other files (default=60); may be repeated")
+    op.add_option("--threads", action="store", type=int, default=0,
+                  help="threads per worker for path lookups, open, file cache and mmap "
+                       "loads, compression and .gz sibling checks, and for file reads when "
+                       "sendfile is off; a response that would wait for them is served "
+                       "from the file itself. 0 keeps all disk access on the event loop "
+                       "and serves large files uncompressed")
+    op.add_option("--thread-queue", action="store", type=int, default=64,
+                  help="pending jobs per pool; when full, the loop does the call itself")
+    op.add_option("--slow-callback", action="store", type=float, default=0, metavar="MS",
+                  help="log event handlers and loop iterations slower than MS milliseconds")
+    op.add_option("--profile", action="store", default=None, metavar="FILE",
+                  help="sample worker stacks into FILE.workerN (folded, for flamegraph.pl)")
+    op.add_option("--profile-interval", action="store", type=float, default=10, metavar="MS",
+                  help="CPU time between stack samples")
+    op.add_option("--status-path", action="store", default=HTTPRequestHandler.status_path,
+                  help="URL of the metrics summary, ?format=prometheus for Prometheus; "
+                       "empty disables metrics")
+    op.add_option("--cpu-affinity", action="store", default=None, metavar="auto|LIST",
+                  help="pin worker N to the N-th CPU of LIST (e.g. 0,2-3) or of all CPUs")
+    op.add_option("--graceful-timeout", action="store", type=float, default=30,
+                  help="seconds a stopping worker may finish its responses before SIGKILL")
+    op.add_option("--restart-backoff", action="store", type=float, default=0.5,
+                  help="first delay before restarting a crashed worker, doubled on each "
+                       "crash up to --restart-backoff-max")
+    op.add_option("--restart-backoff-max", action="store", type=float, default=30)
     (opts, args) = op.parse_args()
     logging.basicConfig(filename=opts.log, level=logging.INFO,
                         format='[%(asctime)s] %(levelname)s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
 
-    server = HTTPServer((opts.host, opts.port), HTTPRequestHandler, root_dir=opts.root)
+    HTTPRequestHandler.keep_alive_timeout = opts.keepalive_timeout
+    HTTPRequestHandler.header_timeout = opts.header_timeout
+    HTTPRequestHandler.send_timeout = opts.send_timeout
+    HTTPRequestHandler.min_send_rate = opts.min_send_rate
+    HTTPRequestHandler.max_keep_alive_requests = opts.max_requests
+    HTTPRequestHandler.resolve_ttl = opts.resolve_ttl
+    HTTPRequestHandler.status_path = opts.status_path
+    if opts.access_log:
+        # ошибки с их статусами попадают в журнал запросов
+        HTTPRequestHandler.log_errors = False
+    TCPServer.max_connections = opts.max_connections
+    if opts.engine == 'select':
+        limit = async_handlers.SelectReactor.max_connections
+        if not 0 < opts.max_connections <= limit:
+            logging.warning('select engine handles descriptors below {:d} only: '
+                            'limiting --max-connections to {:d}'.format(
+                                async_handlers.FD_SETSIZE, limit))
+            TCPServer.max_connections = limit
+    TCPServer.accept_batch = max(opts.accept_batch, 1)
+    TCPServer.reject_overloaded = opts.reject_overloaded
+    if opts.status_path:
+        # общая память создается до fork, у каждого worker'а в ней своя строка
+        HTTPRequestHandler.metrics = metrics.Metrics(opts.workers,
+                                                     HTTPRequestHandler.responses)
+    for max_age in opts.max_age:
+        ext, _, seconds = max_age.partition('=')
+        HTTPRequestHandler.cache_control[ext.lower()] = int(seconds)
+    if opts.no_sendfile:
+        HTTPRequestHandler.use_sendfile = False
+    if opts.cache_size > 0 and opts.shared_cache:
+        # общая память создается до fork, все worker'ы видят одни записи
+        HTTPRequestHandler.file_cache = filecache.SharedFileCache(
+            opts.workers,
+            max_entries=opts.cache_entries,
+            max_bytes=opts.cache_size * 1024 * 1024,
+            max_file_size=opts.cache_max_file * 1024)
+    elif opts.cache_size > 0:
+        # создается до fork, дальше у каждого worker'а своя копия
+        HTTPRequestHandler.file_cache = filecache.FileCache(
+            max_entries=opts.cache_entries,
+            max_bytes=opts.cache_size * 1024 * 1024,
+            max_file_size=opts.cache_max_file * 1024)
+    if opts.mmap_size > 0:
+        HTTPRequestHandler.mmap_pool = filecache.MmapPool(
+            max_bytes=opts.mmap_size * 1024 * 1024,
+            min_file_size=opts.cache_max_file * 1024,
+            max_file_size=opts.mmap_max_file * 1024 * 1024)
+    if opts.compress_cache_size > 0:
+        HTTPRequestHandler.compression_cache = filecache.CompressionCache(
+            max_bytes=opts.compress_cache_size * 1024 * 1024, root_dir=opts.root)
+    server = None
+    if not opts.reuse_port:
+        # один слушающий сокет на всех worker'ов
+        server = HTTPServer((opts.host, opts.port), HTTPRequestHandler,
+                            root_dir=opts.root, backlog=opts.backlog,
+                            exclusive=opts.exclusive)
     logging.info("Starting {} workers at {}".format(opts.workers, opts.port))
-    logging.info('Press Ctrl+C to stop')
-    #multiprocessing.log_to_stderr(logging.INFO)
-    for i in range(opts.workers):
-        p = multiprocessing.Process(target=async_handlers.loop,
-                                    name='worker' + str(i))
-        workers.append(p)
-
-    for worker in workers:
-        worker.start()
-
-    for worker in workers:
-        worker.join()
+    logging.info('Press Ctrl+C to stop, send SIGHUP to restart workers')
+    master = supervisor.Supervisor(
+        lambda worker: serve(opts, server, worker), opts.workers,
+        cpus=parse_cpus(opts.cpu_affinity) if opts.cpu_affinity else None,
+        backoff=opts.restart_backoff, max_backoff=opts.restart_backoff_max,
+        graceful_timeout=opts.graceful_timeout,
+        prepare=(lambda: prewarm(opts)) if opts.prewarm else None,
+        on_exit=release_worker)
+    master.run()
+    if HTTPRequestHandler.metrics is not None:
+        logging.info('Totals: {}'.format(HTTPRequestHandler.metrics.summary()))
     logging.info('Server is stopped')
-
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+from bisect import bisect_left
+
+# верхние границы корзин гистограмм, секунды
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+METHODS = ('GET', 'HEAD', 'other')
+COUNTERS = ('accepted', 'accept_failures', 'accept_queue_full_events', 'rejected',
+            'bytes_sent',
+            'resolver_hits', 'resolver_misses',
+            'file_cache_hits', 'file_cache_misses',
+            'mmap_hits', 'mmap_misses',
+            'compression_hits', 'compression_misses',
+            'access_log_dropped', 'access_log_skipped', 'error_log_dropped')
+# значения, которые описывают живой процесс, а не копятся
+GAUGES = ('active_connections',)
+HISTOGRAMS = ('request_seconds', 'loop_seconds')
+
+HELP = {'accepted': 'Accepted connections',
+        'accept_failures': 'Failed accept() calls: aborted connections, no descriptors or memory',
+        'accept_queue_full_events': 'Accept wakeups that found the listen queue full; '
+                                    'dropped connections are ListenOverflows in /proc/net/netstat',
+        'rejected': 'Connections answered 503 over the per-worker connection limit',
+        'bytes_sent': 'Bytes written to client sockets',
+        'resolver_hits': 'URL lookups answered from the path resolver cache',
+        'resolver_misses': 'URL lookups that went to the file system',
+        'file_cache_hits': 'Responses served from the file cache',
+        'file_cache_misses': 'File cache lookups that had to read the file',
+        'mmap_hits': 'Responses served from an existing memory mapping',
+        'mmap_misses': 'Memory mapping lookups that had to map the file',
+        'compression_hits': 'Compressed variant lookups answered from the cache',
+        'compression_misses': 'Compressed variant lookups that had to compress or stat',
+        'access_log_dropped': 'Access log records dropped on a full buffer',
+        'access_log_skipped': 'Access log records left out by sampling',
+        'error_log_dropped': 'Error log records dropped on a full buffer',
+        'active_connections': 'Open client connections',
+        'requests': 'Finished requests by method and status',
+        'request_seconds': 'Time from the request arriving to the last byte sent',
+        'loop_seconds': 'Time spent dispatching events in one poll loop iteration'}
+
+
+class Metrics(object):
+    """Счетчики и гистограммы worker'ов в общей памяти.
+
+    Создается мастером до fork. У каждого worker'а своя строка массива,
+    в которую пишет только он сам, поэтому блокировки не нужны;
+    суммы по всем строкам может прочитать любой процесс.
+    Строк generations * workers: при перезагрузке старое поколение
+    worker'ов дорабатывает в своих строках, новое пишет в соседние.
+    Строки раздает мастер (supervisor.Supervisor) и, собрав завершенный
+    worker, сбрасывает через release то, что описывает живой процесс.
+    """
+
+    def __init__(self, workers, statuses, generations=2):
+        self.workers = workers
+        self.rows = workers * generations
+        self.statuses = tuple(sorted(statuses)) + ('other',)
+        self.known_statuses = frozenset(statuses)
+        self.index = {}
+        names = list(COUNTERS) + list(GAUGES)
+        names += ['requests:{}:{}'.format(method, status)
+                  for method in METHODS for status in self.statuses]
+        for name in HISTOGRAMS:
+            names += ['{}:{}'.format(name, le) for le in LATENCY_BUCKETS + ('+Inf',)]
+            names += [name + ':sum', name + ':count']
+        for offset, name in enumerate(names):
+            self.index[name] = offset
+        # смещения для горячего пути, без форматирования строк на запрос
+        self.request_index = {}
+        for method in METHODS:
+            for status in self.statuses:
+                self.request_index[method, status] = self.index[
+                    'requests:{}:{}'.format(method, status)]
+        self.histogram_index = {}
+        for name in HISTOGRAMS:
+            self.histogram_index[name] = self.index['{}:{}'.format(name, LATENCY_BUCKETS[0])]
+        self.names = names
+        self.size = len(names)
+        self.shared = multiprocessing.RawArray('d', self.rows * self.size)
+        self.base = 0
+
+    def bind(self, worker):
+        """Дальнейшие изменения пишутся в строку worker'а"""
+        self.base = worker * self.size
+
+    def release(self, worker):
+        """Worker собран мастером: его соединения закрыты, в том числе
+        если его добили SIGKILL. Накопленные счетчики остаются в сумме"""
+        self.shared[worker * self.size + self.index['active_connections']] = 0
+
+    def incr(self, name, value=1):
+        self.shared[self.base + self.index[name]] += value
+
+    def set(self, name, value):
+        self.shared[self.base + self.index[name]] = value
+
+    def observe(self, name, seconds):
+        # корзины, затем +Inf, sum и count подряд
+        offset = self.base + self.histogram_index[name]
+        self.shared[offset + bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.shared[offset + len(LATENCY_BUCKETS) + 1] += seconds
+        self.shared[offset + len(LATENCY_BUCKETS) + 2] += 1
+
+    def request(self, method, status, seconds):
+        if method not in METHODS:
+            method = 'other'
+        if status not in self.known_statuses:
+            status = 'other'
+        self.shared[self.base + self.request_index[method, status]] += 1
+        self.observe('request_seconds', seconds)
+
+    def worker_values(self, worker):
+        start = worker * self.size
+        return dict(zip(self.names, self.shared[start:start + self.size]))
+
+    def totals(self):
+        totals = dict.fromkeys(self.names, 0.0)
+        for worker in range(self.rows):
+            for name, value in self.worker_values(worker).items():
+                totals[name] += value
+        return totals
+
+    def summary(self):
+        """Счетчики и число запросов по всем worker'ам"""
+        totals = self.totals()
+        summary = dict((name, int(totals[name])) for name in COUNTERS + GAUGES)
+        summary['requests'] = int(totals['request_seconds:count'])
+        return summary
+
+    def render_text(self):
+        """Сводка в духе mod_status ?auto: "имя: значение" на строку"""
+        totals = self.totals()
+        lines = ['Workers: {:d}'.format(self.workers)]
+        for name in COUNTERS + GAUGES:
+            lines.append('{}: {:d}'.format(name, int(totals[name])))
+        for method in METHODS:
+            for status in self.statuses:
+                value = totals['requests:{}:{}'.format(method, status)]
+                if value:
+                    lines.append('requests {} {}: {:d}'.format(method, status, int(value)))
+        for name in HISTOGRAMS:
+            count = totals[name + ':count']
+            mean = totals[name + ':sum'] / count if count else 0.0
+            lines.append('{} count: {:d}'.format(name, int(count)))
+            lines.append('{} mean: {:.6f}'.format(name, mean))
+        for worker in range(self.rows):
+            values = self.worker_values(worker)
+            if not any(values.values()):
+                continue
+            lines.append('worker{:d}: requests={:d} active_connections={:d} bytes_sent={:d} '
+                         'accepted={:d} accept_failures={:d} accept_queue_full_events={:d}'.format(
+                             worker, int(values['request_seconds:count']),
+                             int(values['active_connections']), int(values['bytes_sent']),
+                             int(values['accepted']), int(values['accept_failures']),
+                             int(values['accept_queue_full_events'])))
+        return '\n'.join(lines) + '\n'
+
+    def render_prometheus(self, prefix='httpd_'):
+        """Текстовый формат Prometheus (version 0.0.4)"""
+        totals = self.totals()
+        lines = []
+        for name in COUNTERS:
+            lines.append('# HELP {}{}_total {}'.format(prefix, name, HELP[name]))
+            lines.append('# TYPE {}{}_total counter'.format(prefix, name))
+            lines.append('{}{}_total {:d}'.format(prefix, name, int(totals[name])))
+        for name in GAUGES:
+            lines.append('# HELP {}{} {}'.format(prefix, name, HELP[name]))
+            lines.append('# TYPE {}{} gauge'.format(prefix, name))
+            lines.append('{}{} {:d}'.format(prefix, name, int(totals[name])))
+        lines.append('# HELP {}requests_total {}'.format(prefix, HELP['requests']))
+        lines.append('# TYPE {}requests_total counter'.format(prefix))
+        for method in METHODS:
+            for status in self.statuses:
+                value = totals['requests:{}:{}'.format(method, status)]
+                if value:
+                    lines.append('{}requests_total{{method="{}",status="{}"}} {:d}'.format(
+                        prefix, method, status, int(value)))
+        for name in HISTOGRAMS:
+            lines.append('# HELP {}{} {}'.format(prefix, name, HELP[name]))
+            lines.append('# TYPE {}{} histogram'.format(prefix, name))
+            cumulative = 0
+            for le in LATENCY_BUCKETS + ('+Inf',):
+                cumulative += int(totals['{}:{}'.format(name, le)])
+                lines.append('{}{}_bucket{{le="{}"}} {:d}'.format(prefix, name, le, cumulative))
+            lines.append('{}{}_sum {:.6f}'.format(prefix, name, totals[name + ':sum']))
+            lines.append('{}{}_count {:d}'.format(prefix, name, int(totals[name + ':count'])))
+        return '\n'.join(lines) + '\n'
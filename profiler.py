@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+import os
+import signal
+from collections import defaultdict
+
+
+class StackSampler(object):
+    """Выборочный профилировщик по SIGPROF.
+
+    Раз в interval секунд процессорного времени запоминает стек
+    текущего кадра. Результат - "свернутые" стеки (folded stacks),
+    которые понимают flamegraph.pl, speedscope и inferno:
+    одна строка "корень;...;лист число_выборок" на стек.
+    """
+
+    def __init__(self, path, interval=0.01):
+        self.path = path
+        self.interval = interval
+        self.samples = defaultdict(int)
+        self.previous = None
+
+    def start(self):
+        self.previous = signal.signal(signal.SIGPROF, self.sample)
+        # системные вызовы, прерванные сигналом, перезапускаются ядром
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self.previous or signal.SIG_DFL)
+        self.dump()
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        stack.reverse()
+        self.samples[';'.join(stack)] += 1
+
+    def dump(self):
+        with open(self.path, 'w') as output:
+            for stack, count in sorted(self.samples.items()):
+                output.write('{} {:d}\n'.format(stack, count))
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import heapq
+import signal
+import ctypes
+import ctypes.util
+import logging
+import multiprocessing
+
+
+def set_cpu_affinity(cpu):
+    """Привязка текущего процесса к одному CPU (sched_setaffinity через ctypes,
+    в python 2 нет os.sched_setaffinity)"""
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    # cpu_set_t на 1024 CPU
+    mask = (ctypes.c_ubyte * 128)()
+    mask[cpu // 8] = 1 << (cpu % 8)
+    if libc.sched_setaffinity(0, ctypes.c_size_t(len(mask)), mask) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+class Slot(object):
+    """Место worker'а: процесс текущего поколения и история его падений"""
+
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        # строка worker'а в общей памяти
+        self.row = None
+        self.started = 0.0
+        self.failures = 0
+        self.restart_at = 0.0
+
+
+class Supervisor(object):
+    """Мастер-процесс.
+
+    Держит workers процессов и перезапускает упавшие; если worker падает
+    раньше stable_time, задержка перед перезапуском удваивается от backoff
+    до max_backoff. SIGTERM/SIGINT - плавная остановка всех worker'ов,
+    SIGHUP - новое поколение worker'ов на том же слушающем сокете
+    и плавная остановка старого. Не уложившихся в graceful_timeout
+    worker'ов мастер добивает SIGKILL.
+
+    target(worker_id) - тело worker'а. worker_id - его строка в общей
+    памяти (счетчики, закрепления записей кэша), одна из workers *
+    generations. Строка выдается из свободных и возвращается, только когда
+    процесс собран; перед этим мастер вызывает on_exit(worker_id).
+    Поэтому живые worker'ы никогда не делят строку, а перезагрузка,
+    запрошенная, пока старое поколение еще дорабатывает, ждет его ухода.
+    prepare() мастер вызывает перед запуском каждого поколения:
+    то, что он подготовит, worker'ы получат при fork.
+    """
+
+    tick = 0.2
+
+    def __init__(self, target, workers, cpus=None, backoff=0.5, max_backoff=30.0,
+                 stable_time=10.0, graceful_timeout=30.0, prepare=None, generations=2,
+                 on_exit=None):
+        self.target = target
+        self.prepare = prepare
+        self.on_exit = on_exit
+        self.workers = workers
+        self.cpus = cpus
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stable_time = stable_time
+        self.graceful_timeout = graceful_timeout
+        self.slots = [Slot(i) for i in range(workers)]
+        # свободные строки, меньшие номера выдаются первыми
+        self.free_rows = list(range(workers * generations))
+        self.generation = 0
+        # старое поколение: (процесс, срок, после которого SIGKILL, строка)
+        self.retiring = []
+        self.stop_requested = False
+        self.reload_requested = False
+        self.reload_postponed = False
+        self.stopping = False
+        self.stop_deadline = None
+
+    def run(self):
+        # обработчики только ставят флаги, вся работа - в цикле мастера
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        signal.signal(signal.SIGHUP, self.request_reload)
+        self.prepare_generation()
+        for slot in self.slots:
+            self.spawn(slot)
+        while True:
+            if self.stop_requested and not self.stopping:
+                self.stop()
+            if self.reload_requested:
+                self.reload()
+            self.reap()
+            if self.stopping and not self.alive():
+                break
+            time.sleep(self.tick)
+
+    def request_stop(self, signum, frame):
+        self.stop_requested = True
+
+    def request_reload(self, signum, frame):
+        self.reload_requested = True
+
+    def spawn(self, slot):
+        slot.row = heapq.heappop(self.free_rows)
+        process = multiprocessing.Process(target=self.bootstrap,
+                                          args=(slot.index, slot.row),
+                                          name='worker{:d}'.format(slot.index))
+        process.start()
+        slot.process = process
+        slot.started = time.time()
+
+    def release_row(self, row):
+        """Процесс со строкой row собран, строку можно отдать следующему"""
+        if self.on_exit is not None:
+            try:
+                self.on_exit(row)
+            except Exception:
+                logging.exception('Releasing worker row {:d} failed'.format(row))
+        heapq.heappush(self.free_rows, row)
+
+    def bootstrap(self, index, worker_id):
+        """Начало процесса worker'а"""
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        # перезагрузку делает мастер, SIGHUP терминала worker'у не нужен
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        if self.cpus:
+            cpu = self.cpus[index % len(self.cpus)]
+            try:
+                set_cpu_affinity(cpu)
+            except OSError as err:
+                logging.error('worker{:d}: cannot pin to CPU {:d}: {}'.format(index, cpu, err))
+        self.target(worker_id)
+
+    def prepare_generation(self):
+        if self.prepare is None:
+            return
+        try:
+            self.prepare()
+        except Exception:
+            # без подготовки worker'ы все равно работают, только холодными
+            logging.exception('Preparing worker generation {:d} failed'.format(self.generation))
+
+    def processes(self):
+        running = [slot.process for slot in self.slots if slot.process is not None]
+        return running + [process for process, _, _ in self.retiring]
+
+    def alive(self):
+        return any(process.is_alive() for process in self.processes())
+
+    def stop(self):
+        logging.info('Stopping workers')
+        self.stopping = True
+        self.stop_deadline = time.time() + self.graceful_timeout
+        for process in self.processes():
+            self.kill(process, signal.SIGTERM)
+
+    def reload(self):
+        if self.stopping:
+            self.reload_requested = False
+            return
+        if len(self.free_rows) < self.workers:
+            # строки заняты поколением, которое еще дописывает ответы
+            if not self.reload_postponed:
+                self.reload_postponed = True
+                logging.info('Reload postponed until worker generation {:d} exits'.format(
+                    self.generation - 1))
+            return
+        self.reload_requested = self.reload_postponed = False
+        old = [(slot.process, slot.row) for slot in self.slots if slot.process is not None]
+        self.generation += 1
+        logging.info('Reloading: starting worker generation {:d}'.format(self.generation))
+        self.prepare_generation()
+        for slot in self.slots:
+            slot.failures = 0
+            slot.restart_at = 0.0
+            self.spawn(slot)
+        # слушающий сокет общий: пока старые worker'ы дописывают ответы,
+        # новые соединения уже принимают новые
+        deadline = time.time() + self.graceful_timeout
+        for process, row in old:
+            self.kill(process, signal.SIGTERM)
+            self.retiring.append((process, deadline, row))
+
+    def reap(self):
+        now = time.time()
+        for retired in list(self.retiring):
+            process, deadline, row = retired
+            if not process.is_alive():
+                process.join()
+                self.retiring.remove(retired)
+                self.release_row(row)
+            elif now > deadline:
+                self.kill(process, signal.SIGKILL)
+        for slot in self.slots:
+            process = slot.process
+            if process is not None and not process.is_alive():
+                process.join()
+                slot.process = None
+                self.release_row(slot.row)
+                slot.row = None
+                if not self.stopping:
+                    self.schedule_restart(slot, process.exitcode, now)
+            if slot.process is None and not self.stopping and now >= slot.restart_at:
+                self.spawn(slot)
+        if self.stopping and now > self.stop_deadline:
+            for process in self.processes():
+                self.kill(process, signal.SIGKILL)
+
+    def schedule_restart(self, slot, exitcode, now):
+        if now - slot.started >= self.stable_time:
+            slot.failures = 0
+            delay = 0.0
+        else:
+            slot.failures += 1
+            delay = min(self.backoff * 2 ** (slot.failures - 1), self.max_backoff)
+        slot.restart_at = now + delay
+        logging.error('worker{:d} exited with code {}, restarting in {:.1f}s'.format(
+            slot.index, exitcode, delay))
+
+    def kill(self, process, signum):
+        try:
+            os.kill(process.pid, signum)
+        except OSError:
+            # процесс уже завершился
+            pass
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+
+import accesslog
+
+
+class Collector(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class RingBufferTest(unittest.TestCase):
+
+    def test_overflow_is_dropped(self):
+        buffer = accesslog.RingBuffer(2)
+        self.assertTrue(buffer.put(1))
+        self.assertTrue(buffer.put(2))
+        self.assertFalse(buffer.put(3))
+        self.assertEqual((len(buffer), buffer.dropped), (2, 1))
+        self.assertEqual(buffer.drain(), [1, 2])
+        # после сброса место снова есть
+        self.assertTrue(buffer.put(4))
+        self.assertEqual(buffer.drain(), [4])
+        self.assertEqual(buffer.drain(), [])
+
+
+class BufferedLogHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.target = Collector()
+        self.target.setLevel(logging.WARNING)
+        # поток не запускается: сброс вызывает тест
+        self.handler = accesslog.BufferedLogHandler([self.target], capacity=2, interval=60)
+        self.logger = logging.getLogger('test_accesslog')
+        self.logger.propagate = False
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+
+    def test_overflow_and_flush(self):
+        for i in range(3):
+            self.logger.error('error %d', i)
+        self.assertEqual(self.target.records, [])
+        self.assertEqual(self.handler.stats(), {'dropped': 1})
+        self.handler.flusher.flush()
+        self.assertEqual([record.getMessage() for record in self.target.records],
+                         ['error 0', 'error 1'])
+
+    def test_target_level_applies(self):
+        self.logger.setLevel(logging.INFO)
+        self.logger.info('info')
+        self.logger.warning('warning')
+        self.handler.close()
+        self.assertEqual([record.getMessage() for record in self.target.records], ['warning'])
+
+    def test_traceback_formatted_on_emit(self):
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            self.logger.exception('failed')
+        record, = self.handler.buffer.items
+        self.assertIn('ValueError: boom', record.exc_text)
+
+
+class AccessLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'access.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_close_flushes_buffer(self):
+        log = accesslog.AccessLog(self.path, capacity=1)
+        log.record('127.0.0.1', 'GET', '/index.html', 'HTTP/1.1', 200, 6, 0.0005)
+        log.record('127.0.0.1', 'GET', '/a.css', 'HTTP/1.1', 200, 7, 0.0005)
+        log.close()
+        with open(self.path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].startswith('127.0.0.1 ['))
+        self.assertTrue(lines[0].endswith('] "GET /index.html HTTP/1.1" 200 6 0.000500'))
+        self.assertEqual(log.stats(), {'written': 1, 'dropped': 1, 'skipped': 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
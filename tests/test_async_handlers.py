@@ -0,0 +1,441 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+import select
+import socket
+import logging
+import tempfile
+import unittest
+
+import httpd
+import async_handlers
+
+
+class Channel(object):
+    """Канал с произвольным номером дескриптора, реактору нужен только интерфейс"""
+
+    accepting = False
+
+    def __init__(self, map, fd):
+        self.map = map
+        self.fd = fd
+        self.closed = False
+        map[fd] = self
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_close(self):
+        self.closed = True
+        del self.map[self.fd]
+
+    def handle_close_event(self):
+        pass
+
+
+class OutputQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = async_handlers.OutputQueue()
+
+    def test_partial_send_slices_without_copy(self):
+        body = bytearray('b' * 100)
+        self.queue.append('head')
+        self.queue.append(body)
+        self.queue.consume(10)
+        self.assertEqual(len(self.queue), 94)
+        # отправлен весь первый кусок и начало второго
+        first = self.queue.views()[0]
+        self.assertEqual(len(first), 94)
+        body[6] = 'x'
+        self.assertEqual(first[0], 'x')
+        self.queue.consume(94)
+        self.assertFalse(self.queue)
+        self.assertEqual(self.queue.views(), [])
+
+    def test_empty_parts_are_skipped(self):
+        self.queue.append('')
+        self.assertFalse(self.queue)
+        self.assertEqual(self.queue.views(), [])
+
+    def test_peek_coalesces_small_parts(self):
+        for part in ('HTTP/1.1 200 OK\r\n', 'Date: now\r\n', '\r\n', 'body'):
+            self.queue.append(part)
+        self.assertEqual(self.queue.peek(), 'HTTP/1.1 200 OK\r\nDate: now\r\n\r\nbody')
+        self.queue.consume(len('HTTP/1.1 200 OK\r\n') + 3)
+        self.assertEqual(self.queue.peek(), 'e: now\r\n\r\nbody')
+
+    def test_peek_stops_at_coalesce_size(self):
+        self.queue.append('h' * 10)
+        self.queue.append('a' * 20)
+        self.queue.append('b' * 100)
+        self.assertEqual(self.queue.peek(coalesce=40), 'h' * 10 + 'a' * 20)
+        # большой первый кусок отдается без склеивания
+        self.queue.consume(30)
+        self.assertIsInstance(self.queue.peek(coalesce=40), memoryview)
+
+    def test_views_limit(self):
+        for _ in range(5):
+            self.queue.append('x')
+        self.assertEqual(len(self.queue.views(limit=3)), 3)
+        self.queue.clear()
+        self.assertEqual(len(self.queue), 0)
+
+
+class SelectReactorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.map = {}
+        self.reactor = async_handlers.SelectReactor(self.map)
+
+    def tearDown(self):
+        self.reactor.close()
+
+    def test_descriptor_over_fd_setsize_is_closed(self):
+        low = Channel(self.map, self.reactor.wakeup_w)
+        low.readable = lambda: False
+        high = Channel(self.map, async_handlers.FD_SETSIZE + 10)
+        self.reactor.poll(0)
+        self.assertTrue(high.closed)
+        self.assertFalse(low.closed)
+
+    def test_unknown_engine_rejected(self):
+        with self.assertRaises(ValueError) as ctx:
+            async_handlers.loop(map=self.map, count=1, engine='kqueue')
+        self.assertIn('select', str(ctx.exception))
+
+
+class SocketChannel(object):
+    """Обработчик поверх socketpair: интерес задает тест, события записываются"""
+
+    accepting = False
+    exclusive = False
+    supports_transport = False
+
+    def __init__(self, map, sock):
+        self.sock = sock
+        self._fileno = sock.fileno()
+        self.want_read = True
+        self.want_write = False
+        self.events = []
+        map[self._fileno] = self
+
+    def readable(self):
+        return self.want_read
+
+    def writable(self):
+        return self.want_write
+
+    def handle_read_event(self):
+        self.events.append('read')
+        self.sock.recv(4096)
+
+    def handle_write_event(self):
+        self.events.append('write')
+
+    def handle_error(self):
+        raise
+
+    def handle_close(self):
+        self.events.append('close')
+
+    def handle_close_event(self):
+        pass
+
+
+@unittest.skipUnless(hasattr(select, 'epoll'), 'epoll is Linux only')
+class EpollReactorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.map = {}
+        self.local, self.remote = socket.socketpair()
+        self.channel = SocketChannel(self.map, self.local)
+
+    def tearDown(self):
+        self.reactor.close()
+        self.local.close()
+        self.remote.close()
+
+    def create(self, edge_triggered=False):
+        self.reactor = async_handlers.EpollReactor(self.map, edge_triggered)
+        return self.reactor
+
+    def test_existing_channels_registered_once(self):
+        reactor = self.create()
+        flags = reactor.interest[self.channel._fileno]
+        self.assertTrue(flags & select.EPOLLIN)
+        self.assertFalse(flags & select.EPOLLOUT)
+        self.assertFalse(flags & select.EPOLLET)
+        # повторная регистрация не меняет интерес и не падает на EEXIST
+        reactor.register(self.channel)
+        self.assertEqual(reactor.interest[self.channel._fileno], flags)
+
+    def test_modify_follows_interest(self):
+        reactor = self.create(edge_triggered=True)
+        fd = self.channel._fileno
+        self.assertTrue(reactor.interest[fd] & select.EPOLLET)
+        self.channel.want_write = True
+        reactor.modify(self.channel)
+        self.assertTrue(reactor.interest[fd] & select.EPOLLOUT)
+        reactor.poll(0)
+        self.assertEqual(self.channel.events, ['write'])
+        # edge-triggered: EPOLLOUT взводится снова, пока есть что отправлять
+        reactor.poll(0)
+        self.assertEqual(self.channel.events, ['write', 'write'])
+        self.channel.want_write = False
+        reactor.poll(0)
+        self.assertEqual(self.channel.events, ['write', 'write', 'write'])
+        self.assertFalse(reactor.interest[fd] & select.EPOLLOUT)
+        reactor.poll(0)
+        self.assertEqual(len(self.channel.events), 3)
+
+    def test_slow_callback_is_logged(self):
+        reactor = self.create()
+        reactor.slow_callback = 0.01
+        recorder = Recorder()
+        logging.getLogger().addHandler(recorder)
+        try:
+            self.channel.handle_read_event = lambda: time.sleep(0.02) or self.local.recv(1)
+            self.remote.send('x')
+            reactor.poll(0)
+        finally:
+            logging.getLogger().removeHandler(recorder)
+        messages = [record.getMessage() for record in recorder.records]
+        self.assertIn('slow callback', messages[0])
+        self.assertIn('slow poll iteration', messages[1])
+        self.assertGreaterEqual(reactor.dispatch_time, 0.02)
+
+    def test_read_event_and_unregister(self):
+        reactor = self.create()
+        self.remote.send('x')
+        reactor.poll(0)
+        self.assertEqual(self.channel.events, ['read'])
+        reactor.unregister(self.channel._fileno)
+        self.assertNotIn(self.channel._fileno, reactor.interest)
+        self.remote.send('y')
+        reactor.poll(0)
+        self.assertEqual(self.channel.events, ['read'])
+
+
+@unittest.skipUnless('asyncio' in async_handlers.ENGINES, 'trollius is not installed')
+class AsyncioReactorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.map = {}
+        self.reactor = None
+        self.root = tempfile.mkdtemp()
+        with open(os.path.join(self.root, 'index.html'), 'wb') as f:
+            f.write('x' * 1000)
+
+    def tearDown(self):
+        if self.reactor is not None:
+            self.reactor.close()
+        for obj in self.map.values():
+            obj.close()
+        shutil.rmtree(self.root)
+
+    def connect(self):
+        """HTTP-обработчик соединения с loopback и клиентский сокет"""
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        client = socket.create_connection(listener.getsockname())
+        client.settimeout(5)
+        self.addCleanup(client.close)
+        sock, _ = listener.accept()
+        listener.close()
+        return httpd.HTTPRequestHandler(sock, self.map, self.root), client
+
+    def receive(self, client, marker, count=1):
+        """Гоняет цикл, пока клиент не получит count ответов"""
+        data = ''
+        deadline = time.time() + 5
+        while data.count(marker) < count and time.time() < deadline:
+            self.reactor.poll(0.05)
+            try:
+                client.setblocking(False)
+                data += client.recv(65536)
+            except socket.error:
+                pass
+            finally:
+                client.settimeout(5)
+        return data
+
+    def test_readiness_channel(self):
+        local, remote = socket.socketpair()
+        self.addCleanup(local.close)
+        self.addCleanup(remote.close)
+        channel = SocketChannel(self.map, local)
+        self.reactor = async_handlers.AsyncioReactor(self.map)
+        self.assertIsNone(self.reactor.channels[channel._fileno])
+        remote.send('x')
+        self.reactor.poll(1)
+        self.assertEqual(channel.events, ['read'])
+        self.reactor.unregister(channel._fileno)
+        self.assertNotIn(channel._fileno, self.reactor.interest)
+        remote.send('y')
+        self.reactor.poll(0.05)
+        self.assertEqual(channel.events, ['read'])
+        del self.map[channel._fileno]
+
+    def test_handler_over_transport(self):
+        handler, client = self.connect()
+        self.reactor = async_handlers.AsyncioReactor(self.map)
+        self.assertIsInstance(handler.transport, async_handlers.AsyncioTransport)
+        # два запроса одним пакетом: ответы по порядку, соединение живо
+        client.sendall('GET /index.html HTTP/1.1\r\nHost: x\r\n\r\n' * 2)
+        data = self.receive(client, 'x' * 1000, 2)
+        self.assertEqual(data.count('HTTP/1.1 200'), 2)
+        self.assertEqual(data.count('x' * 1000), 2)
+        self.assertTrue(handler.connected)
+
+    def test_close_after_response_drains(self):
+        handler, client = self.connect()
+        self.reactor = async_handlers.AsyncioReactor(self.map)
+        client.sendall('GET /index.html HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n')
+        data = self.receive(client, 'x' * 1000)
+        self.assertIn('HTTP/1.1 200', data)
+        deadline = time.time() + 5
+        while handler.connected and time.time() < deadline:
+            self.reactor.poll(0.05)
+        self.assertFalse(handler.connected)
+        self.assertEqual(client.recv(1), '')
+
+    def test_handler_detached_on_close(self):
+        handler, client = self.connect()
+        self.reactor = async_handlers.AsyncioReactor(self.map)
+        self.reactor.close()
+        self.reactor = None
+        # цикл остановлен, обработчик снова пишет в сокет сам
+        self.assertIsNone(handler.transport)
+
+
+class Timer(object):
+
+    def __init__(self):
+        self._deadline = self._timer_slot = None
+
+
+class TimerWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        # тик, точный в двоичной записи: один оборот - 1 секунда
+        self.wheel = async_handlers.TimerWheel(tick=0.125, size=8)
+        self.now = 1000.0
+        self.wheel.current = int(self.now / self.wheel.tick)
+
+    def test_expire_on_deadline_tick(self):
+        timer = Timer()
+        self.wheel.schedule(timer, self.now + 0.3)
+        self.assertEqual(len(self.wheel), 1)
+        self.assertEqual(self.wheel.expired(self.now + 0.25), [])
+        self.assertEqual(self.wheel.expired(self.now + 0.375), [timer])
+        self.assertEqual(len(self.wheel), 0)
+        self.assertIsNone(timer._timer_slot)
+
+    def test_cancel_and_reschedule(self):
+        first, second = Timer(), Timer()
+        self.wheel.schedule(first, self.now + 0.5)
+        self.wheel.schedule(second, self.now + 0.5)
+        self.wheel.schedule(first, None)
+        # перенос срока: объект в колесе один раз
+        self.wheel.schedule(second, self.now + 0.25)
+        self.wheel.schedule(second, self.now + 0.75)
+        self.assertEqual(len(self.wheel), 1)
+        self.wheel.cancel(first)
+        self.assertEqual(self.wheel.expired(self.now + 0.5), [])
+        self.assertEqual(self.wheel.expired(self.now + 1), [second])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_past_deadline_fires_on_next_tick(self):
+        timer = Timer()
+        self.wheel.schedule(timer, self.now - 5)
+        self.assertEqual(self.wheel.expired(self.now + 0.125), [timer])
+
+    def test_rollover(self):
+        near, far = Timer(), Timer()
+        self.wheel.schedule(near, self.now + 0.25)
+        # больше двух оборотов, в той же ячейке, что и near
+        self.wheel.schedule(far, self.now + 2.25)
+        self.assertEqual(near._timer_slot, far._timer_slot)
+        self.assertEqual(self.wheel.expired(self.now + 0.5), [near])
+        self.assertEqual(self.wheel.expired(self.now + 1.5), [])
+        self.assertEqual(len(self.wheel), 1)
+        # цикл событий проспал больше оборота
+        self.assertEqual(self.wheel.expired(self.now + 5), [far])
+
+    def test_timeout(self):
+        self.assertEqual(self.wheel.timeout(self.now, 30.0), 30.0)
+        timer = Timer()
+        self.wheel.schedule(timer, self.now + 0.3)
+        self.assertEqual(self.wheel.timeout(self.now, 30.0), 0.375)
+        self.assertEqual(self.wheel.timeout(self.now, 0.125), 0.125)
+        self.wheel.schedule(timer, self.now + 3)
+        # срок дальше оборота колеса: ждем не дольше limit
+        self.assertEqual(self.wheel.timeout(self.now, 0.5), 0.5)
+
+
+class Recorder(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class ThreadPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.map = {}
+        self.pool = async_handlers.ThreadPool(2, map=self.map)
+        self.results = []
+        self.recorder = Recorder()
+        logging.getLogger().addHandler(self.recorder)
+
+    def tearDown(self):
+        logging.getLogger().removeHandler(self.recorder)
+        self.pool.waker.close()
+
+    def done(self, result, error):
+        self.results.append((result, error))
+
+    def run_loop(self, count):
+        """Цикл событий: ждем байт в self-pipe и разбираем готовые результаты"""
+        while len(self.results) < count:
+            readable, _, _ = select.select([self.pool.waker.rfd], [], [], 5)
+            self.assertTrue(readable)
+            self.pool.waker.handle_read()
+
+    def test_callback_runs_on_loop(self):
+        self.assertTrue(self.pool.submit(divmod, (7, 2), self.done))
+        self.assertTrue(self.pool.submit(divmod, (1, 0), self.done))
+        self.run_loop(2)
+        self.assertEqual(self.pool.pending, 0)
+        self.assertIn(((3, 1), None), self.results)
+        errors = [error for _, error in self.results if error is not None]
+        self.assertIsInstance(errors[0], ZeroDivisionError)
+
+    def test_failing_ownerless_callback_is_dropped(self):
+        def broken(result, error):
+            raise RuntimeError('callback')
+        self.pool.submit(abs, (-1,), broken)
+        self.pool.submit(abs, (-2,), self.done)
+        self.run_loop(1)
+        self.assertEqual(self.results, [(2, None)])
+        self.assertIn('thread pool callback', self.recorder.records[0].getMessage())
+        # пул не остановлен и принимает следующие задания
+        self.assertFalse(self.pool.closed)
+        self.assertTrue(self.pool.submit(abs, (-3,), self.done))
+        self.run_loop(2)
+        self.assertEqual(self.results[1], (3, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+import time
+import unittest
+
+import async_simplehttp
+from async_simplehttp import DONE, HEADERS, START_LINE, RequestParser, parse_byte_ranges
+
+REQUEST = 'GET /index.html HTTP/1.1\r\nHost: localhost\r\nAccept: */*\r\n\r\n'
+
+
+class RequestParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = RequestParser(max_header_size=256, max_headers=4)
+
+    def test_complete_request(self):
+        self.assertEqual(self.parser.feed(REQUEST), len(REQUEST))
+        self.assertEqual(self.parser.state, DONE)
+        self.assertIsNone(self.parser.error)
+        self.assertEqual(self.parser.startline, 'GET /index.html HTTP/1.1')
+        self.assertEqual(self.parser.headers, {'host': 'localhost', 'accept': '*/*'})
+
+    def test_incremental(self):
+        # по байту: неполная строка не разбирается и не потребляется
+        buffer = ''
+        for char in REQUEST:
+            buffer += char
+            buffer = buffer[self.parser.feed(buffer):]
+            if self.parser.state == DONE:
+                break
+        self.assertEqual(buffer, '')
+        self.assertEqual(self.parser.headers['accept'], '*/*')
+
+    def test_partial_line_is_kept(self):
+        used = self.parser.feed('GET / HTTP/1.1\r\nHo')
+        self.assertEqual(used, len('GET / HTTP/1.1\r\n'))
+        self.assertEqual(self.parser.state, HEADERS)
+
+    def test_pipelined(self):
+        second = 'HEAD /a.css HTTP/1.1\r\nConnection: close\r\n\r\n'
+        data = REQUEST + second
+        used = self.parser.feed(data)
+        self.assertEqual(used, len(REQUEST))
+        self.parser.reset()
+        self.assertEqual(self.parser.feed(data[used:]), len(second))
+        self.assertEqual(self.parser.startline, 'HEAD /a.css HTTP/1.1')
+        self.assertEqual(self.parser.headers, {'connection': 'close'})
+
+    def test_leading_empty_lines_and_bare_lf(self):
+        self.parser.feed('\r\n\nGET / HTTP/1.0\nHost: x\n\n')
+        self.assertEqual(self.parser.state, DONE)
+        self.assertEqual(self.parser.startline, 'GET / HTTP/1.0')
+        self.assertEqual(self.parser.headers, {'host': 'x'})
+
+    def test_http09_has_no_headers(self):
+        self.assertEqual(self.parser.feed('GET /\r\nHost: x\r\n'), len('GET /\r\n'))
+        self.assertEqual(self.parser.state, DONE)
+        self.assertEqual(self.parser.headers, {})
+
+    def test_malformed_header_line_is_ignored(self):
+        self.parser.feed('GET / HTTP/1.1\r\nno colon here\r\nHost: x:80\r\n\r\n')
+        self.assertIsNone(self.parser.error)
+        self.assertEqual(self.parser.headers, {'host': 'x:80'})
+
+    def test_long_start_line(self):
+        self.parser.feed('GET /' + 'a' * 300)
+        self.assertEqual((self.parser.state, self.parser.error), (DONE, 414))
+
+    def test_oversized_headers(self):
+        self.parser.feed('GET / HTTP/1.1\r\n')
+        # заголовки приходят частями, предел считается по всем сразу
+        self.parser.feed('X-A: ' + 'a' * 150 + '\r\n')
+        self.assertIsNone(self.parser.error)
+        self.parser.feed('X-B: ' + 'b' * 150)
+        self.assertEqual((self.parser.state, self.parser.error), (DONE, 431))
+
+    def test_too_many_headers(self):
+        headers = ''.join('X-{:d}: 1\r\n'.format(i) for i in range(5))
+        self.parser.feed('GET / HTTP/1.1\r\n' + headers + '\r\n')
+        self.assertEqual(self.parser.error, 431)
+
+    def test_reset(self):
+        self.parser.feed('GET /' + 'a' * 300)
+        self.parser.reset()
+        self.assertEqual((self.parser.state, self.parser.error), (START_LINE, None))
+        self.parser.feed(REQUEST)
+        self.assertIsNone(self.parser.error)
+
+
+class ParseByteRangesTest(unittest.TestCase):
+
+    def test_single_ranges(self):
+        self.assertEqual(parse_byte_ranges('bytes=0-99', 1000), [(0, 100)])
+        self.assertEqual(parse_byte_ranges('bytes=900-', 1000), [(900, 1000)])
+        self.assertEqual(parse_byte_ranges('bytes=-100', 1000), [(900, 1000)])
+        self.assertEqual(parse_byte_ranges('Bytes = 5-5', 1000), [(5, 6)])
+
+    def test_clipped_to_size(self):
+        self.assertEqual(parse_byte_ranges('bytes=990-2000', 1000), [(990, 1000)])
+        self.assertEqual(parse_byte_ranges('bytes=-5000', 1000), [(0, 1000)])
+
+    def test_multiple_ranges(self):
+        self.assertEqual(parse_byte_ranges('bytes=0-0, -1, 10-19', 100),
+                         [(0, 1), (99, 100), (10, 20)])
+
+    def test_unsatisfiable(self):
+        self.assertEqual(parse_byte_ranges('bytes=1000-', 1000), [])
+        self.assertEqual(parse_byte_ranges('bytes=-0', 1000), [])
+        self.assertEqual(parse_byte_ranges('bytes=0-', 0), [])
+        # удовлетворимые диапазоны списка остаются
+        self.assertEqual(parse_byte_ranges('bytes=2000-3000,0-1', 1000), [(0, 2)])
+
+    def test_invalid_is_ignored(self):
+        for header in ('items=0-1', 'bytes=', 'bytes=5', 'bytes=a-b', 'bytes=10-5',
+                       'bytes=0-1,x', 'bytes=--5', 'bytes=-', 'bytes=+1-2'):
+            self.assertIsNone(parse_byte_ranges(header, 1000), header)
+
+
+class HeaderTemplateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = async_simplehttp.BaseHTTPRequestHandler(None, {})
+        self.handler.request_version = 'HTTP/1.1'
+        self.handler.close_connection = False
+        self.date = async_simplehttp.http_date
+
+    def tearDown(self):
+        async_simplehttp.http_date = self.date
+
+    def sent(self):
+        return ''.join(view.tobytes() for view in self.handler.send_buffer.views())
+
+    def test_template_is_built_once(self):
+        template = self.handler.header_template(200, 'text/css')
+        self.assertEqual(template, 'HTTP/1.1 200 OK\r\nServer: {}\r\nContent-Type: text/css\r\n'
+                         .format(self.handler.version_string()))
+        self.assertIs(self.handler.header_template(200, 'text/css'), template)
+        self.assertNotIn('Content-Type', self.handler.header_template(304, ''))
+
+    def test_headers_are_one_write(self):
+        async_simplehttp.http_date = lambda: 'Thu, 01 Jan 2026 00:00:00 GMT'
+        self.handler.content_type = 'text/css'
+        self.handler.content_length = 5
+        self.handler.send_header('ETag', '"x"')
+        self.handler.send_headers(200)
+        self.assertEqual(len(self.handler.send_buffer.chunks), 1)
+        self.assertEqual(self.sent(), self.handler.header_template(200, 'text/css') +
+                         'Date: Thu, 01 Jan 2026 00:00:00 GMT\r\nContent-Length: 5\r\n'
+                         'ETag: "x"\r\nConnection: keep-alive\r\n\r\n')
+
+    def test_cached_entity_headers(self):
+        self.handler.entity_headers = 'Content-Type: text/html\r\nContent-Length: 2\r\n'
+        self.handler.close_connection = True
+        self.handler.send_headers(200)
+        headers = self.sent()
+        self.assertEqual(headers.count('Content-Type'), 1)
+        self.assertTrue(headers.endswith('Content-Length: 2\r\nConnection: close\r\n\r\n'))
+
+    def test_http09_has_no_headers(self):
+        self.handler.request_version = 'HTTP/0.9'
+        self.handler.send_headers(200)
+        self.assertFalse(self.handler.send_buffer)
+
+
+class HttpDateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.time = time.time
+
+    def tearDown(self):
+        time.time = self.time
+
+    def test_formatted_once_per_second(self):
+        time.time = lambda: 1000000000.25
+        date = async_simplehttp.http_date()
+        self.assertEqual(date, 'Sun, 09 Sep 2001 01:46:40 GMT')
+        time.time = lambda: 1000000000.75
+        self.assertIs(async_simplehttp.http_date(), date)
+        time.time = lambda: 1000000001.0
+        self.assertEqual(async_simplehttp.http_date(), 'Sun, 09 Sep 2001 01:46:41 GMT')
+
+
+if __name__ == '__main__':
+    unittest.main()
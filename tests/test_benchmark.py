@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import socket
+import unittest
+
+import benchmark
+
+
+class ScenarioTest(unittest.TestCase):
+
+    def test_request(self):
+        scenario = benchmark.Scenario('404-storm', 'GET', '/missing-{:d}.html', False, 0, 0)
+        self.assertEqual(scenario.request(), 'GET /missing-1.html HTTP/1.1\r\n'
+                                             'Host: localhost\r\nConnection: close\r\n\r\n')
+        scenario.counter = 99
+        self.assertTrue(scenario.request().startswith('GET /missing-0.html '))
+
+    def test_percentile(self):
+        values = range(1000)
+        self.assertIsNone(benchmark.percentile([], 0.5))
+        self.assertEqual(benchmark.percentile(values, 0.5), 500)
+        self.assertEqual(benchmark.percentile(values, 0.999), 999)
+        self.assertEqual(benchmark.percentile([7], 0.99), 7)
+
+    def test_document_root(self):
+        root = benchmark.make_document_root()
+        try:
+            for name, size in benchmark.FILES.items():
+                self.assertEqual(os.path.getsize(os.path.join(root, name)), size)
+        finally:
+            shutil.rmtree(root)
+
+
+class BenchClientTest(unittest.TestCase):
+    """Разбор ответа клиентом нагрузки; сервер - слушающий сокет без ответов"""
+
+    def setUp(self):
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.stats = benchmark.Stats()
+        # после первого ответа клиент закрывается, не переподключаясь
+        self.stats.running = False
+        self.map = {}
+
+    def tearDown(self):
+        for obj in self.map.values():
+            obj.close()
+        self.listener.close()
+
+    def client(self, method='GET'):
+        scenario = benchmark.Scenario('test', method, '/index.html', True, 0, 0)
+        client = benchmark.BenchClient(self.listener.getsockname(), scenario, self.stats,
+                                       self.map)
+        # соединение с loopback уже установлено, запрос уходит сразу
+        client.send_request()
+        return client
+
+    def test_body_split_across_reads(self):
+        client = self.client()
+        response = 'HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\n0123456789'
+        for part in (response[:10], response[10:42], response[42:]):
+            self.assertEqual(self.stats.latencies, [])
+            client.consume(memoryview(part))
+        self.assertEqual(self.stats.statuses, {200: 1})
+        self.assertEqual(self.stats.bytes, len(response))
+        self.assertEqual(self.map, {})
+
+    def test_head_response_has_no_body(self):
+        client = self.client('HEAD')
+        client.consume(memoryview('HTTP/1.1 200 OK\r\nContent-Length: 1024\r\n\r\n'))
+        self.assertEqual(self.stats.statuses, {200: 1})
+
+    def test_not_modified_has_no_body(self):
+        client = self.client()
+        client.consume(memoryview('HTTP/1.1 304 Not Modified\r\nContent-Length: 1024\r\n\r\n'))
+        self.assertEqual(self.stats.statuses, {304: 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
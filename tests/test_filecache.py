@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+
+import os
+import zlib
+import shutil
+import tempfile
+import unittest
+
+import filecache
+import httpd
+
+
+class PathResolverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'dir'))
+        for name in ('index.html', 'page.html', os.path.join('dir', 'index.html')):
+            with open(os.path.join(self.root, name), 'wb') as f:
+                f.write('<html></html>')
+        self.resolver = filecache.PathResolver(self.root, httpd.CONTENT_TYPES, httpd.INDEX_FILE)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_file_and_index(self):
+        resolution = self.resolver.lookup('/page.html')
+        self.assertEqual(resolution.code, filecache.OK)
+        self.assertEqual(resolution.content_type, 'text/html')
+        self.assertEqual(self.resolver.lookup('/dir/').path,
+                         os.path.join(os.path.realpath(self.root), 'dir', 'index.html'))
+        self.assertEqual(self.resolver.lookup('/missing.html').code, filecache.NOT_FOUND)
+        self.assertEqual(self.resolver.lookup('/missing/').code, filecache.FORBIDDEN)
+
+    def test_file_requested_as_directory(self):
+        self.assertEqual(self.resolver.lookup('/page.html/').code, filecache.NOT_FOUND)
+
+    def test_no_escape_from_root(self):
+        resolution = self.resolver.lookup('/../../etc/passwd')
+        self.assertNotEqual(resolution.code, filecache.OK)
+
+    def test_default_root_is_current_directory(self):
+        cwd = os.getcwd()
+        os.chdir(self.root)
+        try:
+            resolver = filecache.PathResolver('', httpd.CONTENT_TYPES, httpd.INDEX_FILE)
+            self.assertEqual(resolver.lookup('/page.html').code, filecache.OK)
+            self.assertEqual(resolver.lookup('/').code, filecache.OK)
+        finally:
+            os.chdir(cwd)
+
+
+class FileCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = filecache.FileCache(max_entries=2, max_bytes=100, max_file_size=60,
+                                         check_interval=60)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def create(self, name, data):
+        path = os.path.join(self.root, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_lru_by_count(self):
+        a, b, c = [self.create(name, name * 10) for name in 'abc']
+        self.cache.get(a, 'text/plain')
+        self.cache.get(b, 'text/plain')
+        # обращение к a делает вытесняемой запись b
+        self.assertEqual(self.cache.get(a, 'text/plain').data, 'a' * 10)
+        self.cache.get(c, 'text/plain')
+        self.assertEqual(list(self.cache.entries), [a, c])
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_lru_by_bytes(self):
+        a, b = self.create('a', 'a' * 60), self.create('b', 'b' * 50)
+        self.cache.get(a, 'text/plain')
+        self.cache.get(b, 'text/plain')
+        self.assertEqual(list(self.cache.entries), [b])
+        self.assertEqual(self.cache.stats()['bytes'], 50)
+
+    def test_large_file_not_cached(self):
+        path = self.create('big', 'x' * 61)
+        self.assertIsNone(self.cache.get(path, 'text/plain'))
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+    def test_fresh_stat_invalidates(self):
+        path = self.create('page', 'old')
+        entry = self.cache.get(path, 'text/plain', os.stat(path))
+        self.assertIs(self.cache.get(path, 'text/plain', os.stat(path)), entry)
+        self.create('page', 'newer')
+        entry = self.cache.get(path, 'text/plain', os.stat(path))
+        self.assertEqual(entry.data, 'newer')
+        self.assertEqual(self.cache.stats()['bytes'], 5)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+    def test_periodic_revalidation(self):
+        path = self.create('page', 'old')
+        self.cache.get(path, 'text/plain')
+        self.create('page', 'newer')
+        # до check_interval запись отдается без stat
+        self.assertEqual(self.cache.get(path, 'text/plain').data, 'old')
+        self.cache.entries[path].checked -= 60
+        self.assertEqual(self.cache.get(path, 'text/plain').data, 'newer')
+        os.unlink(path)
+        self.cache.entries[path].checked -= 60
+        self.assertIsNone(self.cache.get(path, 'text/plain'))
+        self.assertEqual(self.cache.stats()['bytes'], 0)
+
+    def test_miss_is_read_in_pool(self):
+        pool = QueuedPool()
+        path = self.create('page', 'data')
+        st = os.stat(path)
+        # пока файл читается, запрос отдается из файла, задание одно
+        self.assertIsNone(self.cache.get(path, 'text/plain', st, pool))
+        self.assertIsNone(self.cache.get(path, 'text/plain', st, pool))
+        self.assertEqual(len(pool.jobs), 1)
+        pool.run()
+        self.assertEqual(self.cache.get(path, 'text/plain', st, pool).data, 'data')
+        self.assertEqual(pool.jobs, [])
+
+    def test_invalidate_drops_pool_read(self):
+        pool = QueuedPool()
+        path = self.create('page', 'old')
+        self.cache.get(path, 'text/plain', os.stat(path), pool)
+        self.cache.invalidate(path)
+        pool.run()
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+
+class MmapPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.pool = filecache.MmapPool(max_bytes=250, min_file_size=10, max_file_size=200)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def create(self, name, data):
+        path = os.path.join(self.root, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path, os.stat(path)
+
+    def test_size_bounds(self):
+        self.assertIsNone(self.pool.acquire(*self.create('small', 'x' * 9)))
+        self.assertIsNone(self.pool.acquire(*self.create('large', 'x' * 201)))
+        self.assertEqual(self.pool.stats()['misses'], 0)
+
+    def test_shared_mapping_and_refs(self):
+        path, st = self.create('page', 'a' * 100)
+        first = self.pool.acquire(path, st)
+        second = self.pool.acquire(path, st)
+        self.assertIs(first, second)
+        self.assertEqual(first.view().tobytes(), 'a' * 100)
+        self.assertEqual(first.refs, 2)
+        self.pool.release(first)
+        self.pool.release(second)
+        self.assertEqual(self.pool.stats(), {'hits': 1, 'misses': 1, 'entries': 1, 'bytes': 100})
+
+    def test_changed_file_closed_after_last_release(self):
+        path, st = self.create('page', 'a' * 100)
+        old = self.pool.acquire(path, st)
+        # новая версия подменяет файл переименованием, как при выкладке
+        self.create('page.new', 'b' * 120)
+        os.rename(path + '.new', path)
+        st = os.stat(path)
+        new = self.pool.acquire(path, st)
+        self.assertIsNot(new, old)
+        # ответ со старым отображением еще отправляется
+        self.assertTrue(old.retired)
+        self.assertEqual(old.map[:1], 'a')
+        self.pool.release(old)
+        with self.assertRaises(ValueError):
+            old.map[:1]
+        self.assertEqual(self.pool.stats()['bytes'], 120)
+
+    def test_eviction_skips_busy_mappings(self):
+        busy = self.pool.acquire(*self.create('busy', 'a' * 100))
+        idle = self.pool.acquire(*self.create('idle', 'b' * 100))
+        self.pool.release(idle)
+        self.pool.acquire(*self.create('third', 'c' * 100))
+        self.assertEqual(sorted(os.path.basename(path) for path in self.pool.entries),
+                         ['busy', 'third'])
+        self.assertTrue(idle.retired)
+        self.assertFalse(busy.retired)
+        self.assertEqual(self.pool.stats()['bytes'], 200)
+
+    def test_miss_is_mapped_in_thread_pool(self):
+        threads = QueuedPool()
+        path, st = self.create('page', 'x' * 100)
+        self.assertIsNone(self.pool.acquire(path, st, threads))
+        self.assertIsNone(self.pool.acquire(path, st, threads))
+        self.assertEqual(len(threads.jobs), 1)
+        threads.run()
+        mapping = self.pool.acquire(path, st, threads)
+        self.assertEqual((mapping.refs, mapping.view().tobytes()), (1, 'x' * 100))
+        self.assertEqual(self.pool.stats()['bytes'], 100)
+
+    def test_invalidate_closes_thread_pool_mapping(self):
+        threads = QueuedPool()
+        path, st = self.create('page', 'x' * 100)
+        self.pool.acquire(path, st, threads)
+        self.pool.invalidate(path)
+        threads.run()
+        self.assertEqual(self.pool.stats()['entries'], 0)
+
+
+class CompressionCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'page.html')
+        with open(self.path, 'wb') as f:
+            f.write('<p>compressible</p>' * 100)
+        self.write_sibling('x' * 100)
+        self.cache = filecache.CompressionCache(root_dir=self.root)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.root)
+
+    def write_sibling(self, data):
+        gz_path = self.path + '.gz'
+        with open(gz_path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.rename(gz_path + '.tmp', gz_path)
+
+    def test_sibling_checked_on_new_source_stat(self):
+        st = os.stat(self.path)
+        self.assertEqual(self.cache.get(self.path, st, 'gzip').size, 100)
+        self.write_sibling('y' * 50)
+        # stat исходного файла тот же - .gz не перепроверяется
+        self.assertEqual(self.cache.get(self.path, st, 'gzip').size, 100)
+        self.assertEqual(self.cache.get(self.path, os.stat(self.path), 'gzip').size, 50)
+
+    def test_deleted_sibling(self):
+        self.cache.get(self.path, os.stat(self.path), 'gzip')
+        os.unlink(self.path + '.gz')
+        variant = self.cache.get(self.path, os.stat(self.path), 'gzip')
+        self.assertIsNone(variant.path)
+        self.assertIsNotNone(variant.data)
+
+    def test_sibling_outside_root_is_not_served(self):
+        outside = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(outside, 'secret'), 'wb') as f:
+                f.write('secret')
+            os.unlink(self.path + '.gz')
+            os.symlink(os.path.join(outside, 'secret'), self.path + '.gz')
+            variant = self.cache.get(self.path, os.stat(self.path), 'gzip')
+        finally:
+            shutil.rmtree(outside)
+        # сжатый в памяти вариант вместо файла по ссылке
+        self.assertIsNone(variant.path)
+        self.assertNotIn('secret', zlib.decompress(variant.data, 16 + zlib.MAX_WBITS))
+
+    def test_sibling_link_inside_root(self):
+        os.rename(self.path + '.gz', os.path.join(self.root, 'shared.gz'))
+        os.symlink(os.path.join(self.root, 'shared.gz'), self.path + '.gz')
+        variant = self.cache.get(self.path, os.stat(self.path), 'gzip')
+        self.assertEqual(variant.path, os.path.join(os.path.realpath(self.root), 'shared.gz'))
+
+    def test_sibling_rechecked_in_pool(self):
+        pool = QueuedPool()
+        self.assertIsNone(self.cache.get(self.path, os.stat(self.path), 'gzip', pool))
+        pool.run()
+        # новый stat исходного файла: .gz проверяется в пуле, до того - исходный файл
+        st = os.stat(self.path)
+        self.assertIsNone(self.cache.get(self.path, st, 'gzip', pool))
+        self.assertEqual(len(pool.jobs), 1)
+        self.write_sibling('y' * 50)
+        pool.run()
+        self.assertEqual(self.cache.get(self.path, st, 'gzip', pool).size, 50)
+        self.assertEqual(self.cache.get(self.path, st, 'gzip', pool).size, 50)
+        self.assertEqual(pool.jobs, [])
+
+    def test_small_file_compressed_in_pool(self):
+        pool = QueuedPool()
+        st = os.stat(self.path)
+        self.assertIsNone(self.cache.get(self.path, st, 'deflate', pool))
+        self.assertEqual(self.cache.stats()['bytes'], 0)
+        pool.run()
+        variant = self.cache.get(self.path, st, 'deflate', pool)
+        self.assertEqual(zlib.decompress(variant.data), '<p>compressible</p>' * 100)
+        self.assertEqual(self.cache.stats()['bytes'], variant.size)
+
+    def test_sibling_event_invalidates_source_variant(self):
+        self.cache.get(self.path, os.stat(self.path), 'gzip')
+        self.cache.invalidate(self.path + '.gz')
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+
+class QueuedPool(object):
+    """Пул потоков, задания которого выполняет сам тест"""
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, func, args, callback):
+        self.jobs.append((func, args, callback))
+        return True
+
+    def run(self):
+        jobs, self.jobs = self.jobs, []
+        for func, args, callback in jobs:
+            callback(func(*args), None)
+
+
+class SpooledCompressionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'large.txt')
+        with open(self.path, 'wb') as f:
+            f.write('line of text\n' * 10000)
+        self.cache = filecache.CompressionCache(max_memory_file=1024)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.root)
+
+    def test_large_file_without_pool_is_not_compressed(self):
+        self.assertIsNone(self.cache.get(self.path, os.stat(self.path), 'gzip'))
+        self.assertEqual(self.cache.stats()['spooled'], 0)
+
+    def test_large_file_is_compressed_in_pool(self):
+        pool = QueuedPool()
+        st = os.stat(self.path)
+        # пока сжатие идет, отдается исходный файл, задание одно
+        self.assertIsNone(self.cache.get(self.path, st, 'gzip', pool))
+        self.assertIsNone(self.cache.get(self.path, st, 'gzip', pool))
+        self.assertEqual(len(pool.jobs), 1)
+        pool.run()
+        variant = self.cache.get(self.path, st, 'gzip', pool)
+        self.assertEqual(variant.encoding, 'gzip')
+        self.assertEqual(os.path.getsize(variant.path), variant.size)
+        self.assertLess(variant.size, st.st_size)
+
+
+class SharedFileCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = filecache.SharedFileCache(1, max_entries=8, max_bytes=4096)
+        self.cache.bind(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def create(self, name, size=500):
+        path = os.path.join(self.root, name)
+        with open(path, 'wb') as f:
+            f.write(name[0] * size)
+        return path
+
+    def get(self, path):
+        entry = self.cache.get(path, 'text/plain')
+        self.assertIsNotNone(entry)
+        data = entry.data.tobytes()
+        self.cache.release(entry)
+        return data
+
+    def test_insert_and_hit(self):
+        path = self.create('a.txt')
+        self.assertEqual(self.get(path), 'a' * 500)
+        self.assertEqual(self.get(path), 'a' * 500)
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (1, 1, 1))
+
+    def test_fifo_eviction(self):
+        paths = [self.create('{}.txt'.format(c)) for c in 'abcdefgh']
+        for path in paths:
+            self.get(path)
+        stats = self.cache.stats()
+        self.assertGreater(stats['evictions'], 0)
+        self.assertLessEqual(stats['bytes'], self.cache.capacity)
+        # вытеснены первые записи, последняя на месте
+        self.get(paths[-1])
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.get(paths[0])
+        self.assertEqual(self.cache.stats()['misses'], len(paths) + 1)
+
+    def test_pinned_tail_is_skipped(self):
+        pinned = self.cache.get(self.create('p.txt'), 'text/plain')
+        # кольцо проходит несколько кругов мимо закрепленной записи
+        for i in range(40):
+            path = self.create('{}{:d}.txt'.format('abcdefgh'[i % 8], i))
+            self.assertEqual(self.get(path), path.rsplit('/', 1)[1][0] * 500)
+        self.assertEqual(pinned.data.tobytes(), 'p' * 500)
+        self.assertEqual(self.cache.stats()['retained'], 1)
+        self.cache.release(pinned)
+        self.get(self.create('z.txt'))
+        self.assertEqual(self.cache.stats()['retained'], 0)
+
+    def test_tombstones_are_compacted(self):
+        for i in range(200):
+            self.get(self.create('f{:d}.txt'.format(i), size=100))
+        stats = self.cache.stats()
+        self.assertGreater(self.cache.compactions, 0)
+        self.assertLessEqual(stats['tombstones'], self.cache.table_size // 4 + 1)
+        # записи, перенесенные при перестройке, находятся
+        hits = stats['hits']
+        self.get(os.path.join(self.root, 'f199.txt'))
+        self.assertEqual(self.cache.stats()['hits'], hits + 1)
+
+    def test_release_never_underflows(self):
+        entry = self.cache.get(self.create('a.txt'), 'text/plain')
+        self.cache.release(entry)
+        self.cache.release(entry)
+        self.assertFalse(self.cache.pinned(entry.slot))
+        # запись по-прежнему вытесняется
+        for c in 'bcdefghi':
+            self.get(self.create(c + '.txt'))
+        self.assertGreater(self.cache.stats()['evictions'], 0)
+        self.assertEqual(sum(self.cache.pins), 0)
+
+    def test_bind_keeps_pins_until_reset(self):
+        entry = self.cache.get(self.create('a.txt'), 'text/plain')
+        # новый worker в соседней строке не трогает закрепления живого
+        self.cache.bind(1)
+        self.cache.bind(0)
+        self.assertTrue(self.cache.pinned(entry.slot))
+        self.cache.reset(0)
+        self.assertFalse(self.cache.pinned(entry.slot))
+
+    def test_preload_does_not_pin(self):
+        path = self.create('a.txt')
+        st = os.stat(path)
+        self.cache.preload(path, 'text/plain', st, 'a' * 500)
+        self.assertEqual(sum(self.cache.pins), 0)
+        self.assertEqual(self.get(path), 'a' * 500)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_miss_is_read_in_pool(self):
+        pool = QueuedPool()
+        path = self.create('a.txt')
+        self.assertIsNone(self.cache.get(path, 'text/plain', os.stat(path), pool))
+        self.assertEqual(len(pool.jobs), 1)
+        pool.run()
+        # запись из пула не закреплена, закрепляет ее следующий запрос
+        self.assertEqual(sum(self.cache.pins), 0)
+        entry = self.cache.get(path, 'text/plain', os.stat(path), pool)
+        self.assertEqual(entry.data.tobytes(), 'a' * 500)
+        self.cache.release(entry)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_changed_file_is_reloaded(self):
+        path = self.create('a.txt')
+        self.get(path)
+        with open(path, 'wb') as f:
+            f.write('b' * 300)
+        os.utime(path, (0, 0))
+        self.assertEqual(self.get(path), 'b' * 300)
+        self.assertEqual(self.cache.stats()['entries'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
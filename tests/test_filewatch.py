@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import errno
+import select
+import shutil
+import tempfile
+import unittest
+
+import filecache
+import filewatch
+import httpd
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is Linux only')
+class FileWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = os.path.realpath(tempfile.mkdtemp())
+        self.changed = []
+        self.fallbacks = []
+        self.watcher = filewatch.FileWatcher(self.root, self.changed.append,
+                                             lambda: self.fallbacks.append(True), map={})
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.root)
+
+    def create(self, name, data='x'):
+        path = os.path.join(self.root, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def read_events(self):
+        readable, _, _ = select.select([self.watcher._fileno], [], [], 5)
+        self.assertTrue(readable)
+        self.watcher.handle_read()
+
+    def test_changed_file_reported_once(self):
+        path = self.create('page.html')
+        self.read_events()
+        # IN_CREATE, IN_MODIFY и IN_CLOSE_WRITE одного файла - один вызов
+        self.assertEqual(self.changed, [path])
+
+    def test_new_directory_is_watched(self):
+        os.mkdir(os.path.join(self.root, 'dir'))
+        self.read_events()
+        self.assertEqual(self.changed, [os.path.join(self.root, 'dir')])
+        self.assertIn(os.path.join(self.root, 'dir'), self.watcher.dirs.values())
+        path = self.create(os.path.join('dir', 'page.html'))
+        self.read_events()
+        self.assertEqual(self.changed[-1], path)
+
+    def test_watch_limit_falls_back(self):
+        def exhausted(path, mask):
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        self.watcher.inotify.add_watch = exhausted
+        os.mkdir(os.path.join(self.root, 'dir'))
+        self.read_events()
+        self.assertFalse(self.watcher.watching)
+        self.assertEqual(self.fallbacks, [True])
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is Linux only')
+class InvalidationTest(unittest.TestCase):
+    """Событие inotify сбрасывает разрешения URL и записи кэшей worker'а"""
+
+    def setUp(self):
+        self.root = os.path.realpath(tempfile.mkdtemp())
+        self.path = os.path.join(self.root, 'page.html')
+        with open(self.path, 'wb') as f:
+            f.write('old')
+        httpd.HTTPRequestHandler.file_cache = filecache.FileCache(check_interval=60)
+        self.watcher = filewatch.FileWatcher(self.root, httpd.HTTPRequestHandler.invalidate_path,
+                                             map={})
+
+    def tearDown(self):
+        self.watcher.close()
+        httpd.HTTPRequestHandler.file_cache = None
+        httpd.HTTPRequestHandler.resolvers.clear()
+        shutil.rmtree(self.root)
+
+    def test_write_invalidates_resolution_and_cache(self):
+        resolver = httpd.HTTPRequestHandler.get_resolver(self.root)
+        resolver.store('/page.html', resolver.lookup('/page.html'))
+        cache = httpd.HTTPRequestHandler.file_cache
+        cache.get(self.path, 'text/html')
+        with open(self.path, 'wb') as f:
+            f.write('new')
+        select.select([self.watcher._fileno], [], [], 5)
+        self.watcher.handle_read()
+        self.assertIsNone(resolver.cached('/page.html'))
+        # перезапись того же размера замечена без stat
+        self.assertEqual(cache.get(self.path, 'text/html').data, 'new')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,730 @@
+# -*- coding: utf-8 -*-
+
+import os
+import errno
+import socket
+import select
+import shutil
+import tempfile
+import unittest
+
+import accesslog
+import async_handlers
+import filecache
+import httpd
+import metrics
+
+
+class HandlerTestCase(unittest.TestCase):
+    """Обработчик соединения, принятого с loopback, без цикла событий:
+    события тест подает сам через async_handlers.readwrite"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        self.client = socket.create_connection(listener.getsockname())
+        self.client.settimeout(5)
+        sock, _ = listener.accept()
+        listener.close()
+        self.handler = httpd.HTTPRequestHandler(sock, {}, self.root)
+        self.errors = []
+        self.handler.handle_error = lambda: self.errors.append(True)
+
+    def tearDown(self):
+        self.handler.close()
+        self.client.close()
+        shutil.rmtree(self.root)
+
+    def create(self, name, data):
+        with open(os.path.join(self.root, name), 'wb') as f:
+            f.write(data)
+
+    def exchange(self, request):
+        """Заголовки ответа на request: {имя в нижнем регистре: значение};
+        начало тела, полученное вместе с ними, - в self.body"""
+        self.client.sendall(request)
+        async_handlers.readwrite(self.handler, select.POLLIN)
+        while self.handler.connected and self.handler.writable():
+            async_handlers.readwrite(self.handler, select.POLLOUT)
+        response = ''
+        while '\r\n\r\n' not in response:
+            response += self.client.recv(65536)
+        head, self.body = response.split('\r\n\r\n', 1)
+        lines = head.split('\r\n')
+        headers = {'status': lines[0].split()[1]}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.lower()] = value.strip()
+        return headers
+
+    def read_body(self, headers):
+        """Тело ответа целиком, по Content-Length; остаток - в self.body"""
+        length = int(headers['content-length'])
+        while len(self.body) < length:
+            data = self.client.recv(65536)
+            if not data:
+                break
+            self.body += data
+        body, self.body = self.body[:length], self.body[length:]
+        return body
+
+    def closed_by_server(self):
+        """Сервер закрыл соединение, и клиент дочитал все до EOF"""
+        return not self.handler.connected and self.client.recv(65536) == ''
+
+
+class KeepAliveTest(HandlerTestCase):
+
+    def setUp(self):
+        super(KeepAliveTest, self).setUp()
+        self.create('a.txt', 'first')
+        self.create('b.txt', 'second')
+
+    def test_pipelined_requests_answered_in_order(self):
+        # оба запроса приходят одним пакетом
+        self.client.sendall('GET /a.txt HTTP/1.1\r\nHost: localhost\r\n\r\n'
+                            'GET /b.txt HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        async_handlers.readwrite(self.handler, select.POLLIN)
+        while self.handler.connected and self.handler.writable():
+            async_handlers.readwrite(self.handler, select.POLLOUT)
+        response = ''
+        while response.count('\r\n\r\n') < 2 or not response.endswith('second'):
+            response += self.client.recv(65536)
+        first, second = response.split('HTTP/1.1 ')[1:]
+        self.assertTrue(first.startswith('200 '))
+        self.assertTrue(first.endswith('\r\n\r\nfirst'))
+        self.assertIn('Connection: keep-alive\r\n', first)
+        self.assertTrue(second.startswith('200 '))
+        self.assertTrue(second.endswith('\r\n\r\nsecond'))
+        self.assertEqual(self.handler.requests_served, 2)
+        self.assertTrue(self.handler.connected)
+
+    def test_request_body_skipped_before_next_request(self):
+        self.client.sendall('GET /a.txt HTTP/1.1\r\nHost: localhost\r\n'
+                            'Content-Length: 5\r\n\r\nhello'
+                            'GET /b.txt HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        async_handlers.readwrite(self.handler, select.POLLIN)
+        while self.handler.connected and self.handler.writable():
+            async_handlers.readwrite(self.handler, select.POLLOUT)
+        response = ''
+        while response.count('\r\n\r\n') < 2 or not response.endswith('second'):
+            data = self.client.recv(65536)
+            if not data:
+                break
+            response += data
+        first, second = response.split('HTTP/1.1 ')[1:]
+        # тело первого запроса не принято за начало второго
+        self.assertTrue(first.startswith('200 '))
+        self.assertTrue(first.endswith('\r\n\r\nfirst'))
+        self.assertTrue(second.startswith('200 '))
+        self.assertTrue(second.endswith('\r\n\r\nsecond'))
+        self.assertTrue(self.handler.connected)
+
+    def test_request_body_split_across_reads(self):
+        first = self.exchange('GET /a.txt HTTP/1.1\r\nHost: localhost\r\n'
+                              'Content-Length: 5\r\n\r\nhel')
+        self.assertEqual(self.read_body(first), 'first')
+        second = self.exchange('loGET /b.txt HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        self.assertEqual(second['status'], '200')
+        self.assertEqual(self.read_body(second), 'second')
+
+    def test_unskippable_body_closes(self):
+        for headers in ('Transfer-Encoding: chunked\r\n',
+                        'Content-Length: 5, 5\r\n',
+                        'Content-Length: {:d}\r\n'.format(self.handler.max_body_size + 1)):
+            self.handler.close_connection = False
+            self.handler.parser.feed('GET /a.txt HTTP/1.1\r\n' + headers + '\r\n')
+            self.assertTrue(self.handler.validate_start_line())
+            self.handler.parse_headers()
+            self.assertTrue(self.handler.close_connection, headers)
+            self.assertEqual(self.handler.body_remaining, 0)
+            self.handler.parser.reset()
+
+    def test_connection_close(self):
+        headers = self.exchange('GET /a.txt HTTP/1.1\r\nHost: localhost\r\n'
+                                'Connection: close\r\n\r\n')
+        self.assertEqual(headers['connection'], 'close')
+        self.assertEqual(self.read_body(headers), 'first')
+        self.assertTrue(self.closed_by_server())
+
+    def test_http10_without_keep_alive_closes(self):
+        headers = self.exchange('GET /a.txt HTTP/1.0\r\n\r\n')
+        self.assertEqual(headers['connection'], 'close')
+        self.assertEqual(self.read_body(headers), 'first')
+        self.assertTrue(self.closed_by_server())
+
+    def test_http10_keep_alive(self):
+        headers = self.exchange('GET /a.txt HTTP/1.0\r\nConnection: keep-alive\r\n\r\n')
+        self.assertEqual(headers['connection'], 'keep-alive')
+        self.assertTrue(self.handler.connected)
+
+    def test_last_request_of_connection_closes(self):
+        self.handler.max_keep_alive_requests = 2
+        request = 'GET /a.txt HTTP/1.1\r\nHost: localhost\r\n\r\n'
+        first = self.exchange(request)
+        self.assertEqual(first['connection'], 'keep-alive')
+        self.read_body(first)
+        second = self.exchange(request)
+        self.assertEqual(second['connection'], 'close')
+        self.assertEqual(self.read_body(second), 'first')
+        self.assertTrue(self.closed_by_server())
+
+
+class TimeoutTest(HandlerTestCase):
+    """Сроки соединения из колеса таймеров, время колесу подает тест"""
+
+    def setUp(self):
+        super(TimeoutTest, self).setUp()
+        self.wheel = async_handlers.get_wheel(self.handler._map)
+
+    def start_download(self):
+        self.create('big.txt', 'x' * (8 * 1024 * 1024))
+        self.client.sendall('GET /big.txt HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        async_handlers.readwrite(self.handler, select.POLLIN)
+        # заголовки и первые части тела, дальше клиент не читает
+        async_handlers.readwrite(self.handler, select.POLLOUT)
+        async_handlers.readwrite(self.handler, select.POLLOUT)
+        self.assertTrue(self.handler.responding)
+        return self.handler.send_mark_time + self.handler.send_timeout
+
+    def test_partial_request_line_times_out(self):
+        self.client.sendall('GET /a.t')
+        async_handlers.readwrite(self.handler, select.POLLIN)
+        deadline = self.handler.reading_since + self.handler.header_timeout
+        # досылка по байту не продлевает срок
+        self.client.sendall('xt HT')
+        async_handlers.readwrite(self.handler, select.POLLIN)
+        async_handlers.check_timeouts(self.wheel, deadline - 0.5)
+        self.assertTrue(self.handler.connected)
+        async_handlers.check_timeouts(self.wheel, deadline + 0.5)
+        self.assertFalse(self.handler.connected)
+        self.assertEqual(self.client.recv(65536), '')
+
+    def test_slow_reader_is_dropped(self):
+        self.handler.min_send_rate = 10 ** 9
+        deadline = self.start_download()
+        async_handlers.check_timeouts(self.wheel, deadline + 0.5)
+        self.assertFalse(self.handler.connected)
+        # соединение сброшено, а не закрыто с дочиткой буфера
+        with self.assertRaises(socket.error):
+            while self.client.recv(1024 * 1024):
+                pass
+
+    def test_reader_above_min_rate_keeps_connection(self):
+        self.handler.min_send_rate = 1
+        deadline = self.start_download()
+        async_handlers.check_timeouts(self.wheel, deadline + 0.5)
+        self.assertTrue(self.handler.connected)
+        self.assertEqual(self.handler.send_mark, self.handler.bytes_sent)
+
+
+class RangeTest(HandlerTestCase):
+
+    DATA = '0123456789abcdefghij'
+
+    def setUp(self):
+        super(RangeTest, self).setUp()
+        self.create('data.txt', self.DATA)
+        path = os.path.join(self.root, 'data.txt')
+        # ETag файла, измененного в эту секунду, слабый, а If-Range требует сильного
+        os.utime(path, (1000000000, 1000000000))
+        self.etag = filecache.make_etag(os.stat(path))
+
+    def request(self, *headers):
+        return self.exchange('GET /data.txt HTTP/1.1\r\nHost: localhost\r\n' +
+                             ''.join(header + '\r\n' for header in headers) + '\r\n')
+
+    def test_single_range(self):
+        headers = self.request('Range: bytes=2-5')
+        self.assertEqual(headers['status'], '206')
+        self.assertEqual(headers['content-range'], 'bytes 2-5/20')
+        self.assertEqual(headers['content-type'], 'text/plain')
+        self.assertEqual(self.read_body(headers), '2345')
+
+    def test_suffix_range(self):
+        headers = self.request('Range: bytes=-3')
+        self.assertEqual(headers['content-range'], 'bytes 17-19/20')
+        self.assertEqual(self.read_body(headers), 'hij')
+
+    def test_unsatisfiable(self):
+        headers = self.request('Range: bytes=20-30')
+        self.assertEqual(headers['status'], '416')
+        self.assertEqual(headers['content-range'], 'bytes */20')
+        self.read_body(headers)
+        self.assertTrue(self.handler.connected)
+
+    def test_multipart_byteranges(self):
+        headers = self.request('Range: bytes=0-1,18-')
+        self.assertEqual(headers['status'], '206')
+        content_type, _, boundary = headers['content-type'].partition('; boundary=')
+        self.assertEqual(content_type, 'multipart/byteranges')
+        self.assertNotIn('content-range', headers)
+        expected = ('\r\n--{0}\r\nContent-Type: text/plain\r\nContent-Range: bytes 0-1/20\r\n\r\n01'
+                    '\r\n--{0}\r\nContent-Type: text/plain\r\nContent-Range: bytes 18-19/20\r\n\r\nij'
+                    '\r\n--{0}--\r\n').format(boundary)
+        self.assertEqual(self.read_body(headers), expected)
+        self.assertEqual(int(headers['content-length']), len(expected))
+
+    def test_multipart_does_not_grow_header_templates(self):
+        self.read_body(self.request('Range: bytes=0-1,4-5'))
+        templates = len(self.handler.header_templates)
+        for _ in range(5):
+            self.read_body(self.request('Range: bytes=0-1,4-5'))
+        self.assertEqual(len(self.handler.header_templates), templates)
+
+    def test_if_range_match(self):
+        headers = self.request('Range: bytes=2-5', 'If-Range: ' + self.etag)
+        self.assertEqual(headers['status'], '206')
+        self.assertEqual(self.read_body(headers), '2345')
+
+    def test_if_range_mismatch_sends_whole_file(self):
+        headers = self.request('Range: bytes=2-5', 'If-Range: "stale"')
+        self.assertEqual(headers['status'], '200')
+        self.assertNotIn('content-range', headers)
+        self.assertEqual(self.read_body(headers), self.DATA)
+
+
+class AbortedDownloadTest(HandlerTestCase):
+    """Клиент закрыл соединение посреди тела большого файла"""
+
+    def test_write_event_after_close(self):
+        self.create('big.txt', 'x' * (8 * 1024 * 1024))
+        self.client.sendall('GET /big.txt HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        async_handlers.readwrite(self.handler, select.POLLIN)
+        # заголовки, затем первая часть тела
+        async_handlers.readwrite(self.handler, select.POLLOUT)
+        async_handlers.readwrite(self.handler, select.POLLOUT)
+        self.assertTrue(0 < self.handler.file_offset < self.handler.file_end)
+        self.client.close()
+        # в одной итерации цикла: чтение видит разрыв, затем событие записи
+        async_handlers.readwrite(self.handler, select.POLLIN | select.POLLOUT)
+        self.assertEqual(self.errors, [])
+        self.assertFalse(self.handler.connected)
+        self.assertFalse(self.handler.resource)
+
+
+class ConditionalCompressedTest(HandlerTestCase):
+
+    def setUp(self):
+        super(ConditionalCompressedTest, self).setUp()
+        httpd.HTTPRequestHandler.compression_cache = filecache.CompressionCache()
+        self.create('page.html', '<p>compressible</p>' * 100)
+
+    def tearDown(self):
+        httpd.HTTPRequestHandler.compression_cache.close()
+        httpd.HTTPRequestHandler.compression_cache = None
+        super(ConditionalCompressedTest, self).tearDown()
+
+    def test_not_modified_carries_variant_etag(self):
+        request = 'GET /page.html HTTP/1.1\r\nHost: localhost\r\nAccept-Encoding: gzip\r\n'
+        first = self.exchange(request + '\r\n')
+        self.assertEqual(first['content-encoding'], 'gzip')
+        self.assertTrue(first['etag'].endswith('-gzip"'))
+        second = self.exchange(request + 'If-None-Match: {}\r\n\r\n'.format(first['etag']))
+        self.assertEqual(second['status'], '304')
+        self.assertEqual(second['etag'], first['etag'])
+
+    def test_not_modified_cold_cache(self):
+        # кэш холодный: 304 не сжимает файл ради ETag, а 200 потом
+        # отдает вариант с тем же ETag
+        etag = filecache.make_etag(os.stat(os.path.join(self.root, 'page.html')))
+        request = 'GET /page.html HTTP/1.1\r\nHost: localhost\r\nAccept-Encoding: gzip\r\n'
+        response = self.exchange(request + 'If-None-Match: {}\r\n\r\n'.format(etag))
+        self.assertEqual(response['status'], '304')
+        self.assertEqual(response['etag'], filecache.variant_etag(etag, 'gzip'))
+        stats = httpd.HTTPRequestHandler.compression_cache.stats()
+        self.assertEqual((stats['misses'], stats['entries']), (0, 0))
+        full = self.exchange(request + '\r\n')
+        self.assertEqual(full['etag'], response['etag'])
+        self.assertEqual(httpd.HTTPRequestHandler.compression_cache.stats()['misses'], 1)
+
+    def assert_same_etag(self, name):
+        """ETag 304 на холодном кэше совпадает с ETag ответа 200"""
+        etag = filecache.make_etag(os.stat(os.path.join(self.root, name)))
+        request = 'GET /{} HTTP/1.1\r\nHost: localhost\r\nAccept-Encoding: gzip\r\n'.format(name)
+        cold = self.exchange(request + 'If-None-Match: {}\r\n\r\n'.format(etag))
+        self.assertEqual(cold['status'], '304')
+        full = self.exchange(request + '\r\n')
+        self.assertEqual(full['status'], '200')
+        self.read_body(full)
+        warm = self.exchange(request + 'If-None-Match: {}\r\n\r\n'.format(full['etag']))
+        self.assertEqual(warm['status'], '304')
+        self.assertEqual(cold['etag'], full['etag'])
+        self.assertEqual(warm['etag'], full['etag'])
+        return full
+
+    def test_not_modified_large_file_identity_etag(self):
+        # без пула потоков большой файл отдается несжатым
+        httpd.HTTPRequestHandler.compression_cache.max_memory_file = 1024
+        self.create('large.txt', 'line of text\n' * 1000)
+        self.assertNotIn('content-encoding', self.assert_same_etag('large.txt'))
+
+    def test_not_modified_over_compress_limit_identity_etag(self):
+        httpd.HTTPRequestHandler.compression_cache.max_compress_size = 1024
+        self.create('large.txt', 'line of text\n' * 1000)
+        self.assertNotIn('content-encoding', self.assert_same_etag('large.txt'))
+
+    def test_not_modified_incompressible_identity_etag(self):
+        # выгоду сжатия холодный 304 не знает, готовый вариант - знает
+        self.create('noise.html', os.urandom(4096))
+        etag = filecache.make_etag(os.stat(os.path.join(self.root, 'noise.html')))
+        request = 'GET /noise.html HTTP/1.1\r\nHost: localhost\r\nAccept-Encoding: gzip\r\n'
+        cold = self.exchange(request + 'If-None-Match: {}\r\n\r\n'.format(etag))
+        self.assertEqual(cold['etag'], filecache.variant_etag(etag, 'gzip'))
+        full = self.exchange(request + '\r\n')
+        self.assertNotIn('content-encoding', full)
+        self.assertEqual(full['etag'], etag)
+        self.read_body(full)
+        warm = self.exchange(request + 'If-None-Match: {}\r\n\r\n'.format(etag))
+        self.assertEqual(warm['status'], '304')
+        self.assertEqual(warm['etag'], etag)
+
+    def test_not_modified_small_file_identity_etag(self):
+        self.create('tiny.html', '<p></p>')
+        request = 'GET /tiny.html HTTP/1.1\r\nHost: localhost\r\nAccept-Encoding: gzip\r\n'
+        first = self.exchange(request + '\r\n')
+        self.assertNotIn('content-encoding', first)
+        second = self.exchange(request + 'If-None-Match: {}\r\n\r\n'.format(first['etag']))
+        self.assertEqual(second['etag'], first['etag'])
+
+    def test_not_modified_identity_etag(self):
+        request = 'GET /page.html HTTP/1.1\r\nHost: localhost\r\n'
+        first = self.exchange(request + '\r\n')
+        self.assertNotIn('content-encoding', first)
+        second = self.exchange(request + 'If-None-Match: {}\r\n\r\n'.format(first['etag']))
+        self.assertEqual(second['status'], '304')
+        self.assertEqual(second['etag'], first['etag'])
+
+
+class RejectOverloadedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.map = {}
+        self.server = httpd.TCPServer(('127.0.0.1', 0), httpd.HTTPRequestHandler, map=self.map)
+        self.client = socket.create_connection(self.server.socket.getsockname())
+        self.client.settimeout(5)
+
+    def tearDown(self):
+        for obj in self.map.values():
+            obj.close()
+        self.client.close()
+
+    def test_late_request_does_not_reset_503(self):
+        sock, _ = self.server.socket.accept()
+        self.server.reject(sock)
+        # запрос приходит уже после отправки 503
+        self.client.sendall('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        lingering = [obj for obj in self.map.values() if isinstance(obj, httpd.LingeringClose)]
+        self.assertEqual(len(lingering), 1)
+        select.select([lingering[0].socket], [], [], 5)
+        async_handlers.readwrite(lingering[0], select.POLLIN)
+        response = ''
+        while True:
+            data = self.client.recv(65536)
+            if not data:
+                break
+            response += data
+        self.assertTrue(response.startswith('HTTP/1.1 503 '))
+        self.client.shutdown(socket.SHUT_WR)
+        async_handlers.readwrite(lingering[0], select.POLLIN)
+        self.assertFalse(lingering[0].connected)
+
+
+class PreloadManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        with open(os.path.join(self.root, 'page.html'), 'wb') as f:
+            f.write('<html></html>')
+        resolver = filecache.PathResolver(self.root, httpd.CONTENT_TYPES, httpd.INDEX_FILE)
+        self.manifest = filecache.Manifest(resolver)
+        self.manifest.scan(threads=1)
+        httpd.HTTPRequestHandler.manifest = self.manifest
+
+    def tearDown(self):
+        httpd.HTTPRequestHandler.manifest = None
+        httpd.HTTPRequestHandler.resolvers.clear()
+        httpd.HTTPRequestHandler.resolve_ttl = 1.0
+        shutil.rmtree(self.root)
+
+    def test_preloaded_resolution_is_hit(self):
+        httpd.HTTPRequestHandler.preload_manifest(self.root)
+        resolver = httpd.HTTPRequestHandler.get_resolver(self.root)
+        self.assertIs(resolver.cached('/page.html'), self.manifest.resolutions['/page.html'])
+        self.assertEqual(resolver.stats()['hits'], 1)
+
+    def test_long_scan_with_watch_ttl(self):
+        # обход шел дольше resolve_ttl, с inotify разрешения живут watch_ttl;
+        # срок отсчитывается от конца обхода, а не от его начала
+        self.manifest.started -= 100
+        self.manifest.finished -= 30
+        httpd.HTTPRequestHandler.set_resolve_ttl(60.0)
+        httpd.HTTPRequestHandler.preload_manifest(self.root)
+        resolver = httpd.HTTPRequestHandler.get_resolver(self.root)
+        resolution = resolver.cached('/page.html')
+        self.assertIsNotNone(resolution)
+        self.assertEqual(resolution.expires, self.manifest.finished + 60.0)
+        self.assertEqual(resolver.stats()['misses'], 0)
+
+    def test_scan_finished_longer_than_ttl_ago(self):
+        self.manifest.finished -= 61
+        httpd.HTTPRequestHandler.set_resolve_ttl(60.0)
+        httpd.HTTPRequestHandler.preload_manifest(self.root)
+        resolver = httpd.HTTPRequestHandler.get_resolver(self.root)
+        self.assertIsNone(resolver.cached('/page.html'))
+
+
+class FailingSocket(object):
+    """Слушающий сокет, у которого кончились дескрипторы"""
+
+    def accept(self):
+        raise socket.error(errno.EMFILE, os.strerror(errno.EMFILE))
+
+
+class AcceptTest(unittest.TestCase):
+    """Слушающий сокет worker'а: пачки accept и пауза при пределе соединений"""
+
+    def setUp(self):
+        self.map = {}
+        self.server = httpd.TCPServer(('127.0.0.1', 0), httpd.HTTPRequestHandler, map=self.map,
+                                      reuse_port=True)
+        self.address = self.server.socket.getsockname()
+        self.clients = []
+
+    def tearDown(self):
+        for obj in async_handlers.socket_map.values():
+            if isinstance(obj, httpd.HTTPRequestHandler):
+                obj.close()
+        for obj in self.map.values():
+            obj.close()
+        for client in self.clients:
+            client.close()
+
+    def connect(self, count):
+        for _ in range(count):
+            self.clients.append(socket.create_connection(self.address))
+        # соединения дошли до очереди accept
+        select.select([self.server.socket], [], [], 5)
+
+    def handlers(self):
+        return [obj for obj in async_handlers.socket_map.values()
+                if isinstance(obj, httpd.HTTPRequestHandler) and obj.server is self.server]
+
+    def test_reuse_port_listeners_share_address(self):
+        second = httpd.TCPServer(self.address, httpd.HTTPRequestHandler, map=self.map,
+                                 reuse_port=True)
+        self.assertEqual(second.socket.getsockname(), self.address)
+
+    def test_accept_batch(self):
+        self.server.accept_batch = 2
+        self.connect(3)
+        self.server.handle_accept()
+        self.assertEqual((self.server.accepted, self.server.connections), (2, 2))
+        self.server.handle_accept()
+        self.assertEqual(self.server.accepted, 3)
+        self.assertEqual(len(self.handlers()), 3)
+        self.assertEqual(self.server.accept_stats()['accept_pauses'], 0)
+
+    def test_pause_at_max_connections(self):
+        self.server.max_connections = 1
+        self.connect(2)
+        self.server.handle_accept()
+        # второе соединение остается в очереди для других worker'ов
+        self.assertEqual(self.server.accepted, 1)
+        self.assertTrue(self.server.paused)
+        self.assertFalse(self.server.readable())
+        self.assertEqual(self.server.accept_stats()['accept_pauses'], 1)
+        self.handlers()[0].handle_close()
+        self.assertFalse(self.server.paused)
+        self.assertTrue(self.server.readable())
+        self.server.handle_accept()
+        self.assertEqual(self.server.accepted, 2)
+
+    def test_accept_pressure_in_metrics(self):
+        httpd.HTTPRequestHandler.metrics = metrics.Metrics(1, httpd.HTTPRequestHandler.responses)
+        listener = self.server.socket
+        self.server.socket = FailingSocket()
+        self.server.accept_queue_full = lambda: True
+        try:
+            self.server.handle_accept()
+            self.server.handle_accept()
+            totals = httpd.HTTPRequestHandler.metrics.summary()
+        finally:
+            self.server.socket = listener
+            httpd.HTTPRequestHandler.metrics = None
+        self.assertEqual((totals['accept_failures'], totals['accept_queue_full_events']), (2, 2))
+        self.assertEqual(self.server.accept_stats()['accept_failures'], 2)
+
+    def test_reject_overloaded(self):
+        self.server.max_connections = 1
+        self.server.reject_overloaded = True
+        self.connect(2)
+        self.server.handle_accept()
+        self.assertEqual((self.server.accepted, self.server.rejected), (2, 1))
+        self.assertFalse(self.server.paused)
+        self.assertEqual(len(self.handlers()), 1)
+
+
+class ReusePortStopTest(unittest.TestCase):
+
+    def setUp(self):
+        self.map = {}
+        self.server = httpd.TCPServer(('127.0.0.1', 0), httpd.HTTPRequestHandler, map=self.map,
+                                      reuse_port=True)
+        self.address = self.server.socket.getsockname()
+
+    def tearDown(self):
+        for obj in self.map.values():
+            obj.close()
+
+    def test_queued_connection_accepted_and_listener_closed(self):
+        client = socket.create_connection(self.address)
+        self.server.handle_stop_event()
+        # соединение из очереди принято, а не сброшено вместе с сокетом
+        self.assertEqual(self.server.connections, 1)
+        handler, = [obj for obj in async_handlers.socket_map.values()
+                    if isinstance(obj, httpd.HTTPRequestHandler)]
+        self.assertTrue(handler.stopping)
+        self.assertIsNone(self.server._fileno)
+        with self.assertRaises(socket.error):
+            socket.create_connection(self.address, 1)
+        handler.close()
+        client.close()
+
+
+class ServerStatusTest(HandlerTestCase):
+
+    def setUp(self):
+        httpd.HTTPRequestHandler.metrics = metrics.Metrics(1, httpd.HTTPRequestHandler.responses)
+        super(ServerStatusTest, self).setUp()
+
+    def tearDown(self):
+        super(ServerStatusTest, self).tearDown()
+        httpd.HTTPRequestHandler.metrics = None
+
+    def test_text_and_prometheus(self):
+        request = 'GET /server-status{} HTTP/1.1\r\nHost: localhost\r\n\r\n'
+        text = self.exchange(request.format(''))
+        self.assertEqual((text['status'], text['content-type']), ('200', 'text/plain'))
+        self.assertEqual(text['cache-control'], 'no-cache')
+        body = self.body
+        while len(body) < int(text['content-length']):
+            body += self.client.recv(65536)
+        self.assertIn('Workers: 1\n', body)
+        # соединение теста открыто, пока идет ответ
+        self.assertIn('active_connections: 1\n', body)
+        prometheus = self.exchange(request.format('?format=prometheus'))
+        self.assertEqual(prometheus['content-type'], 'text/plain; version=0.0.4')
+
+    def test_cache_counters_survive_row_reuse(self):
+        cache = httpd.HTTPRequestHandler.file_cache = filecache.FileCache()
+        try:
+            cache.hits = 3
+            httpd.HTTPRequestHandler.publish_stats()
+            cache.hits = 5
+            httpd.HTTPRequestHandler.publish_stats()
+            self.assertEqual(httpd.HTTPRequestHandler.metrics.summary()['file_cache_hits'], 5)
+            # строку собранного worker'а получил новый, его счет начинается с нуля
+            httpd.HTTPRequestHandler.published = {}
+            cache.hits = 2
+            httpd.HTTPRequestHandler.publish_stats()
+            self.assertEqual(httpd.HTTPRequestHandler.metrics.summary()['file_cache_hits'], 7)
+        finally:
+            httpd.HTTPRequestHandler.file_cache = None
+            httpd.HTTPRequestHandler.published = {}
+
+    def test_log_drops_survive_row_reuse(self):
+        handler = httpd.HTTPRequestHandler.log_buffer = accesslog.BufferedLogHandler([])
+        try:
+            handler.buffer.dropped = 4
+            httpd.HTTPRequestHandler.publish_stats()
+            httpd.HTTPRequestHandler.published = {}
+            handler.buffer.dropped = 1
+            httpd.HTTPRequestHandler.publish_stats()
+            self.assertEqual(httpd.HTTPRequestHandler.metrics.summary()['error_log_dropped'], 5)
+            text = httpd.HTTPRequestHandler.metrics.render_prometheus()
+            self.assertIn('# TYPE httpd_error_log_dropped_total counter\n', text)
+            self.assertIn('httpd_error_log_dropped_total 5\n', text)
+        finally:
+            httpd.HTTPRequestHandler.log_buffer = None
+            httpd.HTTPRequestHandler.published = {}
+
+
+class ThreadedOpenTest(HandlerTestCase):
+    """С пулом потоков stat и open уходят в потоки, тело по-прежнему отдает sendfile"""
+
+    def setUp(self):
+        super(ThreadedOpenTest, self).setUp()
+        self.pool = httpd.HTTPRequestHandler.thread_pool = async_handlers.ThreadPool(1, map={})
+        self.sendfile_calls = 0
+        sendfile = self.handler.sendfile
+
+        def counting(*args):
+            self.sendfile_calls += 1
+            return sendfile(*args)
+        self.handler.sendfile = counting
+
+    def tearDown(self):
+        httpd.HTTPRequestHandler.thread_pool = None
+        self.pool.waker.close()
+        super(ThreadedOpenTest, self).tearDown()
+
+    def fetch(self, name, size):
+        """Тело ответа на GET name, задания пула выполняются по ходу"""
+        self.client.sendall('GET /{} HTTP/1.1\r\nHost: localhost\r\n\r\n'.format(name))
+        async_handlers.readwrite(self.handler, select.POLLIN)
+        response = ''
+        while True:
+            if self.handler.writable():
+                async_handlers.readwrite(self.handler, select.POLLOUT)
+            if not self.handler.responding and len(response.partition('\r\n\r\n')[2]) >= size:
+                break
+            readable, _, _ = select.select([self.pool.waker.rfd, self.client], [], [], 5)
+            self.assertTrue(readable)
+            if self.pool.waker.rfd in readable:
+                self.pool.waker.handle_read()
+            if self.client in readable:
+                response += self.client.recv(1024 * 1024)
+        self.assertEqual(self.errors, [])
+        return response.split('\r\n\r\n', 1)[1]
+
+    def test_body_sent_after_deferred_open(self):
+        data = os.urandom(256 * 1024)
+        self.create('data.jpg', data)
+        self.assertEqual(self.fetch('data.jpg', len(data)), data)
+        if async_handlers.HAVE_SENDFILE:
+            self.assertTrue(self.sendfile_calls)
+
+    def test_cache_miss_read_in_pool(self):
+        cache = httpd.HTTPRequestHandler.file_cache = filecache.FileCache()
+        try:
+            self.create('page.html', '<p>cached</p>')
+            # промах: ответ из файла, файл читается в кэш в пуле
+            self.assertEqual(self.fetch('page.html', 13), '<p>cached</p>')
+            while cache.pending:
+                select.select([self.pool.waker.rfd], [], [], 5)
+                self.pool.waker.handle_read()
+            self.assertEqual(cache.stats()['entries'], 1)
+            self.assertEqual(self.fetch('page.html', 13), '<p>cached</p>')
+            self.assertEqual(cache.stats()['hits'], 1)
+        finally:
+            httpd.HTTPRequestHandler.file_cache = None
+
+    def test_open_error_goes_to_handler(self):
+        self.create('gone.jpg', 'x')
+        self.client.sendall('GET /gone.jpg HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        # путь уже разрешен, файл удален до open в потоке
+        self.handler.resolver.store('/gone.jpg', self.handler.resolver.lookup('/gone.jpg'))
+        os.unlink(os.path.join(self.root, 'gone.jpg'))
+        async_handlers.readwrite(self.handler, select.POLLIN)
+        while not self.errors:
+            select.select([self.pool.waker.rfd], [], [], 5)
+            self.pool.waker.handle_read()
+        self.assertFalse(self.handler.job_pending)
+        self.assertFalse(self.pool.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import metrics
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = metrics.Metrics(2, (200, 404))
+
+    def test_rows_are_summed(self):
+        self.metrics.bind(0)
+        self.metrics.incr('accepted')
+        self.metrics.incr('active_connections')
+        self.metrics.bind(3)
+        self.metrics.incr('accepted', 2)
+        self.assertEqual(self.metrics.worker_values(0)['accepted'], 1)
+        self.assertEqual(self.metrics.worker_values(3)['accepted'], 2)
+        summary = self.metrics.summary()
+        self.assertEqual((summary['accepted'], summary['active_connections']), (3, 1))
+
+    def test_bind_keeps_row(self):
+        # строку до сбора прежнего владельца не трогает никто, кроме него
+        self.metrics.bind(1)
+        self.metrics.incr('active_connections')
+        self.metrics.bind(1)
+        self.assertEqual(self.metrics.summary()['active_connections'], 1)
+
+    def test_release_clears_live_gauges_only(self):
+        self.metrics.bind(1)
+        self.metrics.incr('active_connections', 3)
+        self.metrics.incr('bytes_sent', 100)
+        self.metrics.release(1)
+        summary = self.metrics.summary()
+        self.assertEqual((summary['active_connections'], summary['bytes_sent']), (0, 100))
+
+    def test_requests_and_histogram(self):
+        self.metrics.request('GET', 200, 0.002)
+        self.metrics.request('PATCH', 418, 100.0)
+        totals = self.metrics.totals()
+        self.assertEqual(totals['requests:GET:200'], 1)
+        self.assertEqual(totals['requests:other:other'], 1)
+        self.assertEqual(totals['request_seconds:0.0025'], 1)
+        self.assertEqual(totals['request_seconds:+Inf'], 1)
+        self.assertEqual(totals['request_seconds:count'], 2)
+        self.assertAlmostEqual(totals['request_seconds:sum'], 100.002)
+
+    def test_render_text(self):
+        self.metrics.bind(2)
+        self.metrics.incr('accepted')
+        self.metrics.request('HEAD', 404, 0.01)
+        lines = self.metrics.render_text().splitlines()
+        self.assertEqual(lines[0], 'Workers: 2')
+        self.assertIn('accepted: 1', lines)
+        self.assertIn('requests HEAD 404: 1', lines)
+        self.assertIn('worker2: requests=1 active_connections=0 bytes_sent=0 accepted=1 '
+                      'accept_failures=0 accept_queue_full_events=0', lines)
+        # пустые строки worker'ов не выводятся
+        self.assertFalse([line for line in lines if line.startswith('worker0')])
+
+    def test_render_prometheus(self):
+        self.metrics.request('GET', 200, 0.0001)
+        self.metrics.request('GET', 200, 0.3)
+        text = self.metrics.render_prometheus()
+        self.assertIn('httpd_requests_total{method="GET",status="200"} 2\n', text)
+        # корзины накопительные
+        self.assertIn('httpd_request_seconds_bucket{le="0.0005"} 1\n', text)
+        self.assertIn('httpd_request_seconds_bucket{le="0.5"} 2\n', text)
+        self.assertIn('httpd_request_seconds_bucket{le="+Inf"} 2\n', text)
+        self.assertIn('httpd_request_seconds_count 2\n', text)
+
+    def test_cache_totals_are_prometheus_counters(self):
+        self.metrics.incr('file_cache_hits', 3)
+        text = self.metrics.render_prometheus()
+        self.assertIn('# HELP httpd_file_cache_hits_total ', text)
+        self.assertIn('# TYPE httpd_file_cache_hits_total counter\n', text)
+        self.assertIn('httpd_file_cache_hits_total 3\n', text)
+        self.assertIn('# TYPE httpd_active_connections gauge\n', text)
+        self.assertNotIn('httpd_file_cache_hits ', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+import profiler
+
+
+def leaf(sampler):
+    sampler.sample(None, sys._getframe())
+
+
+def caller(sampler):
+    leaf(sampler)
+
+
+class StackSamplerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'profile.worker0')
+        self.sampler = profiler.StackSampler(self.path, interval=0.001)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def read(self):
+        with open(self.path) as profile:
+            return profile.read().splitlines()
+
+    def test_folded_stack(self):
+        caller(self.sampler)
+        caller(self.sampler)
+        (stack, count), = self.sampler.samples.items()
+        # от корня к листу
+        self.assertTrue(stack.endswith(';test_profiler.py:caller;test_profiler.py:leaf'))
+        self.assertEqual(count, 2)
+        self.sampler.dump()
+        self.assertEqual(self.read(), ['{} 2'.format(stack)])
+
+    def test_timer_samples_busy_loop(self):
+        self.sampler.start()
+        try:
+            deadline = time.time() + 0.2
+            while time.time() < deadline:
+                pass
+        finally:
+            self.sampler.stop()
+        lines = self.read()
+        self.assertTrue(lines)
+        self.assertTrue(any('test_timer_samples_busy_loop' in line for line in lines))
+
+
+if __name__ == '__main__':
+    unittest.main()
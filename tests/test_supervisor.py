@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import signal
+import unittest
+
+import supervisor
+
+
+def crash(worker_id):
+    os._exit(3)
+
+
+def drain_forever(worker_id):
+    # дописывает ответы дольше graceful_timeout, пока не придет SIGKILL
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    while True:
+        time.sleep(1)
+
+
+class SupervisorTestCase(unittest.TestCase):
+    """Мастер без своего цикла: тест сам вызывает reload и reap"""
+
+    def create(self, target, workers=1, **kwargs):
+        self.exited = []
+        self.master = supervisor.Supervisor(target, workers, on_exit=self.exited.append,
+                                            **kwargs)
+        for slot in self.master.slots:
+            self.master.spawn(slot)
+        return self.master
+
+    def tearDown(self):
+        for process in self.master.processes():
+            self.master.kill(process, signal.SIGKILL)
+            process.join()
+
+    def wait_exit(self, process):
+        process.join(5)
+        self.assertFalse(process.is_alive())
+
+
+class RespawnTest(SupervisorTestCase):
+
+    def test_backoff_doubles_for_early_crashes(self):
+        master = self.create(crash, backoff=0.5, max_backoff=1.0)
+        slot = master.slots[0]
+        delays = []
+        for _ in range(3):
+            self.wait_exit(slot.process)
+            now = time.time()
+            master.reap()
+            delays.append(slot.restart_at - now)
+            self.assertIsNone(slot.process)
+            slot.restart_at = 0.0
+            master.reap()
+            self.assertIsNotNone(slot.process)
+        self.assertEqual([round(delay, 1) for delay in delays], [0.5, 1.0, 1.0])
+        self.assertEqual(slot.failures, 3)
+
+    def test_row_returned_after_reaping(self):
+        master = self.create(crash, backoff=0.0)
+        process = master.slots[0].process
+        self.wait_exit(process)
+        master.reap()
+        # строка собранного процесса освобождена и снова выдана
+        self.assertEqual(self.exited, [0])
+        self.assertEqual(master.slots[0].row, 0)
+
+
+class ReloadTest(SupervisorTestCase):
+
+    def test_second_reload_waits_for_retiring_generation(self):
+        master = self.create(drain_forever, workers=2, graceful_timeout=60)
+        self.assertEqual(sorted(slot.row for slot in master.slots), [0, 1])
+        master.reload()
+        self.assertEqual(sorted(slot.row for slot in master.slots), [2, 3])
+        retiring = [process for process, _, _ in master.retiring]
+        # первое поколение еще дописывает ответы - строки 0 и 1 заняты
+        master.reload_requested = True
+        master.reload()
+        self.assertTrue(master.reload_requested)
+        self.assertEqual(master.generation, 1)
+        self.assertEqual(self.exited, [])
+        # срок вышел: SIGKILL, затем сбор и освобождение строк
+        master.retiring = [(process, 0, row) for process, _, row in master.retiring]
+        master.reap()
+        for process in retiring:
+            self.wait_exit(process)
+        master.reap()
+        self.assertEqual(sorted(self.exited), [0, 1])
+        master.reload()
+        self.assertFalse(master.reload_requested)
+        self.assertEqual(master.generation, 2)
+        self.assertEqual(sorted(slot.row for slot in master.slots), [0, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()